@@ -6,12 +6,32 @@ Enterprise-grade threat assessment platform with Claude AI
 import streamlit as st
 import anthropic
 import os
-import io
 import sys
 from datetime import datetime
 from pathlib import Path
 import json
 import base64
+import time
+import hashlib
+import zlib
+import sqlite3
+import threading
+import re
+import bisect
+import math
+import tempfile
+import random
+import uuid
+import functools
+import weakref
+from collections import Counter, OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import archives
+import extractors
+import render_worker
 
 # Page configuration
 st.set_page_config(
@@ -383,21 +403,1722 @@ PREFERRED_MESSAGES_API_FAMILIES = [
     "claude",
 ]
 
+# Delay between re-renders of a running assessment job (progress and streamed preview)
+JOB_POLL_INTERVAL_SECONDS = float(os.environ.get('SECUREAI_JOB_POLL_INTERVAL_SECONDS', 1.0))
+
+# Model used for threat assessment generation
+ASSESSMENT_MODEL = "claude-sonnet-4-20250514"
+
+# Token usage counters reported by the Messages API; the cache_* fields cover prompt caching
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+# Input-token budget for one assessment request; uploaded documents are compacted to fit
+PROMPT_TOKEN_BUDGET = int(os.environ.get('SECUREAI_PROMPT_TOKEN_BUDGET', 120000))
+# Token estimates assume about this many characters per token
+CHARS_PER_TOKEN = 4
+# Paragraphs shorter than this (headings, table rules, labels) are never treated as duplicates
+DEDUP_MIN_PARAGRAPH_CHARS = 80
+# Evidence retrieval: above RETRIEVAL_MIN_TOKENS of documents, only the top
+# RETRIEVAL_TOP_K chunks per risk area (and for the framework) are sent
+RETRIEVAL_MIN_TOKENS = int(os.environ.get('SECUREAI_RETRIEVAL_MIN_TOKENS', 6000))
+RETRIEVAL_TOP_K = int(os.environ.get('SECUREAI_RETRIEVAL_TOP_K', 8))
+RETRIEVAL_CHUNK_TOKENS = int(os.environ.get('SECUREAI_RETRIEVAL_CHUNK_TOKENS', 350))
+# Hierarchical summarization: uploads larger than the model context are first
+# summarized in chunks of SUMMARY_CHUNK_TOKENS by up to SUMMARY_WORKERS requests
+MODEL_CONTEXT_TOKENS = int(os.environ.get('SECUREAI_MODEL_CONTEXT_TOKENS', 200000))
+SUMMARY_CHUNK_TOKENS = int(os.environ.get('SECUREAI_SUMMARY_CHUNK_TOKENS', 12000))
+SUMMARY_WORKERS = int(os.environ.get('SECUREAI_SUMMARY_WORKERS', 4))
+# Summary rounds per document before its digest is used as it is
+SUMMARY_MAX_LEVELS = 3
+# Bump whenever the summary prompt changes, so cached digests are regenerated
+SUMMARY_VERSION = 1
+
+# Persistent caches live here (override with SECUREAI_CACHE_DIR, e.g. a mounted volume)
+CACHE_DIR = Path(os.environ.get('SECUREAI_CACHE_DIR', Path.home() / ".cache" / "threat-modeling-tool"))
+
+# Extraction cache: hot entries in memory, everything else on disk under CACHE_DIR
+EXTRACTION_CACHE_MEMORY_BYTES = int(float(os.environ.get('SECUREAI_EXTRACTION_CACHE_MEMORY_MB', 64)) * 1024 * 1024)
+EXTRACTION_CACHE_MAX_BYTES = int(float(os.environ.get('SECUREAI_EXTRACTION_CACHE_MAX_MB', 500)) * 1024 * 1024)
+
+# Response cache limits: least-recently-used entries are evicted beyond these
+RESPONSE_CACHE_MAX_BYTES = int(float(os.environ.get('SECUREAI_RESPONSE_CACHE_MAX_MB', 200)) * 1024 * 1024)
+RESPONSE_CACHE_MAX_AGE_SECONDS = int(float(os.environ.get('SECUREAI_RESPONSE_CACHE_MAX_AGE_DAYS', 30)) * 86400)
+
+# Rendered PDFs kept in memory so reruns of the results page skip rendering;
+# bump PDF_RENDERER_VERSION whenever the PDF layout or styling changes
+PDF_CACHE_MAX_BYTES = int(float(os.environ.get('SECUREAI_PDF_CACHE_MAX_MB', 64)) * 1024 * 1024)
+PDF_RENDERER_VERSION = 3
+
+# PDF renders run in worker processes with a time and memory (address space)
+# limit; a WeasyPrint render that exceeds either falls back to ReportLab.
+# 0 workers renders in the server process, without limits.
+PDF_RENDER_WORKERS = int(os.environ.get('SECUREAI_PDF_RENDER_WORKERS', 2))
+PDF_RENDER_TIMEOUT_SECONDS = float(os.environ.get('SECUREAI_PDF_RENDER_TIMEOUT_SECONDS', 120))
+PDF_RENDER_MEMORY_BYTES = int(float(os.environ.get('SECUREAI_PDF_RENDER_MEMORY_MB', 2048)) * 1024 * 1024)
+
+# Reports converted to HTML, shared by the preview and the PDF exporters
+REPORT_HTML_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+
+def _process_resource(factory):
+    """Decorator for process-wide singletons shared by every session and rerun.
+
+    Streamlit re-executes this script in a fresh namespace on every rerun, so a
+    plain module global would be rebuilt each time; `st.cache_resource` keeps
+    one instance per server process. Outside a Streamlit server (tests,
+    batch_assess), where `st.cache_resource` does not memoize, it degrades to
+    a memo.
+    """
+    cache_resource = getattr(st, 'cache_resource', None)
+    if cache_resource is None or not _streamlit_runtime_exists():
+        return functools.lru_cache(maxsize=None)(factory)
+    return cache_resource(show_spinner=False)(factory)
+
+
+def _streamlit_runtime_exists():
+    try:
+        from streamlit import runtime
+        return runtime.exists()
+    except Exception:
+        return False
+
+
+class DiskLRUCache:
+    """SQLite-backed key/value store with size- and age-based LRU eviction.
+
+    Safe to share between threads and processes: every operation opens its own
+    short-lived connection and the database runs in WAL mode. Hit/miss counters
+    are kept per process.
+    """
+
+    def __init__(self, path, max_bytes, max_age_seconds):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " value BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+
+    def _connect(self):
+        return _sqlite_connection(sqlite3.connect(str(self.path), timeout=30))
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """Return the cached bytes for `key`, or None on a miss or expired entry."""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._count(False)
+                return None
+            value, created_at = row
+            if self.max_age_seconds and now - created_at > self.max_age_seconds:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._count(False)
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+        self._count(True)
+        return bytes(value)
+
+    def put(self, key, value):
+        """Store `value` (bytes) under `key` and evict old entries beyond the limits."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), len(value), now, now),
+            )
+            self._evict(conn, now)
+
+    def get_text(self, key):
+        value = self.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def put_text(self, key, text):
+        self.put(key, text.encode('utf-8'))
+
+    def _evict(self, conn, now):
+        if self.max_age_seconds:
+            conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.max_age_seconds,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least-recently-used entries until the store fits again
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries")
+
+    def stats(self):
+        """Return counters and current size of the store."""
+        with self._connect() as conn:
+            entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "entries": entries,
+            "bytes": total,
+        }
+
+
+@contextmanager
+def _sqlite_connection(conn):
+    """Commit (or roll back) and always close a sqlite3 connection."""
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+class MemoryLRUCache:
+    """Thread-safe in-memory LRU map bounded by the total size of its values.
+
+    A value's size is `sizeof(value)`, `len` by default.
+    """
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= self.sizeof(previous)
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self.sizeof(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+class TieredCache:
+    """A MemoryLRUCache in front of an optional DiskLRUCache; disk hits are promoted to memory."""
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            try:
+                value = self.disk.get(key)
+            except Exception:
+                value = None
+            if value is not None:
+                self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.put(key, value)
+            except Exception:
+                # The disk tier is best effort (full or read-only volume)
+                pass
+
+    def stats(self):
+        memory = self.memory.stats()
+        disk = self.disk.stats() if self.disk is not None else None
+        lookups = memory["hits"] + memory["misses"]
+        hits = memory["hits"] + (disk["hits"] if disk else 0)
+        return {
+            "memory_hits": memory["hits"],
+            "disk_hits": disk["hits"] if disk else 0,
+            "misses": lookups - hits,
+            "hit_rate": (hits / lookups) if lookups else 0.0,
+            "memory_entries": memory["entries"],
+            "memory_bytes": memory["bytes"],
+            "disk_entries": disk["entries"] if disk else 0,
+            "disk_bytes": disk["bytes"] if disk else 0,
+        }
+
+
+@_process_resource
+def _open_response_cache():
+    try:
+        return DiskLRUCache(
+            CACHE_DIR / "responses.sqlite3",
+            max_bytes=RESPONSE_CACHE_MAX_BYTES,
+            max_age_seconds=RESPONSE_CACHE_MAX_AGE_SECONDS,
+        )
+    except Exception:
+        # A read-only or missing cache directory must never block generation
+        return None
+
+
+_response_cache = _open_response_cache()
+
+
+def get_response_cache():
+    """Return the process-wide response cache, or None if it cannot be opened."""
+    return _response_cache
+
+
+class ApiCapabilityCache:
+    """Persisted map of API endpoint -> model name -> API surface ("messages" or "completions").
+
+    Recorded after the first successful call to a model, so later runs go
+    straight to the endpoint the model supports instead of first waiting for a
+    Completions API call to fail. Surfaces are kept per API_BASE_URL, since a
+    gateway may expose a different surface than the default endpoint. Stored as
+    JSON next to the response cache; if the file cannot be written the map is
+    kept in memory only.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._surfaces = None
+
+    @staticmethod
+    def _endpoint():
+        return API_BASE_URL or "default"
+
+    def _read(self):
+        try:
+            surfaces = json.loads(self.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(surfaces, dict):
+            return {}
+        # Maps written before surfaces were kept per endpoint are dropped and learned again
+        return {endpoint: models for endpoint, models in surfaces.items() if isinstance(models, dict)}
+
+    def _load(self):
+        if self._surfaces is None:
+            self._surfaces = self._read()
+        return self._surfaces.setdefault(self._endpoint(), {})
+
+    def get(self, model_name):
+        with self._lock:
+            return self._load().get(model_name)
+
+    def record(self, model_name, surface):
+        with self._lock:
+            if self._load().get(model_name) == surface:
+                return
+            # Merge with what other processes (e.g. batch_assess) wrote since the map was loaded
+            surfaces = self._read()
+            for endpoint, models in self._surfaces.items():
+                surfaces.setdefault(endpoint, {}).update(models)
+            surfaces.setdefault(self._endpoint(), {})[model_name] = surface
+            self._surfaces = surfaces
+            tmp_name = None
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.path.parent,
+                                                 prefix=self.path.name, suffix='.tmp', delete=False) as tmp:
+                    tmp_name = tmp.name
+                    json.dump(surfaces, tmp, indent=2, sort_keys=True)
+                os.replace(tmp_name, self.path)
+            except OSError:
+                if tmp_name:
+                    try:
+                        os.unlink(tmp_name)
+                    except OSError:
+                        pass
+
+    def clear(self):
+        with self._lock:
+            self._surfaces = {}
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+
+    def snapshot(self):
+        """Surfaces learned for the current API endpoint."""
+        with self._lock:
+            return dict(self._load())
+
+
+@_process_resource
+def _shared_api_capabilities():
+    return ApiCapabilityCache(CACHE_DIR / "api_capabilities.json")
+
+
+_api_capabilities = _shared_api_capabilities()
+
+
+# HTTP connection pool and timeouts shared by every session using the same API key
+HTTP_MAX_CONNECTIONS = int(os.environ.get('SECUREAI_HTTP_MAX_CONNECTIONS', 20))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('SECUREAI_HTTP_MAX_KEEPALIVE_CONNECTIONS', 10))
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.environ.get('SECUREAI_HTTP_KEEPALIVE_EXPIRY_SECONDS', 300))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('SECUREAI_HTTP_CONNECT_TIMEOUT_SECONDS', 10))
+HTTP_READ_TIMEOUT_SECONDS = float(os.environ.get('SECUREAI_HTTP_READ_TIMEOUT_SECONDS', 600))
+# Optional API endpoint override (e.g. a proxy or a local stub backend)
+API_BASE_URL = os.environ.get('SECUREAI_BASE_URL') or None
+# Number of distinct API keys whose clients are kept alive
+CLIENT_REGISTRY_SIZE = int(os.environ.get('SECUREAI_CLIENT_REGISTRY_SIZE', 16))
+
+
+class ClientRegistry:
+    """Process-wide registry of API clients keyed by a hash of the API key.
+
+    Clients (and their keep-alive HTTP connection pools) are reused across
+    Streamlit reruns and sessions. Each pooled client traces its requests so the
+    diagnostics can show how many requests were served over reused connections
+    versus new TCP connections and TLS handshakes.
+
+    A client evicted from the registry may still be in use by another session
+    or a background job, so its connection pool is closed only once the client
+    is garbage-collected.
+    """
+
+    def __init__(self, max_clients=CLIENT_REGISTRY_SIZE):
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.clients_created = 0
+        self.client_reuses = 0
+        self.requests = 0
+        self.tcp_connects = 0
+        self.tls_handshakes = 0
+
+    @staticmethod
+    def key_for(api_key):
+        return hashlib.sha256(f"{API_BASE_URL or ''}\0{api_key}".encode('utf-8')).hexdigest()
+
+    def get(self, api_key):
+        """Return the pooled client for `api_key`, creating it on first use."""
+        key = self.key_for(api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                self.client_reuses += 1
+                return client
+            client, http_client = self._build_client(api_key)
+            self._clients[key] = client
+            if http_client is not None:
+                # Closes the pool once no session or job holds the client any more
+                weakref.finalize(client, self._close, http_client)
+            self.clients_created += 1
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+            return client
+
+    def _build_client(self, api_key):
+        """Return (client, its httpx pool or None if the SDK default is used)."""
+        # Retries are owned by the request scheduler, which also honors the shared rate limits
+        kwargs = {"api_key": api_key, "max_retries": 0}
+        if API_BASE_URL:
+            kwargs["base_url"] = API_BASE_URL
+        try:
+            import httpx  # type: ignore
+        except Exception:
+            # Without httpx we cannot tune the pool; the SDK default client still keeps connections alive
+            return anthropic.Anthropic(**kwargs), None
+
+        timeout = httpx.Timeout(HTTP_READ_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS)
+        kwargs["timeout"] = timeout
+        kwargs["http_client"] = httpx.Client(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            event_hooks={"request": [self._trace_request]},
+        )
+        return anthropic.Anthropic(**kwargs), kwargs["http_client"]
+
+    def _trace_request(self, request):
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self._on_trace_event
+
+    def _on_trace_event(self, event_name, info):
+        # httpcore only emits these when it has to open a new connection
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.tcp_connects += 1
+        elif event_name == "connection.start_tls.complete":
+            with self._lock:
+                self.tls_handshakes += 1
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def clear(self):
+        with self._lock:
+            for client in self._clients.values():
+                self._close(client)
+            self._clients.clear()
+
+    def stats(self):
+        with self._lock:
+            reused = max(self.requests - self.tcp_connects, 0)
+            return {
+                "clients": len(self._clients),
+                "clients_created": self.clients_created,
+                "client_reuses": self.client_reuses,
+                "requests": self.requests,
+                "tcp_connects": self.tcp_connects,
+                "tls_handshakes": self.tls_handshakes,
+                "connection_reuse_rate": (reused / self.requests) if self.requests else 0.0,
+            }
+
+
+@_process_resource
+def _shared_client_registry():
+    return ClientRegistry()
+
+
+_client_registry = _shared_client_registry()
+
+
+def get_anthropic_client(api_key):
+    """Return the process-wide pooled API client for `api_key`."""
+    return _client_registry.get(api_key)
+
+
+# Retry policy for model calls (exponential backoff with full jitter)
+API_MAX_RETRIES = int(os.environ.get('SECUREAI_API_MAX_RETRIES', 4))
+API_BACKOFF_BASE_SECONDS = float(os.environ.get('SECUREAI_API_BACKOFF_BASE_SECONDS', 2))
+API_BACKOFF_MAX_SECONDS = float(os.environ.get('SECUREAI_API_BACKOFF_MAX_SECONDS', 60))
+# Organization quotas shared by all sessions in this process (0 disables the limit)
+API_REQUESTS_PER_MINUTE = float(os.environ.get('SECUREAI_API_REQUESTS_PER_MINUTE', 50))
+API_INPUT_TOKENS_PER_MINUTE = float(os.environ.get('SECUREAI_API_INPUT_TOKENS_PER_MINUTE', 400000))
+# Fail fast for this long after this many consecutive calls failed on overload or network errors
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get('SECUREAI_CIRCUIT_BREAKER_FAILURES', 3))
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.environ.get('SECUREAI_CIRCUIT_BREAKER_RESET_SECONDS', 60))
+# Rate limited, conflict, timeout, server error and overloaded responses are worth retrying
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504, 529})
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the API while the circuit breaker is open."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `per_minute` units per minute.
+
+    `reserve` takes the units immediately, letting the bucket go into debt, and
+    returns how long the caller must wait; concurrent callers therefore queue up
+    in arrival order instead of polling.
+    """
+
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        """Take `amount` units and return the seconds to wait before using them."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # A single request larger than the whole quota waits for a full bucket, not forever
+            self._tokens -= min(float(amount), self.capacity)
+            return max(0.0, -self._tokens / self.rate)
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failed calls; lets a trial call through after `reset_seconds`.
+
+    Only one trial call runs at a time: other callers are rejected until the
+    trial succeeds, fails or is ended without an outcome (`end_trial`).
+    """
+
+    def __init__(self, failure_threshold, reset_seconds, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._trial = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "open" if self._clock() - self._opened_at < self.reset_seconds else "half-open"
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call may not proceed; return a token if it is the half-open trial."""
+        with self._lock:
+            if self._opened_at is None:
+                return None
+            remaining = self.reset_seconds - (self._clock() - self._opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(
+                    f"SecureAI API unavailable after {self._failures} consecutive failures; "
+                    f"retrying allowed in {remaining:.0f}s"
+                )
+            if self._trial is not None:
+                raise CircuitOpenError(
+                    f"SecureAI API unavailable after {self._failures} consecutive failures; "
+                    f"a trial request is in progress"
+                )
+            self._trial = object()
+            return self._trial
+
+    def end_trial(self, trial):
+        """Let another trial through if `trial` ended without a recorded outcome."""
+        with self._lock:
+            if self._trial is trial:
+                self._trial = None
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold or self._opened_at is not None:
+                # Also re-opens after a failed half-open trial
+                self._opened_at = self._clock()
+                self._trial = None
+
+
+def _error_status(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+
+def _is_retryable(error):
+    if _error_status(error) in RETRYABLE_STATUS_CODES:
+        return True
+    connection_errors = tuple(
+        cls for cls in (getattr(anthropic, 'APIConnectionError', None), getattr(anthropic, 'APITimeoutError', None)) if cls
+    )
+    if connection_errors and isinstance(error, connection_errors):
+        return True
+    # Overload errors delivered mid-stream arrive as an error event rather than a status code
+    return 'overloaded' in str(error).lower()
+
+
+def _retry_after_seconds(error):
+    """Delay requested by the server's retry-after(-ms) header, if any."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        value = headers.get('retry-after-ms')
+        if value is not None:
+            return max(0.0, float(value) / 1000)
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class RequestScheduler:
+    """Runs model calls under the shared rate limits with retries and a circuit breaker.
+
+    Each call reserves one request and its estimated input tokens from
+    process-wide token buckets, waiting if the quota is used up. Retryable
+    failures (see RETRYABLE_STATUS_CODES) are retried with exponential backoff
+    and full jitter, or after the server's retry-after delay when given.
+    Per-attempt latency and outcome are kept for the diagnostics panel.
+    """
+
+    def __init__(self, max_retries=API_MAX_RETRIES, backoff_base=API_BACKOFF_BASE_SECONDS,
+                 backoff_max=API_BACKOFF_MAX_SECONDS, requests_per_minute=API_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=API_INPUT_TOKENS_PER_MINUTE, breaker=None, sleep=time.sleep):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.breaker = breaker or CircuitBreaker(CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET_SECONDS)
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.attempts = deque(maxlen=500)
+        self.retries = 0
+        self.throttled_seconds = 0.0
+
+    def backoff_delay(self, attempt, error):
+        retry_after = _retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def call(self, send, estimated_tokens=0, can_retry=None):
+        """Return `send()`, retrying retryable failures while `can_retry()` (if given) allows it."""
+        trial = self.breaker.before_call()
+        try:
+            return self._call(send, estimated_tokens, can_retry)
+        finally:
+            if trial is not None:
+                # No-op once the trial recorded a success or failure
+                self.breaker.end_trial(trial)
+
+    def _call(self, send, estimated_tokens, can_retry):
+        attempt = 0
+        while True:
+            attempt += 1
+            wait = max(self.request_bucket.reserve(1), self.token_bucket.reserve(estimated_tokens))
+            if wait > 0:
+                with self._lock:
+                    self.throttled_seconds += wait
+                self._sleep(wait)
+            started = time.monotonic()
+            try:
+                result = send()
+            except Exception as e:
+                retryable = _is_retryable(e)
+                retry = retryable and attempt <= self.max_retries and (can_retry is None or can_retry())
+                self._record(attempt, started, "retry" if retry else "error", _error_status(e))
+                if not retry:
+                    if retryable:
+                        self.breaker.record_failure()
+                    raise
+                with self._lock:
+                    self.retries += 1
+                self._sleep(self.backoff_delay(attempt, e))
+                continue
+            self._record(attempt, started, "ok", None)
+            self.breaker.record_success()
+            return result
+
+    def _record(self, attempt, started, outcome, status):
+        with self._lock:
+            self.attempts.append({
+                "attempt": attempt,
+                "seconds": round(time.monotonic() - started, 3),
+                "outcome": outcome,
+                "status": status,
+            })
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(a["seconds"] for a in self.attempts)
+            outcomes = [a["outcome"] for a in self.attempts]
+            throttled = self.throttled_seconds
+            retries = self.retries
+
+        def percentile(q):
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+
+        return {
+            "attempts": len(outcomes),
+            "retries": retries,
+            "errors": outcomes.count("error"),
+            "p50_seconds": percentile(0.5),
+            "p95_seconds": percentile(0.95),
+            "throttled_seconds": round(throttled, 1),
+            "circuit": self.breaker.state,
+        }
+
+
+@_process_resource
+def _shared_request_scheduler():
+    return RequestScheduler()
+
+
+_request_scheduler = _shared_request_scheduler()
+
+
+def response_cache_key(final_prompt, model_name, images=None):
+    """Content address for a generated report: SHA-256 of the model, the fully rendered prompt and any images."""
+    digest = hashlib.sha256()
+    digest.update(model_name.encode('utf-8'))
+    digest.update(b"\0")
+    digest.update(final_prompt.encode('utf-8'))
+    for image in images or []:
+        digest.update(b"\0" + image['name'].encode('utf-8') + b"\0")
+        digest.update(image['data'])
+    return digest.hexdigest()
+
+# Worker processes for document extraction (PDF page ranges and DOCX files run in parallel)
+EXTRACTION_WORKERS = int(os.environ.get('SECUREAI_EXTRACTION_WORKERS', os.cpu_count() or 2))
+# A file or image whose extraction runs longer is reported as unreadable and its worker is killed
+EXTRACTION_TIMEOUT_SECONDS = float(os.environ.get('SECUREAI_EXTRACTION_TIMEOUT_SECONDS', 300))
+
+
+@_process_resource
+def _shared_extraction_pool():
+    return extractors.create_process_pool(EXTRACTION_WORKERS)
+
+
+@_process_resource
+def _open_extraction_cache():
+    try:
+        disk = DiskLRUCache(
+            CACHE_DIR / "extractions.sqlite3",
+            max_bytes=EXTRACTION_CACHE_MAX_BYTES,
+            max_age_seconds=RESPONSE_CACHE_MAX_AGE_SECONDS,
+        )
+    except Exception:
+        # Without a writable cache directory extractions are still shared in memory
+        disk = None
+    return TieredCache(MemoryLRUCache(EXTRACTION_CACHE_MEMORY_BYTES), disk)
+
+
+_extraction_cache = _open_extraction_cache()
+
+
+# Uploads are hashed and spooled to disk in chunks of this size
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Memory ceilings: uploads held by a session plus the working memory of its
+# extractions, and the same summed over all sessions of this server process
+SESSION_MEMORY_LIMIT_BYTES = int(float(os.environ.get('SECUREAI_SESSION_MEMORY_MB', 1024)) * 1024 * 1024)
+SERVER_MEMORY_LIMIT_BYTES = int(float(os.environ.get('SECUREAI_SERVER_MEMORY_MB', 4096)) * 1024 * 1024)
+# Sessions not seen for this long no longer count towards the server total
+MEMORY_SESSION_IDLE_SECONDS = 3600
+# Peak working memory per input byte while a file is parsed (parsed object trees, page buffers)
+EXTRACTION_MEMORY_FACTORS = {'.pdf': 3, '.docx': 8, '.yaml': 15, '.yml': 15, '.json': 10, '.txt': 3, '.md': 3}
+# Zip bomb limits for uploaded archives: files listed, bytes unpacked and compression ratio
+ARCHIVE_MAX_FILES = int(os.environ.get('SECUREAI_ARCHIVE_MAX_FILES', 2000))
+ARCHIVE_MAX_BYTES = int(float(os.environ.get('SECUREAI_ARCHIVE_MAX_MB', 512)) * 1024 * 1024)
+ARCHIVE_MAX_RATIO = int(os.environ.get('SECUREAI_ARCHIVE_MAX_RATIO', 100))
+# Unpacked archives kept on disk for reruns and other sessions
+ARCHIVE_CACHE_ENTRIES = int(os.environ.get('SECUREAI_ARCHIVE_CACHE_ENTRIES', 8))
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    """Raised instead of starting work that would exceed a session or server memory ceiling."""
+
+
+class MemoryAccountant:
+    """Per-session accounting of upload and extraction memory against configured ceilings.
+
+    A session's usage is its resident uploads (held by the file uploader,
+    reported with `set_resident`) plus reservations for work in progress
+    (`reserve`). Idle sessions are forgotten after `idle_seconds`.
+    """
+
+    def __init__(self, session_limit, server_limit, idle_seconds=MEMORY_SESSION_IDLE_SECONDS, clock=time.monotonic):
+        self.session_limit = session_limit
+        self.server_limit = server_limit
+        self.idle_seconds = idle_seconds
+        self.rejected = 0
+        self._clock = clock
+        self._resident = {}  # session id -> (bytes, last seen)
+        self._reserved = {}  # session id -> bytes
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        for session_id, (_, seen) in list(self._resident.items()):
+            if now - seen > self.idle_seconds and not self._reserved.get(session_id):
+                del self._resident[session_id]
+
+    def _usage(self, session_id):
+        return self._resident.get(session_id, (0, 0))[0] + self._reserved.get(session_id, 0)
+
+    def set_resident(self, session_id, nbytes):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            self._resident[session_id] = (nbytes, now)
+
+    @contextmanager
+    def reserve(self, session_id, nbytes, what):
+        """Hold `nbytes` for `session_id` while the block runs, or raise MemoryBudgetExceeded."""
+        with self._lock:
+            self._expire(self._clock())
+            session_total = self._usage(session_id) + nbytes
+            server_total = sum(self._usage(s) for s in set(self._resident) | set(self._reserved)) + nbytes
+            if session_total > self.session_limit:
+                self.rejected += 1
+                raise MemoryBudgetExceeded(
+                    f"{what} needs about {nbytes / 1024 / 1024:.0f} MB of memory; with the files already uploaded "
+                    f"this session would use {session_total / 1024 / 1024:.0f} MB "
+                    f"(limit {self.session_limit / 1024 / 1024:.0f} MB). Upload fewer or smaller files."
+                )
+            if server_total > self.server_limit:
+                self.rejected += 1
+                raise MemoryBudgetExceeded(
+                    f"The server is busy processing other uploads ({what.lower()} needs about "
+                    f"{nbytes / 1024 / 1024:.0f} MB). Please try again in a moment."
+                )
+            self._reserved[session_id] = self._reserved.get(session_id, 0) + nbytes
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._reserved[session_id] -= nbytes
+                if not self._reserved[session_id]:
+                    del self._reserved[session_id]
+
+    def stats(self, session_id=None):
+        with self._lock:
+            self._expire(self._clock())
+            sessions = set(self._resident) | set(self._reserved)
+            return {
+                "session_bytes": self._usage(session_id) if session_id is not None else 0,
+                "server_bytes": sum(self._usage(s) for s in sessions),
+                "sessions": len(sessions),
+                "rejected": self.rejected,
+            }
+
+
+@_process_resource
+def _shared_memory_accountant():
+    return MemoryAccountant(SESSION_MEMORY_LIMIT_BYTES, SERVER_MEMORY_LIMIT_BYTES)
+
+
+_memory_accountant = _shared_memory_accountant()
+
+
+def _session_id():
+    """ID of the current browser session ("default" outside a Streamlit script run)."""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            return ctx.session_id
+    except Exception:
+        pass
+    return "default"
+
+
+def _upload_chunks(upload):
+    """Yield an upload's content in UPLOAD_CHUNK_BYTES pieces without copying the whole buffer.
+
+    Files on disk (batch runs) are read from their path; Streamlit uploads are
+    read through a zero-copy view of their buffer.
+    """
+    path = getattr(upload, 'path', None)
+    if path is not None:
+        with open(path, 'rb') as fh:
+            yield from iter(lambda: fh.read(UPLOAD_CHUNK_BYTES), b"")
+        return
+    if hasattr(upload, 'getbuffer'):
+        with upload.getbuffer() as view:
+            for start in range(0, len(view), UPLOAD_CHUNK_BYTES):
+                yield bytes(view[start:start + UPLOAD_CHUNK_BYTES])
+        return
+    data = upload.getvalue()
+    for start in range(0, len(data), UPLOAD_CHUNK_BYTES):
+        yield data[start:start + UPLOAD_CHUNK_BYTES]
+
+
+@_process_resource
+def _shared_upload_digests():
+    return MemoryLRUCache(1024 * 1024)
+
+
+_upload_digests = _shared_upload_digests()
+
+
+def upload_digest(upload):
+    """SHA-256 (hex) of an upload's content, memoized per Streamlit file id across reruns.
+
+    Archive members carry the digest computed while they were unpacked.
+    """
+    if getattr(upload, 'digest', None):
+        return upload.digest
+    file_id = getattr(upload, 'file_id', None)
+    if file_id:
+        known = _upload_digests.get(file_id)
+        if known is not None:
+            return known
+    digest = hashlib.sha256()
+    for chunk in _upload_chunks(upload):
+        digest.update(chunk)
+    if file_id:
+        _upload_digests.put(file_id, digest.hexdigest())
+    return digest.hexdigest()
+
+
+class UploadSpool:
+    """Temporary directory that uploads are copied to, chunk by chunk, for the extraction workers.
+
+    Files already on disk are used in place. The directory is removed on exit.
+    """
+
+    def __init__(self):
+        self._dir = None
+        self._paths = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._dir is not None:
+            self._dir.cleanup()
+
+    def path(self, index, upload):
+        if getattr(upload, 'path', None) is not None:
+            return str(upload.path)
+        if index not in self._paths:
+            if self._dir is None:
+                self._dir = tempfile.TemporaryDirectory(prefix="threat-modeling-upload-")
+            path = os.path.join(self._dir.name, f"{index}{Path(upload.name).suffix.lower()}")
+            with open(path, 'wb') as fh:
+                for chunk in _upload_chunks(upload):
+                    fh.write(chunk)
+            self._paths[index] = path
+        return self._paths[index]
+
+
+class ArchiveStore:
+    """Uploaded archives unpacked to disk, keyed by archive content digest.
+
+    Streamlit reruns the script on every interaction; the store lets reruns and
+    other sessions reuse an unpacked archive instead of decompressing it again.
+    The least recently used archives beyond `max_entries` are dropped from the
+    store; another session or a background job may still be reading their
+    members, so each directory is deleted only once none of its members is in
+    use any more.
+    """
+
+    def __init__(self, max_entries=ARCHIVE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def expand(self, upload, progress=None):
+        """(members, report) for an archive upload; see `archives.expand_archive`.
+
+        Raises archives.ArchiveLimitExceeded, or the archive's read error, with
+        nothing kept on disk.
+        """
+        key = upload_digest(upload)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][1:]
+        directory = tempfile.TemporaryDirectory(prefix="threat-modeling-archive-")
+        source = getattr(upload, 'path', None) or upload
+        try:
+            members, report = archives.expand_archive(
+                source, upload.name, directory.name, extractors.SUPPORTED_EXTENSIONS,
+                ARCHIVE_MAX_FILES, ARCHIVE_MAX_BYTES, ARCHIVE_MAX_RATIO, chunk_bytes=UPLOAD_CHUNK_BYTES,
+                progress=progress,
+            )
+        except Exception:
+            directory.cleanup()
+            raise
+        finally:
+            if hasattr(upload, 'seek'):
+                upload.seek(0)
+        with self._lock:
+            if key in self._entries:
+                # Another session unpacked the same archive meanwhile
+                directory.cleanup()
+                return self._entries[key][1:]
+            self._entries[key] = (directory, members, report)
+            while len(self._entries) > self.max_entries:
+                self._release(*self._entries.popitem(last=False)[1][:2])
+        return members, report
+
+    @staticmethod
+    def _release(directory, members):
+        """Delete `directory` once every member in `members` has been garbage-collected."""
+        if not members:
+            directory.cleanup()
+            return
+        remaining = [len(members)]
+        lock = threading.Lock()
+
+        def member_collected():
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            directory.cleanup()
+
+        for member in members:
+            weakref.finalize(member, member_collected)
+
+
+@_process_resource
+def _shared_archive_store():
+    return ArchiveStore()
+
+
+_archive_store = _shared_archive_store()
+
+
+def expand_uploaded_archives(uploaded_files, progress=None):
+    """Replace archive uploads by their supported files; return (files, archive reports).
+
+    Archives are unpacked through `_archive_store` (see `archives.expand_archive`
+    for the limits and what is skipped). Members with the same content as an
+    upload or an earlier member are dropped and marked "duplicate" in their
+    archive's report. A report with an `error` stands for an archive that could
+    not be unpacked and contributes no files. `progress(archive name, files
+    seen, member name)` is called per member while an archive is unpacked.
+    """
+    if not any(archives.is_archive(upload.name) for upload in uploaded_files):
+        return list(uploaded_files), []
+    files = []
+    reports = []
+    # Content digest -> name of the first file with that content; uploads take precedence over members
+    first_with_digest = {}
+    for upload in uploaded_files:
+        if not archives.is_archive(upload.name):
+            first_with_digest.setdefault(upload_digest(upload), upload.name)
+    for upload in uploaded_files:
+        if not archives.is_archive(upload.name):
+            files.append(upload)
+            continue
+        try:
+            members, report = _archive_store.expand(
+                upload, progress=(lambda seen, member, name=upload.name: progress(name, seen, member)) if progress else None,
+            )
+        except Exception as e:
+            reports.append({"archive": upload.name, "entries": [], "files": 0, "bytes": 0, "seconds": 0.0, "error": str(e)})
+            continue
+        duplicates = {}
+        for member in members:
+            if member.digest in first_with_digest:
+                duplicates[member.name] = first_with_digest[member.digest]
+            else:
+                first_with_digest[member.digest] = member.name
+                files.append(member)
+        entries = [
+            dict(entry, status="duplicate", detail=f"same content as {duplicates[entry['name']]}")
+            if entry['name'] in duplicates else entry
+            for entry in report['entries']
+        ]
+        reports.append(dict(report, entries=entries, files=report['files'] - len(duplicates)))
+    return files, reports
+
+
+def _image_pixels(upload):
+    """Pixel count from the image header (nothing is decoded), or None."""
+    try:
+        from PIL import Image
+
+        with Image.open(getattr(upload, 'path', None) or upload) as image:
+            return image.size[0] * image.size[1]
+    except Exception:
+        return None
+    finally:
+        if hasattr(upload, 'seek'):
+            upload.seek(0)
+
+
+def working_memory_estimate(upload):
+    """Approximate peak memory (bytes) for extracting or preparing one upload."""
+    extension = Path(upload.name).suffix.lower()
+    size = getattr(upload, 'size', None) or 0
+    if extension in extractors.IMAGE_EXTENSIONS:
+        pixels = _image_pixels(upload)
+        # The decoded RGBA frame plus the resized copy
+        return pixels * 8 if pixels else size * 10
+    return size * EXTRACTION_MEMORY_FACTORS.get(extension, 1)
+
+
+def extraction_cache_key(name, content_digest):
+    """SHA-256 of the file content digest, its extension and the extractor version."""
+    digest = hashlib.sha256()
+    digest.update(f"{extractors.EXTRACTOR_VERSION}\0{Path(name).suffix.lower()}\0{content_digest}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def extract_uploaded_files(uploaded_files, session_id=None):
+    """Extract text from all uploads at once; return [(text, info)] in upload order.
+
+    Results are memoized by content hash (see `extraction_cache_key`) in a
+    process-wide memory LRU backed by an on-disk store, so the same document
+    is parsed once across reruns, sessions and restarts. The remaining files
+    are spooled to temporary files in chunks (see `UploadSpool`) and parsed
+    concurrently in the extraction process pool, with large PDFs split by page
+    range (see `extractors.extract_files`). Their estimated working memory is
+    reserved for the session first; MemoryBudgetExceeded is raised instead of
+    starting work over the ceiling.
+
+    `info` carries page, paragraph and table counts, extraction time, whether
+    it came from the cache and any error, for the upload summary.
+    """
+    results = [None] * len(uploaded_files)
+    pending = OrderedDict()  # cache key -> indexes of uploads with that content
+    for index, upload in enumerate(uploaded_files):
+        key = extraction_cache_key(upload.name, upload_digest(upload))
+        cached = _extraction_cache.get(key) if key not in pending else None
+        if cached is not None:
+            entry = json.loads(zlib.decompress(cached))
+            results[index] = (entry["text"], dict(entry["info"], name=upload.name, cached=True))
+        else:
+            pending.setdefault(key, []).append(index)
+
+    if pending:
+        first = [indexes[0] for indexes in pending.values()]
+        needed = sum(working_memory_estimate(uploaded_files[i]) for i in first)
+        with _memory_accountant.reserve(session_id or _session_id(), needed, "Extracting the uploads"), \
+                UploadSpool() as spool:
+            extracted = extractors.extract_files(
+                [
+                    # Images only get a placeholder here; `prepare_uploaded_images` reads them
+                    (uploaded_files[i].name, None if Path(uploaded_files[i].name).suffix.lower()
+                     in extractors.IMAGE_EXTENSIONS else spool.path(i, uploaded_files[i]))
+                    for i in first
+                ],
+                pool=_shared_extraction_pool(), timeout=EXTRACTION_TIMEOUT_SECONDS,
+            )
+        for (key, indexes), (text, info) in zip(pending.items(), extracted):
+            if not info["error"]:
+                _extraction_cache.put(key, zlib.compress(json.dumps({"text": text, "info": info}).encode('utf-8')))
+            for index in indexes:
+                results[index] = (text, dict(info, name=uploaded_files[index].name, cached=False))
+    return results
+
+
+# Images are downscaled to this longest edge (the size vision models work at) and re-encoded
+IMAGE_MAX_EDGE = int(os.environ.get('SECUREAI_IMAGE_MAX_EDGE', 1568))
+IMAGE_QUALITY = int(os.environ.get('SECUREAI_IMAGE_QUALITY', 80))
+# Total encoded image bytes per request; above it images are shrunk, down to IMAGE_MIN_EDGE
+IMAGE_BUDGET_BYTES = int(float(os.environ.get('SECUREAI_IMAGE_BUDGET_MB', 4)) * 1024 * 1024)
+IMAGE_MIN_EDGE = 512
+
+
+def image_tokens(width, height):
+    """Approximate input tokens of an image content block (about one token per 750 pixels)."""
+    return -(-width * height // 750)
+
+
+def _prepare_images_cached(images, spool, session_id):
+    """`extractors.prepare_images` for (upload index, upload, max edge or None), memoized in the extraction cache.
+
+    Cache misses are spooled and their working memory reserved first.
+    """
+    results = [None] * len(images)
+    keys = []
+    misses = []
+    for index, (_, upload, edge) in enumerate(images):
+        keys.append(hashlib.sha256(
+            f"image\0{extractors.EXTRACTOR_VERSION}\0{edge or IMAGE_MAX_EDGE}\0{IMAGE_QUALITY}\0"
+            f"{upload_digest(upload)}".encode('utf-8')
+        ).hexdigest())
+        cached = _extraction_cache.get(keys[-1])
+        if cached is not None:
+            header, _, encoded = cached.partition(b"\n")
+            media_type, info = json.loads(header)
+            results[index] = (encoded, media_type, dict(info, name=upload.name, cached=True))
+        else:
+            misses.append(index)
+    if misses:
+        needed = sum(working_memory_estimate(images[i][1]) for i in misses)
+        with _memory_accountant.reserve(session_id, needed, "Preparing the images"):
+            prepared = extractors.prepare_images(
+                [(images[i][1].name, spool.path(images[i][0], images[i][1]), images[i][2]) for i in misses],
+                IMAGE_MAX_EDGE, IMAGE_QUALITY, pool=_shared_extraction_pool(), timeout=EXTRACTION_TIMEOUT_SECONDS,
+            )
+        for index, (encoded, media_type, info) in zip(misses, prepared):
+            if encoded is not None:
+                _extraction_cache.put(keys[index], json.dumps([media_type, info]).encode('utf-8') + b"\n" + encoded)
+            results[index] = (encoded, media_type, dict(info, cached=False))
+    return results
+
+
+def prepare_uploaded_images(uploaded_files, session_id=None):
+    """Prepare the image uploads for image content blocks; return (images, infos).
+
+    Every image is downscaled to IMAGE_MAX_EDGE, re-encoded without metadata
+    (see `extractors.prepare_image`) and processed concurrently in the
+    extraction pool, reading a spooled copy of the upload. If the results
+    exceed IMAGE_BUDGET_BYTES together, they are shrunk once more in
+    proportion to the overshoot (not below IMAGE_MIN_EDGE) and, if still over,
+    the largest are left out. Raises MemoryBudgetExceeded like
+    `extract_uploaded_files`.
+
+    `images` holds {"name", "media_type", "data", "width", "height"} for each
+    image to send. `infos` is aligned with `uploaded_files` (None for other
+    files) and holds the sizes before and after, the estimated tokens and
+    whether the image was shrunk for the budget, left out or failed.
+    """
+    session_id = session_id or _session_id()
+    indexes = [i for i, f in enumerate(uploaded_files) if Path(f.name).suffix.lower() in extractors.IMAGE_EXTENSIONS]
+    uploads = [(i, uploaded_files[i]) for i in indexes]
+    with UploadSpool() as spool:
+        results = _prepare_images_cached([(i, upload, None) for i, upload in uploads], spool, session_id)
+        total = sum(info['bytes'] for encoded, _, info in results if encoded is not None)
+        if total > IMAGE_BUDGET_BYTES:
+            # Encoded size grows roughly with pixel count, i.e. with the square of the edge
+            scale = math.sqrt(IMAGE_BUDGET_BYTES / total) * 0.9
+            shrink = [
+                (i, max(IMAGE_MIN_EDGE, int(max(info['width'], info['height']) * scale)))
+                for i, (encoded, _, info) in enumerate(results)
+                if encoded is not None and max(info['width'], info['height']) > IMAGE_MIN_EDGE
+            ]
+            smaller = _prepare_images_cached([(*uploads[i], edge) for i, edge in shrink], spool, session_id)
+            for (i, _), result in zip(shrink, smaller):
+                if result[0] is not None:
+                    results[i] = (result[0], result[1], dict(result[2], budget_scaled=True))
+    total = sum(info['bytes'] for encoded, _, info in results if encoded is not None)
+    for i in sorted(range(len(results)), key=lambda i: -(results[i][2].get('bytes') or 0)):
+        if total <= IMAGE_BUDGET_BYTES:
+            break
+        encoded, _, info = results[i]
+        if encoded is not None:
+            total -= info['bytes']
+            results[i] = (None, None, dict(info, dropped=True, error="left out: over the image size budget"))
+
+    images = []
+    infos = [None] * len(uploaded_files)
+    for (upload_index, upload), (encoded, media_type, info) in zip(uploads, results):
+        name = upload.name
+        if encoded is not None:
+            info = dict(info, tokens=image_tokens(info['width'], info['height']))
+            images.append({
+                "name": name, "media_type": media_type, "data": encoded,
+                "width": info['width'], "height": info['height'],
+            })
+        infos[upload_index] = info
+    return images, infos
+
+
 def extract_text_from_file(uploaded_file):
     """Extract text content from uploaded files"""
     try:
-        file_extension = Path(uploaded_file.name).suffix.lower()
-        
-        if file_extension in ['.txt', '.md']:
-            return uploaded_file.getvalue().decode('utf-8')
-        elif file_extension == '.pdf':
-            # For PDF, we'll just note the filename and ask Claude to understand it's a PDF
-            return f"[PDF Document: {uploaded_file.name}]"
-        else:
-            return f"[{file_extension.upper()} Document: {uploaded_file.name}]"
+        text, _ = extract_uploaded_files([uploaded_file])[0]
+        return text
     except Exception as e:
         return f"[Error reading {uploaded_file.name}: {str(e)}]"
 
+def assemble_documents(documents):
+    """Join (file name, text) pairs into the UPLOADED DOCUMENTATION block of the prompt."""
+    return "".join(f"\n\n### {name}\n{text}" for name, text in documents)
+
+
+def estimate_tokens(text):
+    """Approximate input-token count of `text` (CHARS_PER_TOKEN characters per token)."""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+# Generic security vocabulary used to rank documents and paragraphs; the selected
+# risk areas' threat descriptions are added per assessment
+SECURITY_TERMS = frozenset("""
+    access admin agent api attack audit auth authentication authorization boundary certificate
+    cloud container cookie credential credentials data database encrypt encryption endpoint
+    firewall gateway iam identity injection input internet jwt key keys kubernetes llm log logging
+    mfa model network oauth password permission permissions pii pipeline privilege prompt public
+    queue risk role roles saml secret secrets session sso storage threat tls token tokens trust
+    upload user users validation vpc vulnerability
+""".split())
+
+_WORD = re.compile(r'[a-z0-9]+')
+_PAGE_MARKER = re.compile(r'^\s*(?:page\s+)?\d+(?:\s*(?:/|of)\s*\d+)?\s*$', re.IGNORECASE)
+_SEPARATOR_LINE = re.compile(r'^\s*([-=_*.~])\1{3,}\s*$')
+
+
+def _paragraphs(text):
+    return [p.strip('\n') for p in re.split(r'\n[ \t]*\n', text) if p.strip()]
+
+
+def _strip_boilerplate(text):
+    """Collapse runs of blanks and blank lines; drop page-number and separator lines.
+
+    Leading indentation is kept so YAML, JSON and code blocks stay readable.
+    """
+    lines = []
+    for line in text.splitlines():
+        body = line.lstrip()
+        if _PAGE_MARKER.match(body) or _SEPARATOR_LINE.match(body):
+            continue
+        lines.append(line[:len(line) - len(body)] + re.sub(r'[ \t\u00a0]{2,}', ' ', body).rstrip())
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip('\n')
+
+
+def _dedupe_paragraphs(documents):
+    """Drop paragraphs already seen earlier in any document; return (documents, removed count)."""
+    seen = set()
+    removed = 0
+    result = []
+    for name, text in documents:
+        kept = []
+        for paragraph in _paragraphs(text):
+            key = ' '.join(paragraph.lower().split())
+            if len(key) >= DEDUP_MIN_PARAGRAPH_CHARS:
+                if key in seen:
+                    removed += 1
+                    continue
+                seen.add(key)
+            kept.append(paragraph)
+        result.append((name, '\n\n'.join(kept)))
+    return result, removed
+
+
+def _relevance_terms(risk_areas):
+    terms = set(SECURITY_TERMS)
+    for area in risk_areas:
+        for threat in RISK_AREAS.get(area, {}).get('threats', []):
+            terms.update(w for w in _WORD.findall(threat.lower()) if len(w) > 4)
+    return terms
+
+
+def _relevance(text, terms):
+    """Share of words in `text` that are security terms (0.0-1.0)."""
+    words = _WORD.findall(text.lower())
+    if not words:
+        return 0.0
+    return sum(1 for w in words if w in terms) / len(words)
+
+
+def _allocate_caps(sizes, weights, budget):
+    """Split `budget` tokens across documents in proportion to `weights`.
+
+    Documents smaller than their share keep everything and their unused share is
+    redistributed among the rest (water-filling).
+    """
+    caps = list(sizes)
+    pending = set(range(len(sizes)))
+    remaining = budget
+    while pending:
+        total_weight = sum(weights[i] for i in pending)
+        fitting = [i for i in pending if sizes[i] <= remaining * weights[i] / total_weight]
+        if not fitting:
+            for i in pending:
+                caps[i] = int(remaining * weights[i] / total_weight)
+            break
+        for i in fitting:
+            remaining -= sizes[i]
+            pending.discard(i)
+    return caps
+
+
+def _truncate_to_tokens(text, cap, terms):
+    """Keep the most relevant paragraphs of `text` within `cap` tokens, in their original order."""
+    paragraphs = _paragraphs(text)
+    # Leave room for the omission note
+    room = cap - 20
+    ranked = sorted(range(len(paragraphs)), key=lambda i: (-_relevance(paragraphs[i], terms), i))
+    keep = set()
+    for i in ranked:
+        cost = estimate_tokens(paragraphs[i]) + 1
+        if cost <= room:
+            keep.add(i)
+            room -= cost
+    if not keep and paragraphs and room > 0:
+        # A single oversized paragraph (e.g. minified JSON): keep its beginning
+        return paragraphs[0][:room * CHARS_PER_TOKEN] + "\n\n[Truncated to fit the prompt budget]"
+    omitted = len(paragraphs) - len(keep)
+    kept_text = '\n\n'.join(paragraphs[i] for i in sorted(keep))
+    if omitted:
+        kept_text += f"\n\n[{omitted} of {len(paragraphs)} paragraphs omitted to fit the prompt budget]"
+    return kept_text
+
+
+_STOPWORDS = frozenset("""
+    and are but for from has have into its not of on or that the their this to was were which with
+    by as at be can all any may our out per via
+""".split())
+_PDF_PAGE_LINE = re.compile(r'^\[Page (\d+)\]$')
+
+
+def _index_terms(text):
+    """Lower-case words with stopwords dropped and a plural "s" stripped, for BM25."""
+    terms = []
+    for word in _WORD.findall(text.lower()):
+        if len(word) < 3 or word in _STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+def _chunk_document(text, chunk_tokens):
+    """Split extracted text into [(section, chunk text)] of at most about `chunk_tokens`.
+
+    Sections start at "[Page N]" markers (PDF) and markdown headings (Markdown,
+    DOCX); consecutive paragraphs of one section are packed into a chunk.
+    """
+    max_chars = max(1, chunk_tokens) * CHARS_PER_TOKEN
+    chunks = []
+    section = ""
+    buffer = []
+
+    def flush():
+        if buffer:
+            chunks.append((section, '\n\n'.join(buffer)))
+            buffer.clear()
+
+    for paragraph in _paragraphs(text):
+        first, _, rest = paragraph.partition('\n')
+        page = _PDF_PAGE_LINE.match(first.strip())
+        if page:
+            flush()
+            section = f"Page {page.group(1)}"
+            paragraph = rest.strip('\n')
+            if not paragraph.strip():
+                continue
+        elif first.startswith('#') and first.lstrip('#').strip():
+            flush()
+            section = first.lstrip('#').strip()
+        if buffer and sum(len(p) for p in buffer) + len(paragraph) > max_chars:
+            flush()
+        while len(paragraph) > max_chars:
+            # An oversized paragraph (long table, minified JSON) is cut at line breaks where possible
+            cut = paragraph.rfind('\n', 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            buffer.append(paragraph[:cut])
+            flush()
+            paragraph = paragraph[cut:].strip('\n')
+        if paragraph:
+            buffer.append(paragraph)
+    flush()
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 over a list of term lists, with an inverted index for sparse queries."""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = len(documents)
+        self.lengths = [len(terms) for terms in documents]
+        self.average_length = (sum(self.lengths) / self.size) if self.size else 0.0
+        self.postings = {}
+        for index, terms in enumerate(documents):
+            for term, count in Counter(terms).items():
+                self.postings.setdefault(term, []).append((index, count))
+
+    def idf(self, term):
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (self.size - df + 0.5) / (df + 0.5))
+
+    def scores(self, query_terms):
+        """Map of document index -> BM25 score for documents matching any query term."""
+        scores = {}
+        for term in set(query_terms):
+            idf = self.idf(term)
+            for index, count in self.postings.get(term, ()):
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / (self.average_length or 1))
+                scores[index] = scores.get(index, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        return scores
+
+
+def retrieval_queries(framework, risk_areas):
+    """Map of query group -> query strings: each selected risk area's threats and the framework's coverage."""
+    groups = {area: list(RISK_AREAS[area]['threats']) for area in risk_areas if area in RISK_AREAS}
+    if framework in FRAMEWORKS:
+        groups[framework] = list(FRAMEWORKS[framework]['coverage'])
+    return groups
+
+
+def retrieve_evidence(documents, framework, risk_areas, top_k=None, chunk_tokens=None):
+    """Keep only the document chunks most relevant to the selected risk areas and framework.
+
+    Each document is chunked by page and heading (`_chunk_document`) and the
+    chunks are indexed with BM25. Every threat of a selected risk area, and every
+    coverage item of the framework, is a query; a chunk's score for a group is
+    the sum of its per-query scores normalized to the best match of each query.
+    The top `top_k` chunks of every group are kept, tagged with their section,
+    in their original order.
+
+    Returns (documents, report). Documents without a selected chunk keep their
+    heading with a note. Recall in the report is the share of queries with a
+    match anywhere in the documents whose best-matching chunk was kept.
+    """
+    top_k = RETRIEVAL_TOP_K if top_k is None else top_k
+    chunk_tokens = chunk_tokens or RETRIEVAL_CHUNK_TOKENS
+    chunks = [
+        (doc_index, section, text)
+        for doc_index, (_, document) in enumerate(documents)
+        for section, text in _chunk_document(document, chunk_tokens)
+    ]
+    index = BM25Index([_index_terms(f"{section}\n{text}") for _, section, text in chunks])
+
+    selected = set()
+    groups = {}
+    matched_total = found_total = 0
+    for group, queries in retrieval_queries(framework, risk_areas).items():
+        combined = {}
+        best_chunks = []
+        for query in queries:
+            scores = index.scores(_index_terms(query))
+            if not scores:
+                continue
+            best = max(scores.values())
+            best_chunks.append(max(scores, key=scores.get))
+            for chunk, score in scores.items():
+                combined[chunk] = combined.get(chunk, 0.0) + score / best
+        top = sorted(combined, key=lambda chunk: (-combined[chunk], chunk))[:top_k]
+        selected.update(top)
+        groups[group] = {"queries": len(queries), "matched_queries": len(best_chunks), "chunks": len(top)}
+        matched_total += len(best_chunks)
+        found_total += sum(1 for chunk in best_chunks if chunk in top)
+
+    kept = [[] for _ in documents]
+    for chunk_index in sorted(selected):
+        doc_index, section, text = chunks[chunk_index]
+        kept[doc_index].append(f"[Excerpt: {section}]\n{text}" if section else f"[Excerpt]\n{text}")
+    retrieved = [
+        (name, '\n\n'.join(kept[i]) if kept[i] else "[No excerpts matched the selected risk areas or framework]")
+        for i, (name, _) in enumerate(documents)
+    ]
+    report = {
+        "top_k": top_k,
+        "chunks": len(chunks),
+        "selected_chunks": len(selected),
+        "recall": (found_total / matched_total) if matched_total else 1.0,
+        "groups": groups,
+    }
+    return retrieved, report
+
+
+def compact_documents(documents, project_info, framework, risk_areas, budget_tokens=None, top_k=None):
+    """Fit the uploaded documents into the prompt token budget.
+
+    `documents` is a list of (file name, extracted text). When the documents
+    exceed RETRIEVAL_MIN_TOKENS, only the chunks most relevant to the selected
+    risk areas and framework are kept (`retrieve_evidence`, `top_k` chunks per
+    area; 0 disables retrieval). Further strategies are applied in order, each
+    only while the full prompt is still over `budget_tokens`
+    (PROMPT_TOKEN_BUDGET by default): whitespace and boilerplate stripping,
+    removal of paragraphs repeated across documents, then per-document caps that
+    split the remaining budget by relevance to the selected risk areas.
+
+    Returns (documents_content, report). The report holds the budget, the tokens
+    used by the rest of the prompt, the strategies applied, the retrieval report
+    (None without retrieval) and, per document, its token contribution before
+    and after compaction.
+    """
+    if budget_tokens is None:
+        budget_tokens = PROMPT_TOKEN_BUDGET
+    if top_k is None:
+        top_k = RETRIEVAL_TOP_K
+    overhead = estimate_tokens(_join_prompt(*build_assessment_request(project_info, "", framework, risk_areas)))
+    document_budget = max(0, budget_tokens - overhead)
+    terms = _relevance_terms(risk_areas)
+    original = [estimate_tokens(text) for _, text in documents]
+
+    def total(docs):
+        return estimate_tokens(assemble_documents(docs))
+
+    compacted = list(documents)
+    strategies = []
+    retrieval = None
+    if top_k > 0 and total(compacted) > RETRIEVAL_MIN_TOKENS:
+        compacted, retrieval = retrieve_evidence(compacted, framework, risk_areas, top_k=top_k)
+        strategies.append(
+            f"{retrieval['selected_chunks']} of {retrieval['chunks']} chunks retrieved for the selected risk areas"
+        )
+    if total(compacted) > document_budget:
+        compacted = [(name, _strip_boilerplate(text)) for name, text in compacted]
+        strategies.append("whitespace and boilerplate stripped")
+    if total(compacted) > document_budget:
+        compacted, removed = _dedupe_paragraphs(compacted)
+        strategies.append(f"{removed} repeated paragraphs removed")
+    relevance = [_relevance(text, terms) for _, text in compacted]
+    truncated = [False] * len(compacted)
+    if total(compacted) > document_budget:
+        headings = total([(name, "") for name, _ in compacted])
+        sizes = [estimate_tokens(text) for _, text in compacted]
+        # Every document keeps a floor share so unrelated-looking files are not dropped entirely
+        weights = [0.05 + r for r in relevance]
+        caps = _allocate_caps(sizes, weights, max(0, document_budget - headings))
+        for i, (name, text) in enumerate(compacted):
+            if sizes[i] > caps[i]:
+                compacted[i] = (name, _truncate_to_tokens(text, caps[i], terms))
+                truncated[i] = True
+        strategies.append(f"{sum(truncated)} documents capped by relevance")
+
+    documents_content = assemble_documents(compacted)
+    if retrieval:
+        documents_content = (
+            "\n\n(Only the excerpts most relevant to the selected risk areas and framework are included; "
+            "each is tagged with its document section.)" + documents_content
+        )
+    prompt_tokens = overhead + estimate_tokens(documents_content)
+    if retrieval:
+        retrieval["saved_tokens"] = max(0, overhead + total(documents) - prompt_tokens)
+    report = {
+        "budget_tokens": budget_tokens,
+        "overhead_tokens": overhead,
+        "original_prompt_tokens": overhead + total(documents),
+        "prompt_tokens": prompt_tokens,
+        "fits": prompt_tokens <= budget_tokens,
+        "strategies": strategies,
+        "retrieval": retrieval,
+        "documents": [
+            {
+                "name": name,
+                "original_tokens": original[i],
+                "tokens": estimate_tokens(text),
+                "relevance": round(relevance[i], 3),
+                "truncated": truncated[i],
+            }
+            for i, (name, text) in enumerate(compacted)
+        ],
+    }
+    return documents_content, report
+
+
 def _suggest_references_from_text(text):
     """Return a set of suggested short citations (text, url) based on keywords in the report."""
     suggestions = set()
@@ -464,24 +2185,315 @@ def _merge_references_section(report_md, suggestions):
     return '\n'.join(new_lines)
 
 
+# Quoted strings shorter than this (after normalization) are names or labels, not evidence
+EVIDENCE_MIN_QUOTE_CHARS = int(os.environ.get('SECUREAI_EVIDENCE_MIN_QUOTE_CHARS', 20))
+# Share of a quote's words that must be found in one place of a document for a fuzzy match
+EVIDENCE_FUZZY_THRESHOLD = float(os.environ.get('SECUREAI_EVIDENCE_FUZZY_THRESHOLD', 0.6))
+# Index key: the bytes following each word start of the normalized documents
+_EVIDENCE_KEY_BYTES = 16
+# Keys that occur more often than this ("the system uses ") carry no location and are not voted on
+_EVIDENCE_MAX_CANDIDATES = 256
+# Lowercases ASCII letters and turns all ASCII punctuation and whitespace into spaces
+_EVIDENCE_TABLE = bytes(
+    c + 32 if 65 <= c <= 90 else c if (48 <= c <= 57 or 97 <= c <= 122 or c >= 128) else 32
+    for c in range(256)
+)
+_EVIDENCE_PUNCTUATION = [mark.encode('utf-8') for mark in "‘’“”–—…•·→"]
+_EVIDENCE_PAGE = re.compile(r'\[Page (\d+)\]')
+_QUOTED = re.compile(r'"([^"\n]+)"|“([^”\n]+)”|‘([^’\n]+)’|(?<![\w\'])\'([^\'\n]+)\'(?![\w\'])')
+_FINDING_REF = re.compile(r'\bF\d{3,}\b')
+_DOCUMENT_CITATION = re.compile(
+    r'\[(?:Based on uploaded document|Documents?|see also):\s*([^\]\n]+)\]|EXAMPLE from \[?([^\]:*\n]+)', re.IGNORECASE
+)
+_CITED_FILE = re.compile(r'[\w\-.()]+\.(?:pdf|docx|md|txt|ya?ml|json|png|jpe?g)\b', re.IGNORECASE)
+
+
+def _evidence_normalize(text):
+    """Normalize text for evidence matching: lowercase ASCII words separated by single spaces."""
+    data = text.encode('utf-8', 'replace')
+    for mark in _EVIDENCE_PUNCTUATION:
+        if mark in data:
+            data = data.replace(mark, b' ')
+    data = data.translate(_EVIDENCE_TABLE)
+    while b'  ' in data:
+        data = data.replace(b'  ', b' ')
+    return data.strip(b' ')
+
+
+def _evidence_key_hash(key):
+    """64-bit hash of a 16-byte index key; must agree with the vectorized form in `EvidenceIndex`."""
+    low, high = int.from_bytes(key[:8], 'little'), int.from_bytes(key[8:16], 'little')
+    return ((low * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) ^ high
+
+
+class EvidenceIndex:
+    """Word-anchored index over the uploaded documents for locating quoted evidence.
+
+    Documents are normalized (see `_evidence_normalize`) and concatenated, with
+    a NUL between documents so no match spans two of them. Every word start is
+    indexed by the 16 bytes that follow it: a suffix array truncated to 16-byte
+    keys and sampled at word starts. A quote is then found by one binary search
+    on its first key plus a comparison per candidate, and a paraphrase by letting
+    the keys of its words vote on where it starts. Nothing scans the documents
+    per quote, so hundreds of quotes against tens of MB take milliseconds once
+    the index is built.
+
+    The keys are hashed and sorted with numpy when it is installed (it comes
+    with Streamlit); otherwise a dict of positions is built in Python.
+    """
+
+    def __init__(self, documents):
+        self.names = []
+        # (offset, document index, page number or None) per indexed segment, in offset order
+        self.segments = []
+        parts = []
+        offset = 0
+        for doc_index, (name, text) in enumerate(documents):
+            self.names.append(name)
+            pieces = _EVIDENCE_PAGE.split(text or "")
+            pages = [(None, pieces[0])] + [(int(pieces[i]), pieces[i + 1]) for i in range(1, len(pieces), 2)]
+            for page, segment in pages:
+                normalized = _evidence_normalize(segment)
+                if not normalized:
+                    continue
+                self.segments.append((offset, doc_index, page))
+                parts.append(b' ' + normalized)
+                offset += len(normalized) + 1
+            parts.append(b' \0')
+            offset += 2
+        parts.append(b' ')
+        self.text = b''.join(parts)
+        self._segment_offsets = [segment[0] for segment in self.segments]
+        try:
+            import numpy as np  # optional: installed with Streamlit
+        except ImportError:
+            np = None
+        if np is not None:
+            self._build_sorted(np)
+        else:
+            self._build_dict()
+
+    def _build_sorted(self, np):
+        padded = self.text + b' ' * _EVIDENCE_KEY_BYTES
+        data = np.frombuffer(padded, dtype=np.uint8)
+        n = len(self.text)
+        starts = np.flatnonzero((data[:n - 1] == 32) & (data[1:n] != 32)) + 1
+        low = np.ndarray((n,), dtype='<u8', buffer=padded, offset=0, strides=(1,))[starts]
+        high = np.ndarray((n,), dtype='<u8', buffer=padded, offset=8, strides=(1,))[starts]
+        with np.errstate(over='ignore'):
+            keys = (low * np.uint64(0x9E3779B97F4A7C15)) ^ high
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._positions = starts[order]
+        self._np = np
+        self._table = None
+
+    def _build_dict(self):
+        self._table = {}
+        for match in re.finditer(rb'(?<= )[^ ]', self.text):
+            position = match.start()
+            self._table.setdefault(self.text[position:position + _EVIDENCE_KEY_BYTES], []).append(position)
+
+    def candidates(self, key):
+        """Positions of word starts whose following bytes begin with the 16-byte `key`."""
+        if self._table is not None:
+            return self._table.get(key, [])
+        target = self._np.uint64(_evidence_key_hash(key))
+        lo = int(self._np.searchsorted(self._keys, target, side='left'))
+        hi = int(self._np.searchsorted(self._keys, target, side='right'))
+        # Hash collisions are weeded out by the caller's comparison against the text
+        return self._positions[lo:hi].tolist()
+
+    def source(self, position):
+        """(document name, page number or None) containing `position`."""
+        offset, doc_index, page = self.segments[bisect.bisect_right(self._segment_offsets, position) - 1]
+        return self.names[doc_index], page
+
+    def locate(self, quote):
+        """Find a quote; return {"status": "verified"|"fuzzy"|"unsupported", "document", "page", "coverage"}."""
+        needle = _evidence_normalize(quote)
+        if len(needle) < _EVIDENCE_KEY_BYTES:
+            return {"status": "unsupported", "document": None, "page": None, "coverage": 0.0}
+        for position in self.candidates(needle[:_EVIDENCE_KEY_BYTES]):
+            if self.text.startswith(needle, position):
+                document, page = self.source(position)
+                return {"status": "verified", "document": document, "page": page, "coverage": 1.0}
+
+        # Fuzzy: each word of the quote votes for where the quote would start in the documents
+        word_offsets = [0] + [i + 1 for i in range(len(needle)) if needle[i] == 32]
+        word_offsets = [i for i in word_offsets if i + _EVIDENCE_KEY_BYTES <= len(needle)]
+        votes = []
+        for i in word_offsets:
+            positions = self.candidates(needle[i:i + _EVIDENCE_KEY_BYTES])
+            if len(positions) > _EVIDENCE_MAX_CANDIDATES:
+                continue
+            votes.extend((position - i, i) for position in positions
+                         if self.text.startswith(needle[i:i + _EVIDENCE_KEY_BYTES], position))
+        best, best_start = 0, None
+        if votes:
+            votes.sort()
+            # Edits shift later words; votes within a quarter of the quote's length agree
+            window = max(32, len(needle) // 4)
+            in_window = Counter()
+            left = 0
+            for start, i in votes:
+                in_window[i] += 1
+                while start - votes[left][0] > window:
+                    in_window[votes[left][1]] -= 1
+                    if not in_window[votes[left][1]]:
+                        del in_window[votes[left][1]]
+                    left += 1
+                if len(in_window) > best:
+                    best, best_start = len(in_window), sum(votes[left])
+        coverage = best / len(word_offsets)
+        if coverage >= EVIDENCE_FUZZY_THRESHOLD:
+            # The first agreeing word's own position, so the source is where the match was found
+            document, page = self.source(best_start)
+            return {"status": "fuzzy", "document": document, "page": page, "coverage": coverage}
+        return {"status": "unsupported", "document": None, "page": None, "coverage": coverage}
+
+
+def _evidence_units(report):
+    """Split a report into (label, text) units: table rows and paragraphs, labelled by finding ID or heading."""
+    heading = "Report"
+    paragraph = []
+    for line in report.splitlines() + [""]:
+        stripped = line.strip()
+        if paragraph and (not stripped or stripped.startswith(('#', '|'))):
+            text = " ".join(paragraph)
+            finding = _FINDING_REF.search(text)
+            yield (finding.group(0) if finding else heading), text
+            paragraph = []
+        if stripped.startswith('#'):
+            heading = stripped.lstrip('#').strip().strip('*') or heading
+        elif stripped.startswith('|'):
+            finding = _FINDING_REF.search(stripped)
+            yield (finding.group(0) if finding else heading), stripped
+        elif stripped:
+            paragraph.append(stripped)
+
+
+def _unknown_documents(text, names):
+    """File names cited in `text` that match none of the uploaded document names."""
+    lowered = [name.lower() for name in names]
+    unknown = []
+    for match in _DOCUMENT_CITATION.finditer(text):
+        cited = match.group(1) or match.group(2) or ""
+        if any(name in cited.lower() for name in lowered):
+            continue
+        for file_name in _CITED_FILE.findall(cited):
+            if not any(name.endswith(file_name.lower()) for name in lowered):
+                unknown.append(file_name)
+    return unknown
+
+
+def _evidence_cell(text, limit=70):
+    text = " ".join(text.split()).replace("|", "/")
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+def verify_evidence(report, documents, index=None):
+    """Check the quoted evidence and document citations in `report` against the uploaded documents.
+
+    `documents` is [(file name, extracted text)]. Every quoted string of at least
+    EVIDENCE_MIN_QUOTE_CHARS characters is looked up in an `EvidenceIndex`:
+    "verified" if it appears verbatim (ignoring case, punctuation and
+    whitespace), "fuzzy" if most of its words appear together in one place, and
+    "unsupported" otherwise. A citation of a file that was not uploaded is also
+    unsupported. Findings (F### rows and paragraphs, or the section they sit in)
+    take their worst status.
+
+    Returns (report with an EVIDENCE VERIFICATION section appended, stats); the
+    report is unchanged when it quotes and cites nothing that can be checked.
+    """
+    started = time.monotonic()
+    names = [name for name, _ in documents]
+    findings = OrderedDict()
+    for label, text in _evidence_units(report):
+        unit_quotes = [next(group for group in match.groups() if group) for match in _QUOTED.finditer(text)]
+        unit_quotes = [q for q in unit_quotes if len(_evidence_normalize(q)) >= EVIDENCE_MIN_QUOTE_CHARS]
+        unknown = _unknown_documents(text, names)
+        if unit_quotes or unknown:
+            finding = findings.setdefault(label, {"quotes": [], "unknown_documents": []})
+            finding["quotes"].extend(q for q in unit_quotes if q not in finding["quotes"])
+            finding["unknown_documents"].extend(u for u in unknown if u not in finding["unknown_documents"])
+
+    stats = {"findings": len(findings), "quotes": 0, "verified": 0, "fuzzy": 0, "unsupported": 0,
+             "index_seconds": 0.0, "seconds": 0.0}
+    if not findings:
+        stats["seconds"] = round(time.monotonic() - started, 3)
+        return report, stats
+    if index is None:
+        index = EvidenceIndex(documents)
+    stats["index_seconds"] = round(time.monotonic() - started, 3)
+
+    located = {}
+    rows = []
+    for label, finding in findings.items():
+        cells = []
+        statuses = []
+        for quote in finding["quotes"]:
+            if quote not in located:
+                located[quote] = index.locate(quote)
+            result = located[quote]
+            statuses.append(result["status"])
+            where = ""
+            if result["document"]:
+                where = f" — {result['document']}" + (f" p. {result['page']}" if result["page"] else "")
+            note = f" ({result['coverage']:.0%} of words)" if result["status"] == "fuzzy" else ""
+            cells.append(f"\"{_evidence_cell(quote)}\" {result['status']}{note}{where}")
+        for file_name in finding["unknown_documents"]:
+            statuses.append("unsupported")
+            cells.append(f"{_evidence_cell(file_name)} was not uploaded")
+        status = next(s for s in ("unsupported", "fuzzy", "verified") if s in statuses)
+        finding["status"] = status
+        stats[status] += 1
+        rows.append(f"| {_evidence_cell(label, 40)} | {status.capitalize()} | {'; '.join(cells)} |")
+    stats["quotes"] = len(located)
+    stats["seconds"] = round(time.monotonic() - started, 3)
+
+    section = [
+        "## EVIDENCE VERIFICATION",
+        "",
+        f"*Quoted evidence checked against the uploaded documents. Findings: {stats['verified']} verified, "
+        f"{stats['fuzzy']} fuzzy-matched, {stats['unsupported']} unsupported.*",
+        "",
+        "| Finding | Status | Evidence |",
+        "|---------|--------|----------|",
+    ] + rows
+    return report.rstrip('\n') + "\n\n" + "\n".join(section) + "\n", stats
+
+
 def reset_assessment_form():
     """Reset all form fields and clear previous assessment"""
     st.session_state.assessment_complete = False
     st.session_state.threat_report = None
     st.session_state.uploaded_files = []
     st.session_state.processing = False
+    st.session_state.assessment_job_id = None
+    _set_job_query_param(None)
     st.session_state.project_name_input = ""
     st.session_state.show_reset_confirm = False
 
 
-def generate_threat_assessment(project_info, documents_content, framework, risk_areas, api_key):
-    """Generate comprehensive threat assessment using SecureAI"""
-    
-    client = anthropic.Anthropic(api_key=api_key)
-    
-    # Build comprehensive prompt
-    prompt = f"""You are an expert cybersecurity consultant specializing in threat modeling and risk assessment. 
-Perform a comprehensive threat assessment for the following project using the {framework} framework.
+def _stream_message(client, on_text, **request_kwargs):
+    """Call the Messages API in streaming mode, forwarding each text delta to `on_text`.
+
+    Returns the final assembled Message so callers extract text from it exactly as
+    they would from a blocking `create` call.
+    """
+    with client.beta.messages.stream(**request_kwargs) as stream:
+        for text in stream.text_stream:
+            on_text(text)
+        return stream.get_final_message()
+
+
+def _prompt_header(project_info, documents_content, framework, risk_areas):
+    """Project details, uploaded documents and selected scope (the variable part of the prompt).
+
+    The role is stated once, in the cacheable ASSESSMENT_SYSTEM_PREFIX.
+    """
+    return f"""Perform a comprehensive threat assessment for the following project using the {framework} framework.
 
 **PROJECT INFORMATION:**
 - Project Name: {project_info['name']}
@@ -497,9 +2509,14 @@ Perform a comprehensive threat assessment for the following project using the {f
 {FRAMEWORKS[framework]['description']}
 
 **SPECIFIC RISK FOCUS AREAS TO ASSESS:**
-{chr(10).join([f"- {area}: {RISK_AREAS[area]['description']}" for area in risk_areas])}
+{chr(10).join([f"- {area} (threat IDs T-{area[:3].upper()}-###): {RISK_AREAS[area]['description']}" for area in risk_areas])}
 
-**ASSESSMENT REQUIREMENTS - EVIDENCE-BASED ANALYSIS:**
+"""
+
+
+def _prompt_evidence_rules():
+    """Evidence and citation rules every part of the report must follow."""
+    return """**ASSESSMENT REQUIREMENTS - EVIDENCE-BASED ANALYSIS:**
 
 Generate a professional threat assessment report with complete structure, extensive tables, and and color-coded risk levels suitable for executive review.
 
@@ -534,7 +2551,11 @@ For every major finding, include at least ONE concrete example directly from the
 
 This creates risk finding F001 because unrestricted privilege elevation enables unauthorized actions including data theft and financial fraud [see also: Configuration_Guide.md, section 'Agent Capability Levels']."
 
-# EXECUTIVE SUMMARY
+"""
+
+
+def _section_executive_summary():
+    return """# EXECUTIVE SUMMARY
 
 **Overall Risk Rating:** [CRITICAL/HIGH/MEDIUM/LOW]
 
@@ -561,11 +2582,15 @@ This creates risk finding F001 because unrestricted privilege elevation enables
 
 ---
 
-# THREAT MODELING ANALYSIS - {framework}
+"""
+
 
-Comprehensive threat analysis organized by {framework} categories with risk scoring and mitigation paths, **with evidence citations and concrete examples from uploaded documentation**.
+def _section_threat_modeling():
+    return """# THREAT MODELING ANALYSIS - [Framework]
 
-For each relevant category in {framework}, provide detailed analysis:
+Comprehensive threat analysis organized by the selected framework's categories with risk scoring and mitigation paths, **with evidence citations and concrete examples from uploaded documentation**.
+
+For each relevant category in the selected framework, provide detailed analysis:
 
 ## [Category Name]
 
@@ -577,22 +2602,31 @@ For each relevant category in {framework}, provide detailed analysis:
 
 ---
 
-# SPECIALIZED RISK ASSESSMENTS
+"""
+
+
+def _section_specialized_risks():
+    return """# SPECIALIZED RISK ASSESSMENTS
 
 Detailed analysis of specific risk areas with threat matrices and mitigation strategies, **each with specific document references, evidence citations, and concrete examples from documentation**.
 
-{chr(10).join([f'''## {area}
+Add one subsection per risk focus area listed under SPECIFIC RISK FOCUS AREAS TO ASSESS, in that order, using the threat ID prefix given for the area:
+
+## [Risk Focus Area]
 
-[Introduction paragraph about {area}]
+[Introduction paragraph about the risk focus area]
 
 | Threat ID | Evidence Source (Doc) | Example from Docs | Threat | Likelihood | Impact | Risk Priority | Mitigation Strategy |
 |-----------|-----------------------|-------------------|--------|-----------|--------|---------------|---------------------|
-| T-{area[:3].upper()}-001 | [Doc: Section] | [Specific example] | [specific threat] | [1-5] | [1-5] | P0/P1/P2 | [specific action] |
-''' for area in risk_areas])}
+| T-[AREA]-001 | [Doc: Section] | [Specific example] | [specific threat] | [1-5] | [1-5] | P0/P1/P2 | [specific action] |
 
 ---
 
-# COMPONENT-SPECIFIC THREAT ANALYSIS
+"""
+
+
+def _section_component_threats():
+    return """# COMPONENT-SPECIFIC THREAT ANALYSIS
 
 Threats organized by system architecture components with detection and response strategies, **including concrete examples from uploaded documentation**.
 
@@ -607,7 +2641,11 @@ Threats organized by system architecture components with detection and response
 
 ---
 
-# ATTACK SCENARIOS & KILL CHAINS
+"""
+
+
+def _section_attack_scenarios():
+    return """# ATTACK SCENARIOS & KILL CHAINS
 
 Realistic attack progression models showing attacker techniques and defense opportunities, **with evidence from uploaded documentation showing how system features enable each phase**.
 
@@ -632,7 +2670,11 @@ Realistic attack progression models showing attacker techniques and defense oppo
 
 ---
 
-# COMPREHENSIVE RISK MATRIX
+"""
+
+
+def _section_risk_matrix():
+    return """# COMPREHENSIVE RISK MATRIX
 
 All findings mapped to risk levels with prioritization.
 
@@ -656,7 +2698,11 @@ All findings mapped to risk levels with prioritization.
 
 ---
 
-# PRIORITIZED RECOMMENDATIONS
+"""
+
+
+def _section_recommendations():
+    return """# PRIORITIZED RECOMMENDATIONS
 
 All recommendations organized by priority tier with implementation details and risk reduction impact.
 
@@ -696,7 +2742,11 @@ All recommendations organized by priority tier with implementation details and r
 
 ---
 
-# SECURITY CONTROLS MAPPING
+"""
+
+
+def _section_controls_mapping():
+    return """# SECURITY CONTROLS MAPPING
 
 Recommendations mapped to control categories and compliance frameworks.
 
@@ -709,17 +2759,25 @@ Recommendations mapped to control categories and compliance frameworks.
 
 ---
 
-# COMPLIANCE CONSIDERATIONS
+"""
+
+
+def _section_compliance():
+    return """# COMPLIANCE CONSIDERATIONS
 
-Map all findings to required compliance frameworks:
+Map all findings to required compliance frameworks, with one row per compliance requirement listed under PROJECT INFORMATION:
 
 | Finding ID | Finding | Compliance Requirement | Compliance Gap | Required Evidence | Remediation Timeline |
 |----------|---------|----------------------|----------------|------------------|---------------------|
-{chr(10).join([f"| [F-ID] | [finding] | {req} | [gap description] | [evidence needed] | [timeline] |" for req in project_info['compliance']])}
+| [F-ID] | [finding] | [requirement] | [gap description] | [evidence needed] | [timeline] |
 
 ---
 
-# SECURITY METRICS & KPIs
+"""
+
+
+def _section_metrics():
+    return """# SECURITY METRICS & KPIs
 
 Establish tracking metrics for continuous security improvement:
 
@@ -734,7 +2792,11 @@ Establish tracking metrics for continuous security improvement:
 
 ---
 
-# APPENDICES
+"""
+
+
+def _section_appendices():
+    return """# APPENDICES
 
 ## A. THREAT TAXONOMY & REFERENCE FRAMEWORKS
 
@@ -773,7 +2835,11 @@ Recommended security tooling by category:
 
 ---
 
-**CRITICAL FORMATTING REQUIREMENTS FOR EXECUTIVE-READY OUTPUT:**
+"""
+
+
+def _prompt_formatting_requirements():
+    return """**CRITICAL FORMATTING REQUIREMENTS FOR EXECUTIVE-READY OUTPUT:**
 
 1. **Table Usage:** All findings, recommendations, risk matrices, and comparisons MUST use markdown tables
 2. **Color-Coded Risk Levels:** Always use **CRITICAL** (red), **HIGH** (orange), **MEDIUM** (yellow), **LOW** (green)
@@ -786,7 +2852,11 @@ Recommended security tooling by category:
 9. **Professional Tone:** Executive summary suitable for C-level review, technical details in analysis sections
 10. **Comprehensive Tables:** Every risk assessment section must include a properly formatted comparison table
 
-Generate the complete, detailed, professionally formatted threat assessment report now, following ALL structure and formatting requirements above.
+"""
+
+
+def _prompt_closing_instructions():
+    return """Generate the complete, detailed, professionally formatted threat assessment report now, following ALL structure and formatting requirements in the instructions.
   - **Top 5 Findings** (bulleted, one sentence each).
   - **Top 3 Prioritized Recommendations** (short bullets).
 - For each **CRITICAL** or **HIGH** finding include a short **Rationale** paragraph explaining why the finding is scored that way and include at least one authoritative reference (cite sources inline using short bracketed citations, e.g., `[NIST SP 800-53]`, `[OWASP Top 10]`, `[MITRE ATT&CK]`, `[ISO 27001]`).
@@ -796,225 +2866,964 @@ Generate the complete, detailed, professionally formatted threat assessment repo
 Generate the document in Markdown so it renders well as both Markdown and PDF.
 """
 
+
+def _prompt_section_scope(part_number, part_count, title, section_headings, include_references):
+    """Closing instruction for one part of a report generated section by section."""
+    if include_references:
+        references_rule = "- End with a **REFERENCES** section listing the cited sources with short URLs where possible."
+    else:
+        references_rule = "- Do not add a REFERENCES section; references are compiled once for the whole report."
+    return f"""**PARTIAL REPORT SCOPE:**
+This request produces part {part_number} of {part_count} of the report ({title}). The other parts are generated separately and combined in order, so:
+- Output ONLY these sections of the report template, in this order, starting directly with the first H1 (#) heading; no preamble, title, or table of contents:
+{chr(10).join(f"  - {heading}" for heading in section_headings)}
+- Keep F### (findings), R### (recommendations) and T### (threats) identifiers consistent with the numbering shown in the report template.
+- For each **CRITICAL** or **HIGH** finding include a short **Rationale** paragraph explaining why the finding is scored that way and include at least one authoritative reference (cite sources inline using short bracketed citations, e.g., `[NIST SP 800-53]`, `[OWASP Top 10]`, `[MITRE ATT&CK]`, `[ISO 27001]`).
+{references_rule}
+
+Generate the document in Markdown so it renders well as both Markdown and PDF.
+"""
+
+
+# Report sections in output order: (key, title, template builder)
+ASSESSMENT_SECTIONS = [
+    ("executive_summary", "Executive Summary", _section_executive_summary),
+    ("threat_modeling", "Threat Modeling Analysis", _section_threat_modeling),
+    ("specialized_risks", "Specialized Risk Assessments", _section_specialized_risks),
+    ("component_threats", "Component-Specific Threat Analysis", _section_component_threats),
+    ("attack_scenarios", "Attack Scenarios & Kill Chains", _section_attack_scenarios),
+    ("risk_matrix", "Comprehensive Risk Matrix", _section_risk_matrix),
+    ("recommendations", "Prioritized Recommendations", _section_recommendations),
+    ("controls_mapping", "Security Controls Mapping", _section_controls_mapping),
+    ("compliance", "Compliance Considerations", _section_compliance),
+    ("metrics", "Security Metrics & KPIs", _section_metrics),
+    ("appendices", "Appendices", _section_appendices),
+]
+
+
+def build_system_prefix():
+    """Static instructions shared by every assessment request.
+
+    Contains no project-specific text, so it is byte-identical across runs and
+    is sent as a cacheable system prompt prefix.
+    """
+    return (
+        "You are an expert cybersecurity consultant specializing in threat modeling and risk assessment. "
+        "Threat assessments follow the requirements and report template below. The project details, uploaded "
+        "documentation, framework and risk focus areas are provided in the request.\n\n"
+        + _prompt_evidence_rules()
+        + "".join(build() for _, _, build in ASSESSMENT_SECTIONS)
+        + _prompt_formatting_requirements()
+    )
+
+
+ASSESSMENT_SYSTEM_PREFIX = build_system_prefix()
+
+
+def build_assessment_request(project_info, documents_content, framework, risk_areas):
+    """Return (system prefix, user prompt) for a complete threat assessment report."""
+    user_prompt = (
+        _prompt_header(project_info, documents_content, framework, risk_areas)
+        + _prompt_closing_instructions()
+    )
+    return ASSESSMENT_SYSTEM_PREFIX, user_prompt
+
+
+def build_assessment_prompt(project_info, documents_content, framework, risk_areas):
+    """Render the full threat assessment prompt as one string (system prefix, then the request)."""
+    return _join_prompt(*build_assessment_request(project_info, documents_content, framework, risk_areas))
+
+
+# Independent parts of the report for parallel section-wise generation: (title, section keys).
+# Each part is a contiguous run of ASSESSMENT_SECTIONS so the stitched report keeps the template order.
+SECTION_GROUPS = [
+    ("Executive Summary", ["executive_summary"]),
+    ("Threat Modeling Analysis", ["threat_modeling", "specialized_risks"]),
+    ("Risk Matrix", ["component_threats", "attack_scenarios", "risk_matrix"]),
+    ("Recommendations", ["recommendations", "controls_mapping", "compliance", "metrics"]),
+    ("Appendices A-C", ["appendices"]),
+]
+
+# Upper bound on concurrent section requests
+SECTION_WORKERS = int(os.environ.get('SECUREAI_SECTION_WORKERS', len(SECTION_GROUPS)))
+
+
+def build_section_request(project_info, documents_content, framework, risk_areas, group_index):
+    """Return (system prefix, user prompt) for one part (see SECTION_GROUPS) of the report.
+
+    Every part shares the full-report system prefix, so all parts and full
+    reports hit the same provider-side prompt cache entry.
+    """
+    title, keys = SECTION_GROUPS[group_index]
+    builders = {key: build for key, _, build in ASSESSMENT_SECTIONS}
+    headings = [builders[key]().splitlines()[0] for key in keys]
+    is_last = group_index == len(SECTION_GROUPS) - 1
+    user_prompt = (
+        _prompt_header(project_info, documents_content, framework, risk_areas)
+        + _prompt_section_scope(group_index + 1, len(SECTION_GROUPS), title, headings, include_references=is_last)
+    )
+    return ASSESSMENT_SYSTEM_PREFIX, user_prompt
+
+
+def _join_prompt(system_prompt, user_prompt):
+    """Single-string form of a (system, user) prompt, for the Completions API and cache keys."""
+    if not system_prompt:
+        return user_prompt
+    return f"{system_prompt}\n\n{user_prompt}"
+
+
+def _format_claude_prompt(prompt):
+    """Ensure the prompt starts with the Human turn required by the Completions API."""
+    if not (prompt.startswith("\n\nHuman:") or prompt.startswith("\n\nSystem:") or prompt.startswith("Human:") or prompt.startswith("System:")):
+        return f"\n\nHuman: {prompt}\n\nAssistant:"
+    return prompt
+
+
+def generate_threat_assessment(project_info, documents_content, framework, risk_areas, api_key, stream_callback=None, use_cache=None, usage=None, force_messages=None, raise_errors=False, images=None):
+    """Generate comprehensive threat assessment using SecureAI
+
+    When `stream_callback` is given and the Messages API is used, the report is
+    streamed and each text delta is passed to the callback as it arrives. The
+    returned text is identical to the blocking call.
+
+    Responses are served from the on-disk response cache when the same rendered
+    prompt was already answered by the same model. `use_cache=False` bypasses the
+    lookup (a fresh result still refreshes the cache); by default the sidebar
+    "bypass cache" toggle decides.
+
+    The static instructions are sent as a cacheable system prefix. If `usage` is
+    a dict it receives the run's token usage, including prompt-cache reads and
+    writes (see `_add_usage`).
+
+    Callers outside a Streamlit session (batch runs, worker threads) pass
+    `use_cache` and `force_messages` explicitly and set `raise_errors` to get
+    the exception instead of an error message on the page.
+
+    `images` (from `prepare_uploaded_images`) are sent as image content blocks
+    ahead of the prompt, which requires the Messages API.
+    """
+    system_prompt, user_prompt = build_assessment_request(project_info, documents_content, framework, risk_areas)
+    model_name = ASSESSMENT_MODEL
+
+    if use_cache is None:
+        use_cache = not getattr(st.session_state, 'bypass_response_cache', False)
+    cache = get_response_cache()
+    cache_key = response_cache_key(_format_claude_prompt(_join_prompt(system_prompt, user_prompt)), model_name, images)
+    if cache is not None and use_cache:
+        cached = cache.get_text(cache_key)
+        if cached is not None:
+            if stream_callback:
+                stream_callback(cached)
+            if usage is not None:
+                usage["response_cache_hit"] = True
+            return cached
+
+    client = get_anthropic_client(api_key)
+    report = _request_assessment(
+        client, user_prompt, model_name, stream_callback, force_messages=force_messages,
+        raise_errors=raise_errors, system_prompt=system_prompt, usage=usage, images=images
+    )
+    if report and cache is not None:
+        cache.put_text(cache_key, report)
+    return report
+
+
+def _cacheable_system(system_prompt):
+    """System prompt as a text block marked for provider-side prompt caching."""
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+
+def _add_usage(usage, resp):
+    """Add the token usage reported on a Messages API response to the `usage` dict."""
+    if usage is None:
+        return
+    reported = getattr(resp, 'usage', None)
+    if reported is None and isinstance(resp, dict):
+        reported = resp.get('usage')
+    if reported is None:
+        return
+    for field in USAGE_FIELDS:
+        value = reported.get(field) if isinstance(reported, dict) else getattr(reported, field, None)
+        usage[field] = usage.get(field, 0) + int(value or 0)
+
+
+def _extract_message_text(resp_obj):
+    """Extract the generated text from the common Messages API response shapes."""
+    # Handle Claude API Message object with content blocks
+    if hasattr(resp_obj, 'content'):
+        content = resp_obj.content
+        # content is a list of ContentBlock objects
+        if isinstance(content, list):
+            text_parts = []
+            for block in content:
+                # Each ContentBlock has a 'text' attribute
+                if hasattr(block, 'text'):
+                    text_parts.append(block.text)
+                elif isinstance(block, dict) and 'text' in block:
+                    text_parts.append(block['text'])
+                elif isinstance(block, str):
+                    text_parts.append(block)
+            if text_parts:
+                return "".join(text_parts)
+        # content might be a string directly
+        elif isinstance(content, str):
+            return content
+
+    # Check other common attributes
+    for attr in ("message", "output", "completion"):
+        if hasattr(resp_obj, attr):
+            candidate = getattr(resp_obj, attr)
+            # dict-like
+            if isinstance(candidate, dict):
+                # common nested patterns
+                for key in ("text", "content", "parts", "output_text"):
+                    if key in candidate:
+                        val = candidate[key]
+                        if isinstance(val, list):
+                            return "".join(map(str, val))
+                        if isinstance(val, str):
+                            return val
+                # fallback to string
+                return str(candidate)
+            # object-like
+            if isinstance(candidate, str):
+                return candidate
+
+    # resp_obj might be a dict
+    if isinstance(resp_obj, dict):
+        for key in ("text", "content", "completion", "message"):
+            if key in resp_obj:
+                v = resp_obj[key]
+                if isinstance(v, str):
+                    return v
+                if isinstance(v, list):
+                    return "".join(map(str, v))
+                if isinstance(v, dict):
+                    # nested
+                    for k in ("text", "content"):
+                        if k in v and isinstance(v[k], str):
+                            return v[k]
+    # fallback
+    return str(resp_obj)
+
+
+def _user_content(user_prompt, images=None):
+    """User turn content: the prompt text, preceded by a labelled image block for each image."""
+    if not images:
+        return user_prompt
+    blocks = []
+    for image in images:
+        blocks.append({"type": "text", "text": f"Image: {image['name']}"})
+        blocks.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": image['media_type'],
+                "data": base64.b64encode(image['data']).decode('ascii'),
+            },
+        })
+    blocks.append({"type": "text", "text": user_prompt})
+    return blocks
+
+
+def _messages_request(client, model_name, user_prompt, system_prompt=None, stream_callback=None, usage=None, images=None):
+    """Call the Messages API (streaming when `stream_callback` is given) and return the text."""
+    request_kwargs = dict(
+        model=model_name,
+        messages=[{"role": "user", "content": _user_content(user_prompt, images)}],
+        max_tokens=16000,
+        temperature=0,
+    )
+    if system_prompt:
+        request_kwargs["system"] = _cacheable_system(system_prompt)
+    streamed = {"text": False}
+
+    def on_text(delta):
+        streamed["text"] = True
+        stream_callback(delta)
+
+    def send():
+        if stream_callback:
+            return _stream_message(client, on_text, **request_kwargs)
+        return client.beta.messages.create(**request_kwargs)
+
+    # Once text has reached the caller a retry would repeat it, so only retry before the first delta
+    resp = _request_scheduler.call(
+        send,
+        estimated_tokens=(
+            estimate_tokens(user_prompt) + estimate_tokens(system_prompt or "")
+            + sum(image_tokens(image['width'], image['height']) for image in images or [])
+        ),
+        can_retry=lambda: not streamed["text"],
+    )
+    _add_usage(usage, resp)
+    return _extract_message_text(resp)
+
+
+def _completions_request(client, model_name, final_prompt):
+    """Call the legacy Completions API with a formatted Human/Assistant prompt and return the text."""
+    completion = _request_scheduler.call(
+        lambda: client.completions.create(
+            model=model_name,
+            prompt=final_prompt,
+            max_tokens_to_sample=16000,
+            temperature=0,
+        ),
+        estimated_tokens=estimate_tokens(final_prompt),
+    )
+    # The Completion object exposes the generated text on `.completion`
+    return getattr(completion, "completion", str(completion))
+
+
+def _request_assessment(client, user_prompt, model_name, stream_callback=None, force_messages=None, raise_errors=False, system_prompt=None, usage=None, images=None):
+    """Send the prompt to the model and return the report text.
+
+    On the Messages API `system_prompt` is sent as a system block marked for
+    prompt caching and `user_prompt` as the user turn; the Completions API gets
+    both joined into a single Human turn. Requests with `images` always use the
+    Messages API. Token usage is added to `usage`.
+
+    Errors are shown in the UI and None is returned, unless `raise_errors` is set
+    (used from worker threads, which cannot write to the page or session state).
+    `force_messages=None` reads the sidebar "Force use of Messages API" toggle.
+    """
+    final_prompt = _format_claude_prompt(_join_prompt(system_prompt, user_prompt))
     # Call Claude API
     try:
-        # Ensure prompt starts with the required Human turn for Claude
-        if not (prompt.startswith("\n\nHuman:") or prompt.startswith("\n\nSystem:") or prompt.startswith("Human:") or prompt.startswith("System:")):
-            final_prompt = f"\n\nHuman: {prompt}\n\nAssistant:"
+        # Save a short preview of the formatted prompt for debugging (visible only on error)
+        if not raise_errors:
+            try:
+                preview = _format_claude_prompt(user_prompt)[:300]
+                # Only store preview if user has enabled prompt debugging
+                if getattr(st.session_state, 'prompt_debug_enabled', False):
+                    setattr(st.session_state, '_debug_prompt_preview', preview)
+            except Exception:
+                # Non-fatal if session state isn't writable in some test contexts
+                # Only store fallback if debugging is conceptually enabled
+                if globals().get('PROMPT_DEBUG_ENABLED_FALLBACK', False):
+                    _debug_prompt_preview = _format_claude_prompt(user_prompt)[:300]
+
+        # Decide whether to use the Completions API or the Messages API
+        if force_messages is None:
+            force_messages = getattr(st.session_state, 'force_messages_api', False)
+        prefer_messages_auto = any(prefix in model_name.lower() for prefix in PREFERRED_MESSAGES_API_FAMILIES)
+        # The Completions API has no image input
+        prefer_messages = force_messages or prefer_messages_auto or bool(images)
+
+        # If preferring messages API (or the model is known to need it), call it directly
+        if prefer_messages or _api_capabilities.get(model_name) == "messages":
+            try:
+                return _messages_request(client, model_name, user_prompt, system_prompt, stream_callback, usage, images)
+            except Exception as e_msg:
+                if raise_errors:
+                    raise
+                # Surface helpful message in the UI
+                st.error(f"Error using Messages API: {str(e_msg)}")
+                return None
+
+        # Otherwise try the completions API first and fall back to messages if needed
+        try:
+            text = _completions_request(client, model_name, final_prompt)
+            _api_capabilities.record(model_name, "completions")
+            return text
+        except Exception as e_comp:
+            # If the model requires the Messages API, fall back and try that
+            msg = str(e_comp)
+            if "Messages API" in msg or "not supported on this API" in msg or "claude-sonnet" in model_name:
+                try:
+                    text = _messages_request(client, model_name, user_prompt, system_prompt, stream_callback, usage)
+                except Exception as e_msg:
+                    # If the fallback fails, raise the original completion error for visibility
+                    raise e_comp from e_msg
+                _api_capabilities.record(model_name, "messages")
+                return text
+            # Re-raise if it's not the messages API case
+            raise
+    except Exception as e:
+        if raise_errors:
+            raise
+        # Show the error and include a prompt preview to help diagnose formatting issues
+        st.error(f"Error generating threat assessment: {str(e)}")
+        preview = getattr(st.session_state, '_debug_prompt_preview', None) if hasattr(st, 'session_state') else None
+        if not preview:
+            # Fallback if session_state wasn't set
+            preview = globals().get('_debug_prompt_preview', None)
+        if preview:
+            st.error(f"Formatted prompt preview (first 300 chars): {repr(preview)}")
         else:
-            final_prompt = prompt
+            st.error("Formatted prompt preview not available")
+        return None
 
-        # Save a short preview of the formatted prompt for debugging (visible only on error)
+def generate_threat_assessment_by_section(project_info, documents_content, framework, risk_areas, api_key, progress_callback=None, use_cache=None, stats=None, usage=None, force_messages=None, raise_errors=False, images=None):
+    """Generate the report as independent parts (SECTION_GROUPS) requested concurrently.
+
+    Parts run on a bounded thread pool, so wall-clock time is bounded by the
+    slowest part instead of one long output stream. The parts are stitched in
+    template order, references are merged into a single REFERENCES section and
+    F###/R###/T### identifiers are reconciled (see `_reconcile_identifiers`).
+
+    `progress_callback(done, total, title)` is called from the calling thread as
+    parts finish. If `stats` is a dict it receives per-part timings and the
+    identifier reconciliation summary; token usage summed over all parts is
+    added to `usage`. Every part receives the `images`. Returns None (after
+    showing the error) if any part fails, or raises when `raise_errors` is set.
+    """
+    if use_cache is None:
+        use_cache = not getattr(st.session_state, 'bypass_response_cache', False)
+    # Worker threads have no Streamlit script context, so read sidebar settings here
+    if force_messages is None:
+        force_messages = getattr(st.session_state, 'force_messages_api', False)
+    cache = get_response_cache()
+    client = get_anthropic_client(api_key)
+    model_name = ASSESSMENT_MODEL
+
+    def generate_part(group_index):
+        started = time.monotonic()
+        system_prompt, user_prompt = build_section_request(
+            project_info, documents_content, framework, risk_areas, group_index
+        )
+        cache_key = response_cache_key(
+            _format_claude_prompt(_join_prompt(system_prompt, user_prompt)), model_name, images
+        )
+        if cache is not None and use_cache:
+            cached = cache.get_text(cache_key)
+            if cached is not None:
+                return cached, time.monotonic() - started, True, {}
+        part_usage = {}
+        text = _request_assessment(
+            client, user_prompt, model_name, force_messages=force_messages, raise_errors=True,
+            system_prompt=system_prompt, usage=part_usage, images=images,
+        )
+        if not text:
+            raise RuntimeError("empty response")
+        if cache is not None:
+            cache.put_text(cache_key, text)
+        return text, time.monotonic() - started, False, part_usage
+
+    started = time.monotonic()
+    parts = [None] * len(SECTION_GROUPS)
+    timings = {}
+    pool = ThreadPoolExecutor(max_workers=max(1, SECTION_WORKERS), thread_name_prefix="report-section")
+    try:
+        futures = {pool.submit(generate_part, i): i for i in range(len(SECTION_GROUPS))}
+        for done, future in enumerate(as_completed(futures), 1):
+            index = futures[future]
+            title = SECTION_GROUPS[index][0]
+            try:
+                parts[index], elapsed, cached, part_usage = future.result()
+            except Exception as e:
+                raise RuntimeError(f"{title}: {e}") from e
+            timings[title] = {"seconds": round(elapsed, 2), "cached": cached}
+            if usage is not None:
+                for field, count in part_usage.items():
+                    usage[field] = usage.get(field, 0) + count
+            if progress_callback:
+                progress_callback(done, len(SECTION_GROUPS), title)
+    except Exception as e:
+        # The report is incomplete without every part: drop queued parts and do not wait for running ones
+        pool.shutdown(wait=False, cancel_futures=True)
+        if raise_errors:
+            raise
+        st.error(f"Error generating threat assessment: {str(e)}")
+        return None
+    pool.shutdown()
+
+    report, reconciliation = stitch_report_sections(parts)
+    if stats is not None:
+        stats.update({
+            "parts": timings,
+            "wall_seconds": round(time.monotonic() - started, 2),
+            **reconciliation,
+        })
+    return report
+
+
+SUMMARY_SYSTEM_PROMPT = """You condense one part of a document uploaded for a security threat assessment into an evidence-preserving digest. The part may itself be a set of earlier digests; merge those without losing their evidence.
+
+Rules:
+- Keep every security-relevant fact: components, data flows, trust boundaries, authentication and authorization, secrets and key handling, data stores and sensitive data, third-party integrations, AI agents and their permissions, network exposure, configuration values and stated gaps or exceptions.
+- Copy the most important statements word for word as quotes in double quotes (at most about 25 words each). Never alter the wording inside quotes and never quote text that is not in the part.
+- Start every point with the location it comes from in square brackets, using the part's own labels, e.g. [Page 12] or [Section: Authentication]. Keep existing location labels of earlier digests unchanged.
+- Drop marketing text, legal boilerplate, tables of contents and anything with no bearing on security.
+- Write terse bullet points and stay within the requested length. Output only the bullet points."""
+
+
+def needs_summaries(documents, project_info, framework, risk_areas):
+    """True when the documents with the rest of the prompt exceed MODEL_CONTEXT_TOKENS."""
+    overhead = estimate_tokens(_join_prompt(*build_assessment_request(project_info, "", framework, risk_areas)))
+    return overhead + estimate_tokens(assemble_documents(documents)) > MODEL_CONTEXT_TOKENS
+
+
+def summary_cache_key(text, model_name, words):
+    """SHA-256 of one chunk's text, the model, the digest length and SUMMARY_VERSION."""
+    digest = hashlib.sha256()
+    digest.update(f"summary\0{SUMMARY_VERSION}\0{model_name}\0{words}\0".encode('utf-8'))
+    digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _pack_paragraphs(text, chunk_tokens):
+    """Split text into chunks of at most about `chunk_tokens`, at paragraph boundaries where possible.
+
+    Unlike `_chunk_document`, chunks run across pages and headings; "[Page N]"
+    markers stay in the text so digests can cite them.
+    """
+    max_chars = max(1, chunk_tokens) * CHARS_PER_TOKEN
+    chunks = []
+    buffer = []
+    size = 0
+    for paragraph in _paragraphs(text):
+        if buffer and size + len(paragraph) > max_chars:
+            chunks.append('\n\n'.join(buffer))
+            buffer, size = [], 0
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind('\n', 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            chunks.append(paragraph[:cut])
+            paragraph = paragraph[cut:].strip('\n')
+        if paragraph:
+            buffer.append(paragraph)
+            size += len(paragraph) + 2
+    if buffer:
+        chunks.append('\n\n'.join(buffer))
+    return chunks
+
+
+def summarize_documents(documents, project_info, framework, risk_areas, api_key, use_cache=True,
+                        force_messages=False, progress_callback=None, usage=None):
+    """Hierarchically summarize the documents that keep the assessment from fitting the model context.
+
+    Every document over SUMMARY_CHUNK_TOKENS is cut into chunks of that size
+    (map). The chunks of all such documents are summarized concurrently, by up
+    to SUMMARY_WORKERS requests, into digests that keep verbatim quotes and
+    [Page N]/section labels (see SUMMARY_SYSTEM_PROMPT). A document's digests
+    are joined in order. If they still exceed the document's share of
+    PROMPT_TOKEN_BUDGET, the joined digest is chunked and summarized again
+    (reduce), for up to SUMMARY_MAX_LEVELS rounds. Smaller documents are kept
+    verbatim.
+
+    Map digests have a fixed length and only the reduce rounds depend on the
+    share, which changes with the project info, framework, risk areas and the
+    other uploads. Every chunk digest is cached in the response cache by its
+    chunk's content hash (see `summary_cache_key`), so re-assessing the same
+    uploads in any setting skips the map phase. `progress_callback(done, total)`
+    is called as chunks finish and token usage is added to `usage`.
+
+    Returns (documents with digests in place of the oversized texts, report).
+    The report lists per summarized document its original and digest tokens,
+    chunk count, rounds, chunk digests taken from the cache and whether it
+    needed no requests at all, plus the request count and wall time.
+    """
+    started = time.monotonic()
+    overhead = estimate_tokens(_join_prompt(*build_assessment_request(project_info, "", framework, risk_areas)))
+    oversized = [i for i, (_, text) in enumerate(documents) if estimate_tokens(text) > SUMMARY_CHUNK_TOKENS]
+    kept = sum(estimate_tokens(text) for i, (_, text) in enumerate(documents) if i not in oversized)
+    share = max(SUMMARY_CHUNK_TOKENS // 4, (PROMPT_TOKEN_BUDGET - overhead - kept) // max(1, len(oversized)))
+    # Map digests get a quarter of their chunk, so every round shrinks the text
+    map_words = max(80, SUMMARY_CHUNK_TOKENS // 4 * 3 // 4)
+    model_name = ASSESSMENT_MODEL
+    cache = get_response_cache() if use_cache else None
+    results = list(documents)
+    report = {"documents": [], "requests": 0, "seconds": 0.0}
+    entries = {}
+    for i in oversized:
+        entries[i] = {"name": documents[i][0], "original_tokens": estimate_tokens(documents[i][1]), "tokens": 0,
+                      "chunks": 0, "levels": 0, "cached_chunks": 0, "cached": True}
+        report["documents"].append(entries[i])
+    if not oversized:
+        report["seconds"] = round(time.monotonic() - started, 2)
+        return results, report
+
+    client = None
+
+    def summarize_chunk(name, chunk, number, count, words):
+        chunk_usage = {}
+        text = _request_assessment(
+            client, f"Document: {name}\nPart {number} of {count}\nLength: at most {words} words\n\n{chunk}",
+            model_name, force_messages=force_messages, raise_errors=True,
+            system_prompt=SUMMARY_SYSTEM_PROMPT, usage=chunk_usage,
+        )
+        if not text:
+            raise RuntimeError(f"empty summary of {name}, part {number}")
+        return text.strip(), chunk_usage
+
+    current = {i: documents[i][1] for i in oversized}
+    done = 0
+    pool = ThreadPoolExecutor(max_workers=max(1, SUMMARY_WORKERS), thread_name_prefix="document-summary")
+    try:
+        while current:
+            chunks = {i: _pack_paragraphs(text, SUMMARY_CHUNK_TOKENS) for i, text in current.items()}
+            total = done + sum(len(parts) for parts in chunks.values())
+            digests = {i: [None] * len(parts) for i, parts in chunks.items()}
+            futures = {}
+            for i, parts in chunks.items():
+                entry = entries[i]
+                # Reduce digests split the document's share of the budget
+                words = map_words if not entry["levels"] else max(
+                    80, min(share // len(parts), SUMMARY_CHUNK_TOKENS // 4) * 3 // 4)
+                for number, chunk in enumerate(parts):
+                    key = summary_cache_key(chunk, model_name, words)
+                    cached = cache.get_text(key) if cache is not None else None
+                    if cached is not None:
+                        digests[i][number] = cached
+                        entry["cached_chunks"] += 1
+                        done += 1
+                        continue
+                    if client is None:
+                        client = get_anthropic_client(api_key)
+                    future = pool.submit(summarize_chunk, documents[i][0], chunk, number + 1, len(parts), words)
+                    futures[future] = (i, number, key)
+                    entry["cached"] = False
+            if progress_callback and done:
+                progress_callback(done, total)
+            for future in as_completed(futures):
+                i, number, key = futures[future]
+                digests[i][number], chunk_usage = future.result()
+                if cache is not None:
+                    cache.put_text(key, digests[i][number])
+                if usage is not None:
+                    for field, count in chunk_usage.items():
+                        usage[field] = usage.get(field, 0) + count
+                done += 1
+                if progress_callback:
+                    progress_callback(done, total)
+            report["requests"] += len(futures)
+            for i, parts in digests.items():
+                entry = entries[i]
+                digest = "\n\n".join(parts)
+                entry["levels"] += 1
+                entry["chunks"] = entry["chunks"] or len(parts)
+                if estimate_tokens(digest) > share and len(parts) > 1 and entry["levels"] < SUMMARY_MAX_LEVELS:
+                    current[i] = digest
+                    continue
+                del current[i]
+                digest = (
+                    f"(Digest of a {entry['original_tokens']:,}-token document in {entry['levels']} summary "
+                    f"round{'s' if entry['levels'] > 1 else ''}; quoted text is verbatim from the document.)\n\n{digest}"
+                )
+                results[i] = (documents[i][0], digest)
+                entry["tokens"] = estimate_tokens(digest)
+    except Exception:
+        # Finished digests are cached; drop the queued chunks and do not wait for running ones
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+    report["seconds"] = round(time.monotonic() - started, 2)
+    return results, report
+
+
+# Report section that defines each identifier family; other sections only reference them
+IDENTIFIER_OWNERS = {"F": "risk_matrix", "R": "recommendations", "T": "threat_modeling"}
+
+_ID_TOKEN = re.compile(r'\b([FRT])(\d{3})\b')
+# An identifier is defined by the first cell of a table row, e.g. "| F001 | ..." or "| **R010** | ..."
+_ID_DEFINITION = re.compile(r'(?m)^\|\s*\**([FRT]\d{3})\**\s*\|')
+
+
+def _split_references(part_md):
+    """Remove a REFERENCES section from `part_md`; return (remaining markdown, reference lines)."""
+    lines = part_md.splitlines()
+    for i, line in enumerate(lines):
+        if line.strip().upper().startswith(('## REFERENCES', '# REFERENCES')):
+            end = len(lines)
+            for j in range(i + 1, len(lines)):
+                if lines[j].startswith('#'):
+                    end = j
+                    break
+            refs = [l.strip() for l in lines[i + 1:end] if l.strip()]
+            return '\n'.join(lines[:i] + lines[end:]), refs
+    return part_md, []
+
+
+def _reconcile_identifiers(parts):
+    """Make F###/R###/T### identifiers consistent across independently generated parts.
+
+    Each identifier family is defined by one section (IDENTIFIER_OWNERS). In the
+    part containing that section, a repeated definition (the same ID in the first
+    cell of two table rows, e.g. T001 restarted per category table) is renumbered
+    to the next free number, so every definition in the stitched report is
+    unique. References to a repeated ID within that part are rewritten to the
+    nearest definition before them; references from other parts cannot be told
+    apart and are reported as ambiguous. IDs referenced elsewhere but never
+    defined by their owning section are reported as dangling. Returns (parts,
+    summary).
+    """
+    owner_part = {}
+    for prefix, key in IDENTIFIER_OWNERS.items():
+        for index, (_, keys) in enumerate(SECTION_GROUPS):
+            if key in keys:
+                owner_part[prefix] = index
+
+    used = {prefix: set() for prefix in "FRT"}
+    for part in parts:
+        for prefix, number in _ID_TOKEN.findall(part):
+            used[prefix].add(int(number))
+
+    defined = set()
+    renumbered = []
+    reconciled = []
+    for index, part in enumerate(parts):
+        owned = {prefix for prefix, owner in owner_part.items() if owner == index}
+        if not owned:
+            reconciled.append(part)
+            continue
+
+        # Definition start -> assigned ID, and per ID the (start, assigned ID) of its definitions in order
+        assigned = {}
+        definitions = {}
+        for match in _ID_DEFINITION.finditer(part):
+            ident = match.group(1)
+            if ident[0] not in owned:
+                continue
+            new_ident = ident
+            if ident in defined:
+                number = max(used[ident[0]]) + 1
+                used[ident[0]].add(number)
+                new_ident = f"{ident[0]}{number:03d}"
+                renumbered.append((ident, new_ident))
+            defined.add(new_ident)
+            assigned[match.start(1)] = new_ident
+            definitions.setdefault(ident, []).append((match.start(1), new_ident))
+
+        def resolve(match):
+            if match.start() in assigned:
+                return assigned[match.start()]
+            candidates = definitions.get(match.group(0))
+            if not candidates or len(candidates) == 1:
+                return match.group(0)
+            starts = [start for start, _ in candidates]
+            return candidates[max(0, bisect.bisect_right(starts, match.start()) - 1)][1]
+
+        reconciled.append(_ID_TOKEN.sub(resolve, part))
+
+    repeated = {old for old, _ in renumbered}
+    referenced = set()
+    ambiguous = set()
+    for index, part in enumerate(reconciled):
+        for match in _ID_TOKEN.finditer(part):
+            ident = match.group(0)
+            referenced.add(ident)
+            if ident in repeated and owner_part.get(ident[0]) != index:
+                ambiguous.add(ident)
+    dangling = sorted(ident for ident in referenced if ident not in defined and ident[0] in owner_part)
+    return reconciled, {"renumbered_ids": renumbered, "dangling_ids": dangling, "ambiguous_ids": sorted(ambiguous)}
+
+
+def stitch_report_sections(parts):
+    """Join independently generated report parts into one report.
+
+    Text before each part's first heading is dropped, REFERENCES sections are
+    merged into one at the end and identifiers are reconciled. Returns
+    (report markdown, reconciliation summary).
+    """
+    bodies = []
+    references = []
+    for part in parts:
+        part = part or ""
+        first_heading = re.search(r'(?m)^#', part)
+        if first_heading:
+            part = part[first_heading.start():]
+        part, refs = _split_references(part)
+        references.extend(refs)
+        bodies.append(part.strip())
+
+    bodies, summary = _reconcile_identifiers(bodies)
+    report = "\n\n".join(body for body in bodies if body) + "\n"
+    if references:
+        report += "\n## REFERENCES\n" + "\n".join(dict.fromkeys(references)) + "\n"
+    return report, summary
+
+
+# Background assessment jobs: concurrent generations across all sessions
+JOB_WORKERS = int(os.environ.get('SECUREAI_JOB_WORKERS', 4))
+# Finished jobs are kept this long so a reconnecting session can still collect the result
+JOB_RESULT_TTL_SECONDS = float(os.environ.get('SECUREAI_JOB_RESULT_TTL_SECONDS', 3600))
+
+
+class AssessmentJob:
+    """State of one background assessment, written by its worker thread and read by the UI."""
+
+    def __init__(self, job_id, description=""):
+        self.id = job_id
+        self.description = description
+        self.status = "queued"
+        self.progress = 0.0
+        self.message = "Waiting for a free worker..."
+        self.result = None
+        self.error = None
+        self.details = {}
+        self.created_at = time.time()
+        self.finished_at = None
+        self._streamed = []
+        self._lock = threading.Lock()
+
+    def update(self, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    def append_text(self, delta):
+        """Stream callback: collect report text as it arrives."""
+        with self._lock:
+            self._streamed.append(delta)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "description": self.description,
+                "status": self.status,
+                "progress": self.progress,
+                "message": self.message,
+                "result": self.result,
+                "error": self.error,
+                "details": dict(self.details),
+                "streamed": "".join(self._streamed),
+                "elapsed": (self.finished_at or time.time()) - self.created_at,
+            }
+
+
+class AssessmentJobManager:
+    """Runs assessment jobs on a thread pool and keeps their state by job ID.
+
+    Generation runs outside the Streamlit script thread, so reruns, widget
+    interactions and browser refreshes do not interrupt it; the UI polls the
+    job and a reconnecting session can reattach by job ID.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, result_ttl=JOB_RESULT_TTL_SECONDS):
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="assessment-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, description="", **kwargs):
+        """Queue `fn(job, **kwargs)`; its return value becomes the job result. Returns the job ID."""
+        job = AssessmentJob(uuid.uuid4().hex, description)
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, kwargs)
+        return job.id
+
+    def _run(self, job, fn, kwargs):
+        job.update(status="running", message="🤖 Generating threat assessment with SecureAI...")
         try:
-            preview = final_prompt[:300]
-            # Only store preview if user has enabled prompt debugging
-            if getattr(st.session_state, 'prompt_debug_enabled', False):
-                setattr(st.session_state, '_debug_prompt_preview', preview)
-        except Exception:
-            # Non-fatal if session state isn't writable in some test contexts
-            # Only store fallback if debugging is conceptually enabled
-            if globals().get('PROMPT_DEBUG_ENABLED_FALLBACK', False):
-                _debug_prompt_preview = final_prompt[:300]
+            result = fn(job, **kwargs)
+        except Exception as e:
+            job.update(status="failed", error=str(e), finished_at=time.time())
+        else:
+            job.update(status="done", result=result, progress=1.0, finished_at=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _expire(self):
+        cutoff = time.time() - self.result_ttl
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ("queued", "running", "done", "failed")}
+
+
+@_process_resource
+def _shared_job_manager():
+    return AssessmentJobManager()
+
+
+_job_manager = _shared_job_manager()
+
+
+def run_assessment_job(job, project_info, documents_content, framework, risk_areas, api_key,
+                       parallel_sections=False, stream=True, use_cache=True, force_messages=False, images=None,
+                       documents=None, summarize=False):
+    """Job body for AssessmentJobManager: generate the report, augment its references and verify its evidence.
+
+    Runs in a worker thread, so every sidebar setting is passed in explicitly.
+    Progress, streamed text, section statistics, token usage and evidence
+    verification statistics are published on `job` for the UI to poll.
+    `documents` is [(file name, extracted text)] of the uploads, for
+    `verify_evidence`. With `summarize` (see `needs_summaries`) the oversized
+    documents are first reduced to digests by `summarize_documents`, and
+    `documents_content` is rebuilt from them.
+    """
+    usage = {}
+    summaries = None
+    if summarize and documents:
+        job.update(message="📚 Summarizing documents that exceed the model context...")
+
+        def summary_progress(done, total):
+            job.update(progress=done / total, message=f"📚 Summarized {done}/{total} document chunks...")
+
+        digests, summaries = summarize_documents(
+            documents, project_info, framework, risk_areas, api_key, use_cache=use_cache,
+            force_messages=force_messages, progress_callback=summary_progress, usage=usage,
+        )
+        documents_content, _ = compact_documents(digests, project_info, framework, risk_areas)
+        job.update(progress=0.0, details={"summaries": summaries, "usage": usage})
+    if parallel_sections:
+        section_stats = {}
+
+        def section_progress(done, total, title):
+            job.update(progress=done / total, message=f"🧩 Generated {title} ({done}/{total} parts)...")
+
+        report = generate_threat_assessment_by_section(
+            project_info, documents_content, framework, risk_areas, api_key,
+            progress_callback=section_progress, use_cache=use_cache, stats=section_stats, usage=usage,
+            force_messages=force_messages, raise_errors=True, images=images,
+        )
+        job.update(details={"section_stats": section_stats, "usage": usage, "summaries": summaries})
+    else:
+        report = generate_threat_assessment(
+            project_info, documents_content, framework, risk_areas, api_key,
+            stream_callback=job.append_text if stream else None, use_cache=use_cache, usage=usage,
+            force_messages=force_messages, raise_errors=True, images=images,
+        )
+        job.update(details={"usage": usage, "summaries": summaries})
+    if not report:
+        raise RuntimeError("empty response")
 
-        # Decide whether to use the Completions API or the Messages API
-        model_name = "claude-sonnet-4-20250514"
-        prefer_messages_auto = any(prefix in model_name.lower() for prefix in PREFERRED_MESSAGES_API_FAMILIES)
-        prefer_messages = getattr(st.session_state, 'force_messages_api', False) or prefer_messages_auto
+    # Augment references automatically when possible
+    try:
+        suggestions = _suggest_references_from_text(report)
+        report = _merge_references_section(report, suggestions)
+    except Exception:
+        # Non-fatal if augmentation errors
+        pass
 
-        # If preferring messages API, call it directly
-        if prefer_messages:
-            try:
-                content = final_prompt
-                if content.startswith("\n\nHuman:"):
-                    content = content.split("Human:", 1)[1].lstrip()
-                elif content.startswith("\n\nSystem:"):
-                    content = content.split("System:", 1)[1].lstrip()
-
-                messages = [{"role": "user", "content": content}]
-
-                resp = client.beta.messages.create(
-                    model=model_name,
-                    messages=messages,
-                    max_tokens=16000,
-                    temperature=0,
-                )
+    if documents:
+        job.update(message="🔎 Verifying quoted evidence against the uploaded documents...")
+        report, evidence = verify_evidence(report, documents)
+        job.update(details=dict(job.details, evidence=evidence))
+    return report
 
-                # Try to extract text content from common response shapes
-                def _extract_message_text(resp_obj):
-                    # Handle Claude API Message object with content blocks
-                    if hasattr(resp_obj, 'content'):
-                        content = resp_obj.content
-                        # content is a list of ContentBlock objects
-                        if isinstance(content, list):
-                            text_parts = []
-                            for block in content:
-                                # Each ContentBlock has a 'text' attribute
-                                if hasattr(block, 'text'):
-                                    text_parts.append(block.text)
-                                elif isinstance(block, dict) and 'text' in block:
-                                    text_parts.append(block['text'])
-                                elif isinstance(block, str):
-                                    text_parts.append(block)
-                            if text_parts:
-                                return "".join(text_parts)
-                        # content might be a string directly
-                        elif isinstance(content, str):
-                            return content
-                    
-                    # Check other common attributes
-                    for attr in ("message", "output", "completion"):
-                        if hasattr(resp_obj, attr):
-                            candidate = getattr(resp_obj, attr)
-                            # dict-like
-                            if isinstance(candidate, dict):
-                                # common nested patterns
-                                for key in ("text", "content", "parts", "output_text"):
-                                    if key in candidate:
-                                        val = candidate[key]
-                                        if isinstance(val, list):
-                                            return "".join(map(str, val))
-                                        if isinstance(val, str):
-                                            return val
-                                # fallback to string
-                                return str(candidate)
-                            # object-like
-                            if isinstance(candidate, str):
-                                return candidate
-                    
-                    # resp_obj might be a dict
-                    if isinstance(resp_obj, dict):
-                        for key in ("text", "content", "completion", "message"):
-                            if key in resp_obj:
-                                v = resp_obj[key]
-                                if isinstance(v, str):
-                                    return v
-                                if isinstance(v, list):
-                                    return "".join(map(str, v))
-                                if isinstance(v, dict):
-                                    # nested
-                                    for k in ("text", "content"):
-                                        if k in v and isinstance(v[k], str):
-                                            return v[k]
-                    # fallback
-                    return str(resp_obj)
-
-                return _extract_message_text(resp)
-            except Exception as e_msg:
-                # Surface helpful message in the UI
-                st.error(f"Error using Messages API: {str(e_msg)}")
-                return None
 
-        # Otherwise try the completions API first and fall back to messages if needed
-        try:
-            completion = client.completions.create(
-                model=model_name,
-                prompt=final_prompt,
-                max_tokens_to_sample=16000,
-                temperature=0,
-            )
+def _get_job_query_param():
+    """Job ID carried in the page URL, so a refreshed or reconnected browser can reattach."""
+    try:
+        if hasattr(st, 'query_params'):
+            return st.query_params.get('job')
+        return (st.experimental_get_query_params().get('job') or [None])[0]
+    except Exception:
+        return None
 
-            # The Completion object exposes the generated text on `.completion`
-            return getattr(completion, "completion", str(completion))
-        except Exception as e_comp:
-            # If the model requires the Messages API, fall back and try that
-            msg = str(e_comp)
-            if "Messages API" in msg or "not supported on this API" in msg or "claude-sonnet" in model_name:
-                try:
-                    # Convert the final_prompt into a single user message for the Messages API
-                    content = final_prompt
-                    # strip leading human/system prefixes that were used for the completions endpoint
-                    if content.startswith("\n\nHuman:"):
-                        content = content.split("Human:", 1)[1].lstrip()
-                    elif content.startswith("\n\nSystem:"):
-                        content = content.split("System:", 1)[1].lstrip()
-
-                    messages = [{"role": "user", "content": content}]
-
-                    # Use the beta messages API
-                    resp = client.beta.messages.create(
-                        model=model_name,
-                        messages=messages,
-                        max_tokens=16000,
-                        temperature=0,
-                    )
 
-                    # Try to extract text content from common response shapes
-                    def _extract_message_text(resp_obj):
-                        # Handle Claude API Message object with content blocks
-                        if hasattr(resp_obj, 'content'):
-                            content = resp_obj.content
-                            # content is a list of ContentBlock objects
-                            if isinstance(content, list):
-                                text_parts = []
-                                for block in content:
-                                    # Each ContentBlock has a 'text' attribute
-                                    if hasattr(block, 'text'):
-                                        text_parts.append(block.text)
-                                    elif isinstance(block, dict) and 'text' in block:
-                                        text_parts.append(block['text'])
-                                    elif isinstance(block, str):
-                                        text_parts.append(block)
-                                if text_parts:
-                                    return "".join(text_parts)
-                            # content might be a string directly
-                            elif isinstance(content, str):
-                                return content
-                        
-                        # Check other common attributes
-                        for attr in ("message", "output", "completion"):
-                            if hasattr(resp_obj, attr):
-                                candidate = getattr(resp_obj, attr)
-                                # dict-like
-                                if isinstance(candidate, dict):
-                                    # common nested patterns
-                                    for key in ("text", "content", "parts", "output_text"):
-                                        if key in candidate:
-                                            val = candidate[key]
-                                            if isinstance(val, list):
-                                                return "".join(map(str, val))
-                                            if isinstance(val, str):
-                                                return val
-                                    # fallback to string
-                                    return str(candidate)
-                                # object-like
-                                if isinstance(candidate, str):
-                                    return candidate
-                        
-                        # resp_obj might be a dict
-                        if isinstance(resp_obj, dict):
-                            for key in ("text", "content", "completion", "message"):
-                                if key in resp_obj:
-                                    v = resp_obj[key]
-                                    if isinstance(v, str):
-                                        return v
-                                    if isinstance(v, list):
-                                        return "".join(map(str, v))
-                                    if isinstance(v, dict):
-                                        # nested
-                                        for k in ("text", "content"):
-                                            if k in v and isinstance(v[k], str):
-                                                return v[k]
-                        # fallback
-                        return str(resp_obj)
-
-                    return _extract_message_text(resp)
-                except Exception as e_msg:
-                    # If the fallback fails, raise the original completion error for visibility
-                    raise e_comp from e_msg
-            # Re-raise if it's not the messages API case
-            raise
-    except Exception as e:
-        # Show the error and include a prompt preview to help diagnose formatting issues
-        st.error(f"Error generating threat assessment: {str(e)}")
-        preview = getattr(st.session_state, '_debug_prompt_preview', None) if hasattr(st, 'session_state') else None
-        if not preview:
-            # Fallback if session_state wasn't set
-            preview = globals().get('_debug_prompt_preview', None)
-        if preview:
-            st.error(f"Formatted prompt preview (first 300 chars): {repr(preview)}")
+def _set_job_query_param(job_id):
+    try:
+        if hasattr(st, 'query_params'):
+            if job_id:
+                st.query_params['job'] = job_id
+            elif 'job' in st.query_params:
+                del st.query_params['job']
         else:
-            st.error("Formatted prompt preview not available")
-        return None
+            st.experimental_set_query_params(**({'job': job_id} if job_id else {}))
+    except Exception:
+        pass
+
 
 def _pdf_support_status():
     """Return (supported: bool, reason: str)."""
@@ -1048,88 +3857,104 @@ def pdf_bytes_to_data_uri(pdf_bytes: bytes) -> str:
     return f"data:application/pdf;base64,{b64}"
 
 
+@_process_resource
+def _shared_report_html_cache():
+    return MemoryLRUCache(REPORT_HTML_CACHE_MAX_BYTES)
+
+
+_report_html_cache = _shared_report_html_cache()
+
+
+def report_html(report_content):
+    """The report converted to HTML by `render_worker.convert_markdown`, once per report version.
+
+    Conversions are cached by a hash of the markdown, so the preview and the
+    PDF exporters share one conversion per report, across reruns.
+    """
+    key = hashlib.sha256((report_content or "").encode('utf-8')).hexdigest()
+    converted = _report_html_cache.get(key)
+    if converted is None:
+        converted = render_worker.convert_markdown(report_content)
+        _report_html_cache.put(key, converted)
+    return converted
+
+
 def markdown_to_html(md_text: str) -> str:
     """Convert markdown to HTML using python-markdown (safe fallback if available)."""
-    try:
-        import markdown as _markdown  # type: ignore
-        md = _markdown.Markdown(extensions=["tables", "fenced_code", "toc"])
-        html_body = md.convert(md_text or "")
-        # Simple wrapper for consistent preview styling
-        return f"<div style='font-family: Arial, Helvetica, sans-serif; line-height:1.4; color:#222'>{html_body}</div>"
-    except Exception:
-        # If python-markdown isn't available, do a very small fallback
-        escaped = (md_text or "").replace("<", "&lt;").replace(">", "&gt;")
-        return f"<pre style='white-space: pre-wrap;'>{escaped}</pre>"
-
-
-def clean_markdown_artifacts(html_text):
-    """Clean up common markdown artifacts from HTML output."""
-    import re
-    # Remove literal \n sequences that appear as text
-    html_text = html_text.replace('\\n', ' ')
-    # Remove markdown link syntax that might not have been converted
-    html_text = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'<a href="\2">\1</a>', html_text)
-    # Clean up double spaces
-    html_text = re.sub(r'  +', ' ', html_text)
-    return html_text
-
-
-def apply_risk_styling(html_text):
-    """Apply color styling to risk level indicators in HTML."""
-    import re
-    
-    # Style CRITICAL risk levels with red
-    html_text = re.sub(
-        r'\b(CRITICAL|Critical)\b',
-        r'<span class="risk-critical">\1</span>',
-        html_text
-    )
-    
-    # Style HIGH risk levels with orange
-    html_text = re.sub(
-        r'\b(HIGH|High)\b',
-        r'<span class="risk-high">\1</span>',
-        html_text
-    )
-    
-    # Style MEDIUM risk levels with yellow
-    html_text = re.sub(
-        r'\b(MEDIUM|Medium)\b',
-        r'<span class="risk-medium">\1</span>',
-        html_text
-    )
-    
-    # Style LOW risk levels with green
-    html_text = re.sub(
-        r'\b(LOW|Low)\b',
-        r'<span class="risk-low">\1</span>',
-        html_text
-    )
-    
-    # Style priority indicators
-    html_text = re.sub(
-        r'\b(P0)\b',
-        r'<span class="priority-critical">\1</span>',
-        html_text
-    )
-    
-    html_text = re.sub(
-        r'\b(P1)\b',
-        r'<span class="priority-high">\1</span>',
-        html_text
-    )
-    
-    return html_text
+    converted = report_html(md_text)
+    if converted.error:
+        # If python-markdown isn't available, show the escaped markdown
+        return converted.html.replace("<pre>", "<pre style='white-space: pre-wrap;'>", 1)
+    # Simple wrapper for consistent preview styling
+    return f"<div style='font-family: Arial, Helvetica, sans-serif; line-height:1.4; color:#222'>{converted.html}</div>"
+
+
+def report_branding():
+    """Branding for exported reports, taken from the sidebar settings of the current session."""
+    return {
+        'logo_image': getattr(st.session_state, 'logo_image', None),
+        'company_name': getattr(st.session_state, 'company_name', "") or "",
+        'report_footer': getattr(st.session_state, 'report_footer', "") or "",
+    }
+
+
+def pdf_cache_key(report_content, branding):
+    """Key of a rendered PDF: the report, the branding, the renderer version and the day it is dated."""
+    digest = hashlib.sha256()
+    for part in (
+        str(PDF_RENDERER_VERSION),
+        datetime.now().strftime('%Y-%m-%d'),
+        report_content or "",
+        hashlib.sha256(branding.get('logo_image') or b"").hexdigest(),
+        branding.get('company_name') or "",
+        branding.get('report_footer') or "",
+    ):
+        digest.update(part.encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+@_process_resource
+def _shared_pdf_cache():
+    # Values are (PDF bytes, WeasyPrint error or None); only the PDF counts towards the limit
+    return MemoryLRUCache(PDF_CACHE_MAX_BYTES, sizeof=lambda entry: len(entry[0]))
+
+
+_pdf_cache = _shared_pdf_cache()
+
+
+@_process_resource
+def _shared_render_pool():
+    if PDF_RENDER_WORKERS <= 0:
+        return None
+    return render_worker.RenderPool(PDF_RENDER_WORKERS, memory_bytes=PDF_RENDER_MEMORY_BYTES)
+
+
+def get_render_pool():
+    """Return the process-wide RenderPool, or None if PDF_RENDER_WORKERS is 0.
+
+    Created on the first render, so importing the app (tests, batch_assess)
+    sets up no pool.
+    """
+    return _shared_render_pool()
 
 
-def create_pdf_download(report_content, project_name):
+def create_pdf_download(report_content, project_name, branding=None):
     """Create a PDF download (preferred) and a markdown fallback.
 
-    Tries to render the markdown report to PDF using WeasyPrint. If the
-    required packages or system libraries are not available, falls back to
-    returning the raw markdown and a `.md` filename. When running in the
-    Streamlit app, diagnostic details are stored in `st.session_state['_pdf_error']`.
+    Returns the PDF rendered by `render_worker.render_pdf` in the render
+    pool from the shared `report_html` conversion, or the raw markdown and a
+    `.md` filename if no PDF engine is available. When running in the
+    Streamlit app, diagnostic details are stored in
+    `st.session_state['_pdf_error']`. Rendered PDFs are kept in a
+    process-wide LRU cache keyed by `pdf_cache_key`, so reruns of the results
+    page do not render the report again.
+
+    `branding` (logo_image, company_name, report_footer) defaults to the current
+    session's sidebar settings; pass it explicitly outside a Streamlit session.
     """
+    if branding is None:
+        branding = report_branding()
     base = f"Threat_Assessment_{project_name.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}"
     pdf_filename = f"{base}.pdf"
     md_filename = f"{base}.md"
@@ -1141,652 +3966,32 @@ def create_pdf_download(report_content, project_name):
     except Exception:
         pass
 
-    # Try to convert markdown -> HTML -> PDF using WeasyPrint (optional dependency)
-    try:
-        import markdown as _markdown  # optional
-        from weasyprint import HTML  # optional
-
-        # Build logo HTML if available
-        logo_html = ""
-        if st.session_state.logo_image:
-            try:
-                logo_b64 = base64.b64encode(st.session_state.logo_image).decode()
-                logo_html = f'<img src="data:image/png;base64,{logo_b64}" style="max-width: 120px; height: auto;">'
-            except Exception:
-                pass
-
-        # Use python-markdown with toc extension to generate a Table of Contents
-        md = _markdown.Markdown(extensions=["tables", "fenced_code", "toc"])
-        html_body = md.convert(report_content or "")
-        html_body = clean_markdown_artifacts(html_body)
-        html_body = apply_risk_styling(html_body)  # Apply color styling to risk levels
-        toc_html = md.toc if hasattr(md, 'toc') else ''
-        toc_html = clean_markdown_artifacts(toc_html)
-
-        company_header = st.session_state.company_name or "Threat Assessment"
-        footer_text = st.session_state.report_footer or f"Generated {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-
-        full_html = f"""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>{company_header} - Threat Assessment</title>
-            <style>
-                * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-                
-                /* Page setup */
-                @page {{ 
-                    size: A4; 
-                    margin: 2cm 2cm 2.5cm 2cm;
-                    @bottom-left {{ 
-                        content: "{footer_text}"; 
-                        font-size: 9pt; 
-                        color: #666; 
-                    }}
-                    @bottom-right {{ 
-                        content: "Page " counter(page) " of " counter(pages); 
-                        font-size: 9pt; 
-                        color: #666; 
-                    }}
-                }}
-                @page :first {{ margin-top: 2.5cm; }}
-                
-                html {{ 
-                    width: 100%; 
-                }}
-                
-                body {{ 
-                    width: 100%;
-                    min-height: 100%;
-                    font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', 'Roboto', 'Oxygen', 'Ubuntu', sans-serif;
-                    font-size: 11pt;
-                    line-height: 1.5;
-                    color: #1a202c;
-                    background: white;
-                    padding: 0;
-                    margin: 0;
-                }}
-                
-                /* Header section */
-                .doc-header {{
-                    border-bottom: 3px solid #2d3748;
-                    padding: 1.5rem 0;
-                    margin-bottom: 2rem;
-                    display: flex;
-                    justify-content: space-between;
-                    align-items: flex-start;
-                }}
-                
-                .logo-section {{ flex: 0 0 auto; }}
-                .logo-section img {{ max-width: 100px; height: auto; }}
-                
-                .title-section {{ 
-                    flex: 1; 
-                    text-align: center;
-                    padding: 0 2rem;
-                }}
-                
-                .title-section h1 {{
-                    font-size: 28pt;
-                    color: #1a202c;
-                    margin: 0 0 0.5rem 0;
-                    font-weight: 700;
-                }}
-                
-                .title-section p {{
-                    font-size: 12pt;
-                    color: #666;
-                    margin: 0;
-                }}
-                
-                .date-section {{
-                    flex: 0 0 auto;
-                    text-align: right;
-                    font-size: 10pt;
-                    color: #666;
-                }}
-                
-                /* Table of Contents */
-                .toc-container {{
-                    background: #f7fafc;
-                    border-left: 4px solid #2d3748;
-                    padding: 1.5rem;
-                    margin: 2rem 0;
-                    page-break-inside: avoid;
-                    border-radius: 4px;
-                }}
-                
-                .toc-container h2 {{
-                    font-size: 14pt;
-                    margin: 0 0 1rem 0;
-                    color: #1a202c;
-                }}
-                
-                .toc-container ul {{
-                    list-style: none;
-                    padding: 0;
-                    margin: 0;
-                }}
-                
-                .toc-container li {{
-                    margin: 0.4rem 0;
-                    padding-left: 1.5rem;
-                }}
-                
-                .toc-container a {{
-                    color: #2c5282;
-                    text-decoration: none;
-                    font-size: 10pt;
-                }}
-                
-                /* Main content */
-                main {{
-                    padding: 0;
-                }}
-                
-                /* Headings with page break control */
-                h1 {{ 
-                    font-size: 22pt;
-                    color: #1a202c;
-                    margin: 3rem 0 1.5rem 0;
-                    padding: 0.8rem 0 0.5rem 0;
-                    border-bottom: 3px solid #2d3748;
-                    page-break-before: always;
-                    page-break-after: avoid;
-                    font-weight: 700;
-                    letter-spacing: 0.5px;
-                }}
-                
-                h1:first-of-type {{
-                    page-break-before: avoid;
-                    margin-top: 0;
-                }}
-                
-                h2 {{ 
-                    font-size: 16pt;
-                    color: #2d3748;
-                    margin: 2.2rem 0 1rem 0;
-                    padding-top: 0.8rem;
-                    padding-bottom: 0.3rem;
-                    border-bottom: 2px solid #cbd5e0;
-                    page-break-after: avoid;
-                    font-weight: 700;
-                }}
-                
-                h3 {{ 
-                    font-size: 13pt;
-                    color: #2c5282;
-                    margin: 1.5rem 0 0.8rem 0;
-                    padding-top: 0.5rem;
-                    page-break-after: avoid;
-                    font-weight: 700;
-                }}
-                
-                h4 {{ 
-                    font-size: 11.5pt;
-                    color: #4a5568;
-                    margin: 1.2rem 0 0.6rem 0;
-                    page-break-after: avoid;
-                    font-weight: 600;
-                }}
-                
-                h5, h6 {{
-                    font-size: 10.5pt;
-                    color: #4a5568;
-                    margin: 1rem 0 0.5rem 0;
-                    page-break-after: avoid;
-                    font-weight: 600;
-                }}
-                
-                /* Paragraphs with proper spacing */
-                p {{
-                    margin: 1rem 0;
-                    text-align: justify;
-                    line-height: 1.6;
-                    orphans: 3;
-                    widows: 3;
-                }}
-                
-                /* Lists with proper spacing */
-                ul, ol {{
-                    margin: 1.2rem 0;
-                    padding-left: 2.2rem;
-                }}
-                
-                li {{
-                    margin: 0.6rem 0;
-                    padding-left: 0.4rem;
-                    line-height: 1.5;
-                }}
-                
-                ul ul, ol ol, ul ol, ol ul {{
-                    margin: 0.6rem 0;
-                    padding-left: 2rem;
-                }}
-                
-                /* Tables with professional styling */
-                table {{
-                    width: 100%;
-                    max-width: 100%;
-                    border-collapse: collapse;
-                    margin: 1.6rem 0;
-                    page-break-inside: auto;
-                    font-size: 8pt;
-                    background: white;
-                    table-layout: fixed;
-                }}
-                
-                table tr {{
-                    page-break-inside: avoid;
-                    page-break-after: auto;
-                }}
-                
-                table, th, td {{
-                    border: 1px solid #cbd5e0;
-                }}
-                
-                th {{
-                    background: #2d3748;
-                    color: white;
-                    padding: 0.55rem 0.5rem;
-                    text-align: left;
-                    font-weight: 700;
-                    font-size: 8pt;
-                    word-wrap: break-word;
-                    overflow-wrap: anywhere;
-                    max-width: 110px;
-                }}
-                
-                td {{
-                    padding: 0.45rem 0.55rem;
-                    vertical-align: top;
-                    line-height: 1.35;
-                    word-wrap: break-word;
-                    overflow-wrap: anywhere;
-                    max-width: 110px;
-                }}
-                
-                tbody tr:nth-child(odd) {{ 
-                    background: #f7fafc; 
-                }}
-                
-                tbody tr:nth-child(even) {{
-                    background: white;
-                }}
-                
-                tbody tr:hover {{
-                    background: #edf2f7;
-                }}
-                
-                /* Risk level styling in tables */
-                td:contains('CRITICAL'), 
-                td:contains('Critical') {{
-                    color: #c53030;
-                    font-weight: 700;
-                }}
-                
-                td:contains('HIGH'),
-                td:contains('High') {{
-                    color: #d97706;
-                    font-weight: 700;
-                }}
-                
-                td:contains('MEDIUM'),
-                td:contains('Medium') {{
-                    color: #d69e2e;
-                    font-weight: 700;
-                }}
-                
-                td:contains('LOW'),
-                td:contains('Low') {{
-                    color: #22543d;
-                    font-weight: 600;
-                }}
-                
-                /* Code blocks with better styling */
-                pre {{
-                    background: #1e293b;
-                    color: #e2e8f0;
-                    padding: 1.2rem;
-                    border-radius: 5px;
-                    margin: 1.5rem 0;
-                    overflow-x: auto;
-                    page-break-inside: avoid;
-                    font-size: 8.5pt;
-                    line-height: 1.5;
-                    font-family: 'Courier New', 'Consolas', monospace;
-                    white-space: pre-wrap;
-                    word-wrap: break-word;
-                    border-left: 4px solid #3b82f6;
-                }}
-                
-                pre code {{
-                    background: none;
-                    color: #e2e8f0;
-                    padding: 0;
-                    border-radius: 0;
-                    font-size: 8.5pt;
-                    font-weight: 400;
-                }}
-                
-                code {{
-                    background: #f1f5f9;
-                    color: #d97706;
-                    padding: 2px 6px;
-                    border-radius: 3px;
-                    font-family: 'Courier New', 'Consolas', monospace;
-                    font-size: 9pt;
-                    font-weight: 500;
-                }}
-                
-                /* Risk levels and emphasis */
-                strong, b {{
-                    font-weight: 700;
-                    color: #1a202c;
-                }}
-                
-                em, i {{
-                    font-style: italic;
-                    color: #4a5568;
-                }}
-                
-                /* Risk level styling with color-coding */
-                .risk-critical {{
-                    color: #c53030;
-                    font-weight: 700;
-                    background: #fdf2f2;
-                    padding: 2px 6px;
-                    border-radius: 3px;
-                }}
-                
-                .risk-high {{
-                    color: #d97706;
-                    font-weight: 700;
-                    background: #fffbf0;
-                    padding: 2px 6px;
-                    border-radius: 3px;
-                }}
-                
-                .risk-medium {{
-                    color: #d69e2e;
-                    font-weight: 700;
-                    background: #fffaf0;
-                    padding: 2px 6px;
-                    border-radius: 3px;
-                }}
-                
-                .risk-low {{
-                    color: #22543d;
-                    font-weight: 600;
-                    background: #f0fdf4;
-                    padding: 2px 6px;
-                    border-radius: 3px;
-                }}
-                
-                /* Priority styling */
-                .priority-critical {{
-                    color: #c53030;
-                    font-weight: 700;
-                    background: #fdf2f2;
-                    padding: 2px 6px;
-                    border-radius: 3px;
-                }}
-                
-                .priority-high {{
-                    color: #d97706;
-                    font-weight: 700;
-                    background: #fffbf0;
-                    padding: 2px 6px;
-                    border-radius: 3px;
-                }}
-                
-                /* Finding boxes */
-                .finding-critical {{
-                    border-left: 5px solid #c53030;
-                    background: #fdf2f2;
-                    padding: 1rem;
-                    margin: 1.5rem 0;
-                    page-break-inside: avoid;
-                    border-radius: 3px;
-                }}
-                
-                .finding-high {{
-                    border-left: 5px solid #d97706;
-                    background: #fffbf0;
-                    padding: 1rem;
-                    margin: 1.5rem 0;
-                    page-break-inside: avoid;
-                    border-radius: 3px;
-                }}
-                
-                /* Important pointers */
-                .important {{
-                    background: #fffaf0;
-                    border-left: 4px solid #d69e2e;
-                    padding: 0.8rem;
-                    margin: 1rem 0;
-                    page-break-inside: avoid;
-                    font-size: 10pt;
-                }}
-                
-                /* Section dividers */
-                hr {{
-                    border: none;
-                    border-top: 2px solid #cbd5e0;
-                    margin: 2.5rem 0;
-                    page-break-after: avoid;
-                }}
-                
-                /* Blockquotes */
-                blockquote {{
-                    border-left: 4px solid #cbd5e0;
-                    padding-left: 1rem;
-                    margin: 1.5rem 0;
-                    padding: 0.8rem 1rem;
-                    color: #4a5568;
-                    background: #f7fafc;
-                    page-break-inside: avoid;
-                    font-style: italic;
-                }}
-                
-                /* Links */
-                a {{
-                    color: #2c5282;
-                    text-decoration: none;
-                    page-break-inside: avoid;
-                }}
-                
-                a:hover {{
-                    text-decoration: underline;
-                }}
-                
-                /* Horizontal rule */
-                hr {{
-                    border: none;
-                    border-top: 1px solid #e2e8f0;
-                    margin: 2rem 0;
-                    page-break-after: avoid;
-                }}
-                
-                /* Page breaks */
-                .page-break {{
-                    page-break-before: always;
-                }}
-                
-                /* Ensure proper spacing */
-                main > *:first-child {{
-                    margin-top: 0;
-                }}
-            </style>
-        </head>
-        <body>
-        <div class="doc-header">
-            <div class="logo-section">{logo_html}</div>
-            <div class="title-section">
-                <h1>{company_header}</h1>
-                <p>Enterprise Threat Assessment Report</p>
-            </div>
-            <div class="date-section">
-                <p>Report Date</p>
-                <p>{datetime.now().strftime('%B %d, %Y')}</p>
-            </div>
-        </div>
-        
-        <div class="toc-container">
-            <h2>Contents</h2>
-            {toc_html}
-        </div>
-        
-        <main>{html_body}</main>
-        </body>
-        </html>
-        """
-
-        # Generate PDF with full content rendering (no truncation)
-        pdf_bytes = HTML(string=full_html).write_pdf(
-            presentational_hints=True,
-            optimize_size=('fonts',)  # Optimize fonts but keep full content
+    key = pdf_cache_key(report_content, branding)
+    cached = _pdf_cache.get(key)
+    if cached is not None:
+        pdf_bytes, error = cached
+    else:
+        pdf_bytes, error = render_worker.render_pdf(
+            report_html(report_content), branding, pool=get_render_pool(), timeout=PDF_RENDER_TIMEOUT_SECONDS
         )
-        return pdf_filename, pdf_bytes, "application/pdf"
-    except Exception as e:
+        if pdf_bytes is not None:
+            _pdf_cache.put(key, (pdf_bytes, error))
+
+    if error:
         # Store diagnostic info for UI visibility if possible
         try:
             if hasattr(st, 'session_state'):
-                setattr(st.session_state, '_pdf_error', str(e))
+                setattr(st.session_state, '_pdf_error', error)
         except Exception:
             pass
-
-        # Fallback: attempt a styled PDF using ReportLab so the button still appears
-        try:
-            from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-            from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-            from reportlab.lib.pagesizes import A4
-            from reportlab.lib.units import cm
-            from reportlab.lib import colors
-            from bs4 import BeautifulSoup
-
-            buffer = io.BytesIO()
-            doc = SimpleDocTemplate(
-                buffer,
-                pagesize=A4,
-                leftMargin=2*cm,
-                rightMargin=2*cm,
-                topMargin=2*cm,
-                bottomMargin=2*cm,
-            )
-            styles = getSampleStyleSheet()
-            styles.add(ParagraphStyle(name='H1', fontSize=18, leading=22, spaceAfter=10, spaceBefore=10))
-            styles.add(ParagraphStyle(name='H2', fontSize=14, leading=18, spaceAfter=8, spaceBefore=8))
-            styles.add(ParagraphStyle(name='H3', fontSize=12, leading=16, spaceAfter=6, spaceBefore=6))
-            header_style = ParagraphStyle(
-                name='TableHeader',
-                parent=styles['BodyText'],
-                fontName='Helvetica-Bold',
-                textColor=colors.white,
-                fontSize=8,
-                leading=10
-            )
-            story = []
-
-            # Title
-            header_text = getattr(st.session_state, 'company_name', None) or "Threat Assessment"
-            story.append(Paragraph(f"{header_text} - Threat Assessment", styles['Title']))
-            story.append(Spacer(1, 12))
-
-            # Convert markdown to HTML and parse
-            try:
-                import markdown as _markdown
-                md = _markdown.Markdown(extensions=["tables", "fenced_code", "toc"])
-                html = md.convert(report_content or "")
-            except Exception:
-                html = f"<pre>{(report_content or '').replace('<','&lt;').replace('>','&gt;')}</pre>"
-
-            soup = BeautifulSoup(html, 'html.parser')
-
-            def colorize_text(text: str) -> str:
-                # Apply risk color spans recognized by ReportLab (<font color="...">)
-                rep = (
-                    ('CRITICAL', 'c53030'), ('Critical', 'c53030'),
-                    ('HIGH', 'd97706'), ('High', 'd97706'),
-                    ('MEDIUM', 'd69e2e'), ('Medium', 'd69e2e'),
-                    ('LOW', '22543d'), ('Low', '22543d'),
-                )
-                for key, col in rep:
-                    text = text.replace(key, f'<font color="#{col}"><b>{key}</b></font>')
-                return text
-
-            def add_table(table_tag):
-                rows = []
-                for tr in table_tag.find_all('tr'):
-                    cells = []
-                    for cell in tr.find_all(['th', 'td']):
-                        cell_text = colorize_text(cell.get_text(" ", strip=True))
-                        cell_style = header_style if cell.name == 'th' else styles['BodyText']
-                        cells.append(Paragraph(cell_text or " ", cell_style))
-                    rows.append(cells)
-                if not rows:
-                    return
-                tbl = Table(rows, repeatRows=1)
-                style_cmds = [
-                    ('GRID', (0,0), (-1,-1), 0.5, colors.HexColor('#cbd5e0')),
-                    ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#2d3748')),
-                    ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0,0), (-1,-1), 8),
-                    ('VALIGN', (0,0), (-1,-1), 'TOP'),
-                ]
-                # Zebra stripes for body
-                for i in range(1, len(rows)):
-                    bg = colors.HexColor('#f7fafc') if i % 2 == 1 else colors.white
-                    style_cmds.append(('BACKGROUND', (0,i), (-1,i), bg))
-                tbl.setStyle(TableStyle(style_cmds))
-                story.append(tbl)
-                story.append(Spacer(1, 10))
-
-            # Walk top-level elements and render
-            for el in soup.contents:
-                name = getattr(el, 'name', None)
-                if not name:
-                    # Text node
-                    txt = str(el).strip()
-                    if txt:
-                        story.append(Paragraph(colorize_text(txt), styles['BodyText']))
-                        story.append(Spacer(1, 6))
-                    continue
-
-                if name in ('h1', 'h2', 'h3'):
-                    style = styles['H1'] if name == 'h1' else styles['H2'] if name == 'h2' else styles['H3']
-                    story.append(Paragraph(colorize_text(el.get_text()), style))
-                    story.append(Spacer(1, 6))
-                elif name == 'p':
-                    story.append(Paragraph(colorize_text(el.decode_contents()), styles['BodyText']))
-                    story.append(Spacer(1, 6))
-                elif name == 'table':
-                    add_table(el)
-                else:
-                    # Fallback for other tags
-                    story.append(Paragraph(colorize_text(el.get_text()), styles['BodyText']))
-                    story.append(Spacer(1, 6))
-
-            doc.build(story)
-            pdf_bytes = buffer.getvalue()
-            return pdf_filename, pdf_bytes, "application/pdf"
-        except Exception:
-            # If ReportLab fallback also fails, return the markdown as a final fallback
-            return md_filename, report_content, "text/markdown"
+    if pdf_bytes is None:
+        return md_filename, report_content, "text/markdown"
+    return pdf_filename, pdf_bytes, "application/pdf"
 
 
 def render_markdown_as_html(markdown_text):
-    """Convert markdown to HTML for in-app preview."""
-    try:
-        import markdown as _markdown  # optional
-        md = _markdown.Markdown(extensions=["tables", "fenced_code", "toc"])
-        html = md.convert(markdown_text or "")
-        return html
-    except Exception:
-        # Fallback: wrap in pre tag if markdown conversion fails
-        return f"<pre>{markdown_text}</pre>"
+    """Convert markdown to HTML for in-app preview (escaped in a <pre> block without python-markdown)."""
+    return report_html(markdown_text).html
 
 
 def show_report_preview(report_content, is_pdf_available=False):
@@ -1807,6 +4012,34 @@ def show_report_preview(report_content, is_pdf_available=False):
         st.markdown(f'<div class="report-preview">{html_content}</div>', unsafe_allow_html=True)
 
 
+def _job_is_active():
+    """Whether this session's assessment job (or the one in the URL) is queued or running."""
+    job_id = getattr(st.session_state, 'assessment_job_id', None) or _get_job_query_param()
+    job = _job_manager.get(job_id) if job_id else None
+    return job is not None and job.status in ("queued", "running")
+
+
+def prompt_budget(documents, project_info, framework, risk_areas):
+    """`compact_documents` plus `needs_summaries`, memoized per session for the current inputs.
+
+    Reruns triggered by unrelated widgets reuse the previous result instead of
+    compacting (and indexing) the documents again.
+    """
+    key = hashlib.sha256()
+    key.update(json.dumps([project_info, framework, risk_areas], sort_keys=True, default=str).encode('utf-8'))
+    for name, text in documents:
+        key.update(f"\0{name}\0".encode('utf-8'))
+        key.update(text.encode('utf-8'))
+    key = key.hexdigest()
+    memo = getattr(st.session_state, '_prompt_budget', None)
+    if memo is not None and memo[0] == key:
+        return memo[1]
+    documents_content, budget_report = compact_documents(documents, project_info, framework, risk_areas)
+    result = (documents_content, budget_report, needs_summaries(documents, project_info, framework, risk_areas))
+    setattr(st.session_state, '_prompt_budget', (key, result))
+    return result
+
+
 def main():
     # Header
     st.markdown("""
@@ -1919,6 +4152,105 @@ def main():
             help="When enabled, the app will use the Messages API instead of the Completions API regardless of model family detection. Use for debugging or compatibility testing.",
             key="force_messages_api"
         )
+
+        # Stream the report into the results area while it is being generated
+        st.checkbox(
+            "Stream report while generating",
+            value=True,
+            help="When enabled, the report text is shown as it is generated instead of after the full response arrives.",
+            key="stream_output"
+        )
+
+        # Generate independent report parts concurrently
+        st.checkbox(
+            "Parallel section-wise generation",
+            value=False,
+            help="Generate the Executive Summary, Threat Modeling Analysis, Risk Matrix, Recommendations and Appendices as separate concurrent requests and stitch them together. Much faster for large reports; the parts are written independently, so cross-references between them are checked afterwards.",
+            key="parallel_sections"
+        )
+
+        # Skip the response cache lookup (a fresh report still refreshes the cache)
+        st.checkbox(
+            "Bypass response cache",
+            value=False,
+            help="When enabled, the report is always regenerated even if identical inputs were assessed before. The new report replaces the cached one.",
+            key="bypass_response_cache"
+        )
+
+        st.markdown("---")
+
+        # Diagnostics
+        st.markdown("### 📈 Diagnostics")
+        response_cache = get_response_cache()
+        if response_cache is not None:
+            try:
+                cache_stats = response_cache.stats()
+                st.caption(
+                    f"Response cache: {cache_stats['hits']} hits · {cache_stats['misses']} misses · "
+                    f"{cache_stats['entries']} reports ({cache_stats['bytes'] / 1024 / 1024:.1f} MB)"
+                )
+            except Exception as e:
+                st.caption(f"Response cache unavailable: {e}")
+        else:
+            st.caption("Response cache: disabled (cache directory not writable)")
+
+        memory_stats = _memory_accountant.stats(_session_id())
+        st.caption(
+            f"Memory: this session {memory_stats['session_bytes'] / 1024 / 1024:.0f} of "
+            f"{SESSION_MEMORY_LIMIT_BYTES / 1024 / 1024:.0f} MB · server "
+            f"{memory_stats['server_bytes'] / 1024 / 1024:.0f} of {SERVER_MEMORY_LIMIT_BYTES / 1024 / 1024:.0f} MB "
+            f"across {memory_stats['sessions']} sessions · {memory_stats['rejected']} rejected"
+        )
+
+        extraction_stats = _extraction_cache.stats()
+        st.caption(
+            f"Extraction cache: {extraction_stats['hit_rate']:.0%} hit rate · "
+            f"{extraction_stats['memory_hits']} memory / {extraction_stats['disk_hits']} disk hits · "
+            f"{extraction_stats['misses']} misses · {extraction_stats['disk_entries'] or extraction_stats['memory_entries']} documents "
+            f"({max(extraction_stats['disk_bytes'], extraction_stats['memory_bytes']) / 1024 / 1024:.1f} MB)"
+        )
+
+        pdf_stats = _pdf_cache.stats()
+        st.caption(
+            f"PDF cache: {pdf_stats['hits']} hits · {pdf_stats['misses']} renders · "
+            f"{pdf_stats['entries']} PDFs ({pdf_stats['bytes'] / 1024 / 1024:.1f} of "
+            f"{PDF_CACHE_MAX_BYTES / 1024 / 1024:.0f} MB)"
+        )
+
+        render_pool = get_render_pool()
+        if render_pool is not None:
+            render_stats = render_pool.stats()
+            st.caption(
+                f"PDF renderer: {render_stats['busy']} rendering · {render_stats['queued']} queued · "
+                f"{render_stats['renders']} renders, p50 {render_stats['p50_seconds']:.1f}s / "
+                f"p95 {render_stats['p95_seconds']:.1f}s · {render_stats['timeouts']} timed out · "
+                f"{render_stats['failures']} failed"
+            )
+
+        scheduler_stats = _request_scheduler.stats()
+        st.caption(
+            f"API calls: {scheduler_stats['attempts']} attempts · {scheduler_stats['retries']} retries · "
+            f"{scheduler_stats['errors']} failed · latency p50 {scheduler_stats['p50_seconds']:.1f}s / "
+            f"p95 {scheduler_stats['p95_seconds']:.1f}s · {scheduler_stats['throttled_seconds']}s rate-limited · "
+            f"circuit {scheduler_stats['circuit']}"
+        )
+
+        job_stats = _job_manager.stats()
+        st.caption(
+            f"Background jobs: {job_stats['running']} running · {job_stats['queued']} queued · "
+            f"{job_stats['done']} done · {job_stats['failed']} failed"
+        )
+
+        surfaces = _api_capabilities.snapshot()
+        if surfaces:
+            st.caption("API surfaces: " + " · ".join(f"{model} → {surface}" for model, surface in sorted(surfaces.items())))
+
+        client_stats = _client_registry.stats()
+        st.caption(
+            f"API clients: {client_stats['clients']} pooled · {client_stats['client_reuses']} reuses · "
+            f"{client_stats['requests']} requests over {client_stats['tcp_connects']} new connections "
+            f"({client_stats['tls_handshakes']} TLS handshakes, {client_stats['connection_reuse_rate']:.0%} reused)"
+        )
         
         st.markdown("---")
         
@@ -2044,7 +4376,7 @@ def main():
     st.markdown("""
         <div class='upload-box'>
             <h3>📤 Drop your files here</h3>
-            <p style='margin: 0.5rem 0; color: #666;'>Supported: PDF, DOCX, TXT, MD, PNG, JPG, YAML, JSON</p>
+            <p style='margin: 0.5rem 0; color: #666;'>Supported: PDF, DOCX, TXT, MD, PNG, JPG, YAML, JSON, or a ZIP/tar archive of them</p>
             <p style='margin: 0.5rem 0; font-size: 0.9rem; color: #999;'>Architecture diagrams, design docs, data flows, API specs, technical documentation</p>
         </div>
     """, unsafe_allow_html=True)
@@ -2052,12 +4384,40 @@ def main():
     uploaded_files = st.file_uploader(
         "Choose files",
         accept_multiple_files=True,
-        type=['pdf', 'docx', 'txt', 'md', 'png', 'jpg', 'jpeg', 'yaml', 'json'],
-        help="Upload architecture diagrams, design documents, data flow diagrams, etc.",
+        type=['pdf', 'docx', 'txt', 'md', 'png', 'jpg', 'jpeg', 'yaml', 'yml', 'json', 'zip', 'tar', 'tgz', 'gz'],
+        help="Upload architecture diagrams, design documents, data flow diagrams, etc., or a ZIP/tar archive of a docs folder.",
         label_visibility="collapsed"
     )
     
-    if uploaded_files:
+    # While a job runs, the job panel below reruns the page every JOB_POLL_INTERVAL_SECONDS. Unpacking,
+    # extraction and the prompt budget only feed the Generate button, which is disabled meanwhile, so skip them.
+    job_active = _job_is_active()
+    extracted = []
+    images = []
+    archive_reports = []
+    # The uploader keeps the files in server memory for as long as they are selected; none once all are removed
+    _memory_accountant.set_resident(_session_id(), sum(f.size for f in uploaded_files or []))
+    if uploaded_files and not job_active:
+        unpacking = st.empty()
+        uploaded_files, archive_reports = expand_uploaded_archives(
+            uploaded_files,
+            progress=lambda archive, seen, member: unpacking.text(f"📦 Unpacking {archive}: {seen} files read · {member}"),
+        )
+        unpacking.empty()
+        for report in archive_reports:
+            if report['error']:
+                st.error(f"⚠️ Could not unpack {report['archive']}: {report['error']}")
+        try:
+            extracted = extract_uploaded_files(uploaded_files)
+            images, image_infos = prepare_uploaded_images(uploaded_files)
+        except MemoryBudgetExceeded as e:
+            st.error(f"⚠️ {e}")
+            # Nothing can be assessed without the extracted text
+            extracted = []
+            uploaded_files = []
+    if uploaded_files and job_active:
+        st.info(f"⏳ Assessing {len(uploaded_files)} uploaded file(s). The upload summary is shown again when the report is ready.")
+    elif uploaded_files:
         st.success(f"✓ {len(uploaded_files)} file(s) uploaded - Ready for analysis")
         
         # Show uploaded files with better styling
@@ -2065,19 +4425,69 @@ def main():
             total_size = sum(f.size for f in uploaded_files) / 1024 / 1024
             st.metric("Total Files", len(uploaded_files), delta="Ready for processing")
             
-            for idx, file in enumerate(uploaded_files, 1):
+            for idx, (file, (text, info), image_info) in enumerate(zip(uploaded_files, extracted, image_infos), 1):
+                text_tokens = estimate_tokens(text)
                 col1, col2, col3, col4 = st.columns([3, 1.5, 1.2, 0.5])
+                if image_info is not None:
+                    info = dict(info, error=image_info['error'])
                 with col1:
                     st.markdown(f"**{idx}. {file.name}**")
+                    timing = "from cache" if info.get('cached') else f"extracted in {info['seconds']:.2f}s"
+                    if image_info is not None:
+                        if image_info.get('width'):
+                            st.caption(
+                                f"{image_info['original_width']}×{image_info['original_height']} "
+                                f"{image_info['original_format']} · {image_info['original_bytes'] / 1024:.0f} KB → "
+                                f"{image_info['width']}×{image_info['height']} {image_info['format']} · "
+                                f"{image_info['bytes'] / 1024:.0f} KB"
+                                + (f" · ~{image_info['tokens']:,} tokens" if 'tokens' in image_info else "")
+                                + (" · shrunk to fit the image budget" if image_info.get('budget_scaled') else "")
+                            )
+                        if image_info['error']:
+                            st.caption(f"⚠️ Image not sent: {image_info['error']}")
+                    elif info['error']:
+                        st.caption(f"⚠️ Could not extract text: {info['error']}")
+                    elif info['pages'] is not None:
+                        empty = f" · {info['empty_pages']} without text" if info['empty_pages'] else ""
+                        st.caption(f"{info['pages']} pages{empty} · {timing}")
+                    elif 'tables' in info:
+                        st.caption(f"{info['paragraphs']} paragraphs · {info['tables']} tables · {timing}")
+                    elif 'outline' in info:
+                        if info.get('parse_error'):
+                            st.caption(f"⚠️ Not parsed, sent as raw text: {info['parse_error']}")
+                        else:
+                            st.caption(
+                                f"{info['outline']} · {info['findings']} security-relevant values · "
+                                f"{text_tokens:,} tokens from {file.size / 1024:.0f} KB · {timing}"
+                            )
                 with col2:
                     st.markdown(f"`{file.size / 1024:.1f} KB`")
                 with col3:
                     st.markdown(f"*{Path(file.name).suffix.upper()[1:]}*")
                 with col4:
-                    st.markdown("✓")
+                    st.markdown("⚠️" if info['error'] else "✓")
             
             if total_size > 0:
                 st.caption(f"📊 Total size: {total_size:.2f} MB")
+            for report in archive_reports:
+                if report['error']:
+                    continue
+                statuses = Counter(entry['status'] for entry in report['entries'])
+                st.caption(
+                    f"📦 {report['archive']}: {report['files']} files unpacked "
+                    f"({report['bytes'] / 1024 / 1024:.2f} MB in {report['seconds']:.2f}s) · "
+                    f"{statuses['duplicate']} duplicates · {statuses['skipped']} skipped · {statuses['error']} unreadable"
+                )
+                for entry in report['entries']:
+                    if entry['status'] != 'extracted':
+                        st.markdown(f"- `{entry['name']}`: {entry['status']} ({entry['detail']})")
+            if images:
+                image_bytes = sum(len(image['data']) for image in images)
+                original_bytes = sum(i['original_bytes'] for i in image_infos if i is not None and i.get('width'))
+                st.caption(
+                    f"🖼️ {len(images)} image(s) sent to the model: {original_bytes / 1024 / 1024:.2f} MB → "
+                    f"{image_bytes / 1024 / 1024:.2f} MB (budget {IMAGE_BUDGET_BYTES / 1024 / 1024:.0f} MB)"
+                )
     else:
         st.info("👆 Upload documents to enable threat assessment generation")
     
@@ -2180,95 +4590,180 @@ def main():
         """)
     else:
         st.success("✓ All required fields completed - Ready to generate assessment!")
+
+    # Measure the prompt and compact the documents to the token budget before generating
+    if can_generate and not job_active:
+        project_info = {
+            'name': project_name,
+            'app_type': app_type,
+            'deployment': deployment,
+            'criticality': criticality,
+            'compliance': compliance if compliance else ['None specified'],
+            'environment': environment
+        }
+        documents = [(file.name, text) for file, (text, _) in zip(uploaded_files, extracted)]
+        documents_content, budget_report, summarize = prompt_budget(
+            documents, project_info, selected_framework, selected_risks
+        )
+        with st.expander("📏 Prompt Budget", expanded=bool(budget_report['strategies']) or summarize):
+            if summarize:
+                oversized = [name for name, text in documents if estimate_tokens(text) > SUMMARY_CHUNK_TOKENS]
+                chunks = sum(len(_pack_paragraphs(text, SUMMARY_CHUNK_TOKENS)) for _, text in documents
+                             if estimate_tokens(text) > SUMMARY_CHUNK_TOKENS)
+                st.info(
+                    f"📚 The documents exceed the model context of {MODEL_CONTEXT_TOKENS:,} tokens. Before the "
+                    f"assessment, {len(oversized)} large documents are summarized in about {chunks} chunks "
+                    f"({SUMMARY_WORKERS} at a time); digests keep quotes and page references and are cached "
+                    "for re-assessments. The figures below are before summarization."
+                )
+            st.caption(
+                f"Estimated prompt: {budget_report['prompt_tokens']:,} of {budget_report['budget_tokens']:,} tokens "
+                f"({budget_report['overhead_tokens']:,} instructions and project details, "
+                f"{budget_report['prompt_tokens'] - budget_report['overhead_tokens']:,} documents)"
+            )
+            for doc in budget_report['documents']:
+                change = (
+                    f"{doc['original_tokens']:,} → {doc['tokens']:,} tokens"
+                    if doc['tokens'] != doc['original_tokens'] else f"{doc['tokens']:,} tokens"
+                )
+                note = " · capped" if doc['truncated'] else ""
+                st.markdown(f"- **{doc['name']}**: {change} · relevance {doc['relevance']:.0%}{note}")
+            retrieval = budget_report['retrieval']
+            if retrieval:
+                st.caption(
+                    f"Evidence retrieval: {retrieval['selected_chunks']} of {retrieval['chunks']} chunks "
+                    f"(top {retrieval['top_k']} per area) · recall {retrieval['recall']:.0%} · "
+                    f"{retrieval['saved_tokens']:,} tokens saved"
+                )
+                for group, stats in retrieval['groups'].items():
+                    st.markdown(
+                        f"- {group}: {stats['chunks']} chunks · "
+                        f"{stats['matched_queries']} of {stats['queries']} topics found in the documents"
+                    )
+            if budget_report['strategies']:
+                st.info(
+                    f"Documents compacted from {budget_report['original_prompt_tokens']:,} tokens: "
+                    + "; ".join(budget_report['strategies'])
+                )
+            if not budget_report['fits']:
+                st.warning("⚠️ The prompt is still over budget. Consider uploading fewer or smaller documents.")
     
     col1, col2, col3 = st.columns([1, 1.5, 1])
     
     with col2:
         if st.button(
             "🎯 Generate Threat Assessment Report",
-            disabled=not can_generate,
+            disabled=not can_generate or job_active or bool(getattr(st.session_state, 'assessment_job_id', None)),
             use_container_width=True,
             key="generate_report_btn"
         ):
+            # Generation runs as a background job; the panel below polls it
+            st.session_state.assessment_job_id = _job_manager.submit(
+                run_assessment_job,
+                description=project_name,
+                project_info=project_info,
+                documents_content=documents_content,
+                framework=selected_framework,
+                risk_areas=selected_risks,
+                api_key=api_key,
+                parallel_sections=getattr(st.session_state, 'parallel_sections', False),
+                stream=getattr(st.session_state, 'stream_output', True),
+                use_cache=not getattr(st.session_state, 'bypass_response_cache', False),
+                force_messages=getattr(st.session_state, 'force_messages_api', False),
+                images=images,
+                documents=documents,
+                summarize=summarize,
+            )
             st.session_state.processing = True
-            
-            # Progress tracking
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            status_container = st.container()
-            
-            try:
-                # Step 1: Process documents
-                with status_container:
-                    status_text.text("📄 Processing uploaded documents...")
-                progress_bar.progress(20)
-                
-                documents_content = ""
-                for file in uploaded_files:
-                    content = extract_text_from_file(file)
-                    documents_content += f"\n\n### {file.name}\n{content}"
-                
-                # Step 2: Prepare project info
-                with status_container:
-                    status_text.text("📊 Preparing project information...")
-                progress_bar.progress(40)
-                
-                project_info = {
-                    'name': project_name,
-                    'app_type': app_type,
-                    'deployment': deployment,
-                    'criticality': criticality,
-                    'compliance': compliance if compliance else ['None specified'],
-                    'environment': environment
-                }
-                
-                # Step 3: Generate assessment
-                with status_container:
-                    status_text.text("🤖 Generating threat assessment with SecureAI...")
-                progress_bar.progress(60)
-                
-                threat_report = generate_threat_assessment(
-                    project_info,
-                    documents_content,
-                    selected_framework,
-                    selected_risks,
-                    api_key
-                )
-
-                # Augment references automatically when possible
-                if threat_report:
-                    try:
-                        suggestions = _suggest_references_from_text(threat_report)
-                        threat_report = _merge_references_section(threat_report, suggestions)
-                    except Exception:
-                        # Non-fatal if augmentation errors
-                        pass
-
-                    progress_bar.progress(100)
-                    with status_container:
-                        status_text.text("✅ Assessment complete! Generating PDF...")
-
-                    st.session_state.threat_report = threat_report
-                    st.session_state.assessment_complete = True
-                    st.session_state.processing = False
-
-                    # Clear any stored prompt preview to avoid leaving sensitive data in session state
-                    try:
-                        if hasattr(st.session_state, '_debug_prompt_preview'):
-                            delattr(st.session_state, '_debug_prompt_preview')
-                    except Exception:
-                        pass
+            st.session_state.assessment_complete = False
+            _set_job_query_param(st.session_state.assessment_job_id)
+            st.rerun()
+
+    # Running or just-finished assessment job (reattached from the URL after a refresh)
+    job_id = getattr(st.session_state, 'assessment_job_id', None) or _get_job_query_param()
+    job = _job_manager.get(job_id) if job_id else None
+    if job_id and job is None:
+        st.session_state.assessment_job_id = None
+        st.session_state.processing = False
+        _set_job_query_param(None)
+        st.warning("⚠️ The previous assessment job is no longer available (the server restarted or the result expired).")
+    if job is not None:
+        st.session_state.assessment_job_id = job.id
+        snapshot = job.snapshot()
+        if snapshot["status"] in ("queued", "running"):
+            streamed = snapshot["streamed"]
+            progress = snapshot["progress"]
+            message = snapshot["message"]
+            if streamed:
+                # Roughly 4 characters per token against the 16k-token output ceiling
+                progress = len(streamed) / (16000 * 4)
+                message = f"✍️ Receiving report from SecureAI... ({len(streamed):,} characters)"
+            st.progress(min(95, 5 + int(90 * progress)))
+            st.text(f"{message} · {snapshot['elapsed']:.0f}s")
+            st.caption("You can keep using the page or refresh it; generation continues in the background.")
+            if streamed:
+                st.markdown(streamed)
+            time.sleep(JOB_POLL_INTERVAL_SECONDS)
+            st.rerun()
+        else:
+            # Collect the finished job once, then forget it
+            st.session_state.assessment_job_id = None
+            st.session_state.processing = False
+            _set_job_query_param(None)
+            if snapshot["status"] == "done":
+                st.session_state.threat_report = snapshot["result"]
+                st.session_state.assessment_complete = True
+
+                # Clear any stored prompt preview to avoid leaving sensitive data in session state
+                try:
+                    if hasattr(st.session_state, '_debug_prompt_preview'):
+                        delattr(st.session_state, '_debug_prompt_preview')
+                except Exception:
+                    pass
+
+                st.balloons()
+                st.success("🎉 Threat assessment generated successfully! Download your report below.")
+                section_stats = snapshot["details"].get("section_stats")
+                usage = snapshot["details"].get("usage") or {}
+                if section_stats:
+                    st.caption(
+                        f"Generated {len(section_stats['parts'])} parts in {section_stats['wall_seconds']}s · "
+                        f"{len(section_stats['renumbered_ids'])} duplicate IDs renumbered · "
+                        f"{len(section_stats['dangling_ids'])} unresolved cross-references · "
+                        f"{len(section_stats['ambiguous_ids'])} ambiguous cross-references"
+                    )
+                summaries = snapshot["details"].get("summaries")
+                if summaries:
+                    cached = sum(doc['cached_chunks'] for doc in summaries['documents'])
+                    st.caption(
+                        f"Summarized {len(summaries['documents'])} large documents with {summaries['requests']} "
+                        f"requests in {summaries['seconds']}s ({cached} chunk digests from cache): "
+                        + "; ".join(f"{doc['name']} {doc['original_tokens']:,} → {doc['tokens']:,} tokens"
+                                    for doc in summaries['documents'])
+                    )
+                evidence = snapshot["details"].get("evidence")
+                if evidence and evidence["findings"]:
+                    st.caption(
+                        f"Evidence check: {evidence['verified']} findings verified, {evidence['fuzzy']} fuzzy-matched, "
+                        f"{evidence['unsupported']} unsupported · {evidence['quotes']} quotes in {evidence['seconds']}s "
+                        "(see EVIDENCE VERIFICATION at the end of the report)"
+                    )
+                    if evidence['unsupported']:
+                        st.warning(
+                            f"⚠️ {evidence['unsupported']} findings cite evidence that was not found in the uploaded "
+                            "documents. Review them before sharing the report."
+                        )
+                if usage.get("response_cache_hit"):
+                    st.caption("Served from the response cache; no tokens were used.")
+                elif usage:
+                    st.caption(
+                        f"Prompt cache: {usage.get('cache_read_input_tokens', 0):,} input tokens read from cache, "
+                        f"{usage.get('cache_creation_input_tokens', 0):,} written · "
+                        f"{usage.get('input_tokens', 0):,} uncached input, {usage.get('output_tokens', 0):,} output tokens"
+                    )
+            else:
+                st.error(f"❌ Failed to generate assessment: {snapshot['error']}")
 
-                    st.balloons()
-                    st.success("🎉 Threat assessment generated successfully! Download your report below.")
-                else:
-                    st.error("❌ Failed to generate assessment. Please try again.")
-                    st.session_state.processing = False
-                    
-            except Exception as e:
-                st.error(f"❌ Error: {str(e)}")
-                st.session_state.processing = False
-    
     # Display Results
     if st.session_state.assessment_complete and st.session_state.threat_report:
         st.markdown("---")
@@ -0,0 +1,160 @@
+"""
+Unpacking of uploaded ZIP and tar archives.
+
+Kept free of Streamlit imports, like `extractors`. Members are streamed to
+files in a directory chunk by chunk, so an archive never has to fit in memory,
+and each member is hashed on the way so duplicates can be dropped without
+reading them twice. Decompression is checked against the limits while it
+happens rather than against the sizes stored in the archive, which a zip bomb
+can forge.
+"""
+
+import hashlib
+import os
+import tarfile
+import time
+import zipfile
+from pathlib import Path, PurePosixPath
+
+# '.gz' covers '.tar.gz'; a compressed single file is reported as not being a tar archive
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tgz', '.gz')
+# The compression ratio limit only applies past this many bytes, so small, very
+# compressible files (a short YAML file in a ZIP) are not mistaken for bombs
+RATIO_GRACE_BYTES = 1024 * 1024
+
+
+class ArchiveLimitExceeded(ValueError):
+    """An archive has too many files, unpacks to too many bytes or is compressed suspiciously well."""
+
+
+def is_archive(name):
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+class ArchiveMember:
+    """An unpacked archive member with the interface of a Streamlit upload (`name`, `size`, `getvalue()`).
+
+    `path` lets the app extract the file in place, and `digest` (SHA-256, hex)
+    spares hashing it again.
+    """
+
+    def __init__(self, name, path, size, digest):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+    def getvalue(self):
+        return Path(self.path).read_bytes()
+
+
+def _zip_members(source):
+    """Yield (member name, compressed size, opener) for the files of a ZIP archive."""
+    with zipfile.ZipFile(source) as archive:
+        for info in archive.infolist():
+            if not info.is_dir():
+                yield info.filename, info.compress_size, lambda info=info: archive.open(info)
+
+
+def _tar_members(source):
+    """Yield (member name, None, opener) for the files of a tar archive, reading it as a stream.
+
+    The stream mode decompresses the archive front to back once; a member must
+    be read before the next one is requested.
+    """
+    options = {'name': source} if isinstance(source, (str, os.PathLike)) else {'fileobj': source}
+    with tarfile.open(mode='r|*', **options) as archive:
+        for info in archive:
+            if info.isfile():
+                yield info.name, None, lambda info=info: archive.extractfile(info)
+
+
+def _source_size(source):
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    position = source.tell()
+    size = source.seek(0, os.SEEK_END)
+    source.seek(position)
+    return size
+
+
+def expand_archive(source, name, directory, extensions, max_files, max_bytes, max_ratio,
+                   chunk_bytes=1024 * 1024, progress=None):
+    """Unpack the files of an archive (a path or a seekable file object) into `directory`.
+
+    Only members whose extension is in `extensions` are written; hidden files
+    (including macOS `__MACOSX` metadata) and nested archives are skipped.
+    Members with the same content as an earlier member are dropped. Raises
+    ArchiveLimitExceeded, leaving the written files behind for the caller to
+    remove, when the archive lists more than `max_files` files or unpacks to
+    more than `max_bytes`. It also raises when a member (ZIP) or the whole
+    archive (tar) grows beyond `max_ratio` times its compressed size.
+    `progress(files seen, member name)` is called after each member.
+
+    Returns (members, report). `members` holds one `ArchiveMember` per unpacked
+    file, named "<archive>/<member path>". `report` lists every member with its
+    status ("extracted", "duplicate", "skipped" or "error") and detail, plus
+    totals.
+    """
+    started = time.monotonic()
+    archive_bytes = max(1, _source_size(source))
+    members_of = _zip_members if name.lower().endswith('.zip') else _tar_members
+    members, entries = [], []
+    first_with_digest = {}
+    files = total = 0
+    for member_name, compressed, open_member in members_of(source):
+        files += 1
+        if files > max_files:
+            raise ArchiveLimitExceeded(f"{name} has more than {max_files} files")
+        display = f"{name}/{member_name}"
+        member_path = PurePosixPath(member_name)
+        extension = member_path.suffix.lower()
+        if any(part.startswith('.') or part == '__MACOSX' for part in member_path.parts):
+            entries.append({"name": display, "status": "skipped", "bytes": 0, "detail": "hidden file"})
+        elif extension not in extensions:
+            entries.append({"name": display, "status": "skipped", "bytes": 0, "detail": f"unsupported type {extension or '(none)'}"})
+        else:
+            path = os.path.join(directory, f"{len(members)}-{files}{extension}")
+            digest = hashlib.sha256()
+            written = 0
+            try:
+                with open_member() as fh, open(path, 'wb') as out:
+                    for chunk in iter(lambda: fh.read(chunk_bytes), b""):
+                        written += len(chunk)
+                        total += len(chunk)
+                        if total > max_bytes:
+                            raise ArchiveLimitExceeded(f"{name} unpacks to more than {max_bytes // (1024 * 1024)} MB")
+                        basis, unpacked = (compressed, written) if compressed is not None else (archive_bytes, total)
+                        if unpacked > RATIO_GRACE_BYTES and unpacked > max_ratio * max(1, basis):
+                            raise ArchiveLimitExceeded(
+                                f"{display} expands more than {max_ratio}× its compressed size (possible zip bomb)"
+                            )
+                        digest.update(chunk)
+                        out.write(chunk)
+            except ArchiveLimitExceeded:
+                raise
+            except (OSError, RuntimeError, zipfile.BadZipFile, tarfile.TarError) as e:
+                # An encrypted or corrupt member; the rest of the archive may still be readable
+                os.remove(path)
+                entries.append({"name": display, "status": "error", "bytes": 0, "detail": str(e)})
+            else:
+                content_digest = digest.hexdigest()
+                if content_digest in first_with_digest:
+                    os.remove(path)
+                    entries.append({"name": display, "status": "duplicate", "bytes": written,
+                                    "detail": f"same content as {first_with_digest[content_digest]}"})
+                else:
+                    first_with_digest[content_digest] = display
+                    members.append(ArchiveMember(display, path, written, content_digest))
+                    entries.append({"name": display, "status": "extracted", "bytes": written, "detail": ""})
+        if progress is not None:
+            progress(files, display)
+    report = {
+        "archive": name,
+        "entries": entries,
+        "files": len(members),
+        "bytes": total,
+        "seconds": round(time.monotonic() - started, 3),
+        "error": None,
+    }
+    return members, report
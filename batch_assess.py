@@ -0,0 +1,334 @@
+"""
+Headless batch runner for portfolio-wide threat assessments.
+
+Reads a manifest of projects (YAML or JSON), generates each assessment with the
+same pipeline as the Streamlit app and writes the Markdown and PDF reports to an
+output directory. Projects run concurrently; a JSON-lines progress log in the
+output directory lets an interrupted run resume where it stopped.
+
+    python batch_assess.py portfolio.yaml --output-dir reports --workers 4
+
+Manifest format (paths are relative to the manifest file, globs are allowed):
+
+    defaults:
+      framework: STRIDE
+      risk_areas: [Agentic AI Risk, Data Security Risk]
+      compliance: [GDPR]
+    projects:
+      - name: Customer Portal
+        app_type: Web Application
+        deployment: Cloud (AWS)
+        criticality: High
+        environment: Production
+        documents: [docs/portal/*.md, docs/portal/architecture.pdf, exports/portal-docs.zip]
+
+Every entry accepts the `project_info` fields (name, app_type, deployment,
+criticality, compliance, environment) plus documents, framework and
+risk_areas; keys under `defaults` apply to every entry that omits them.
+ZIP and tar archives among the documents are unpacked as in the app.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import app
+
+PROJECT_INFO_DEFAULTS = {
+    'app_type': "Web Application",
+    'deployment': "Cloud (AWS)",
+    'criticality': "High",
+    'compliance': [],
+    'environment': "Production",
+}
+PROGRESS_LOG_NAME = "progress.jsonl"
+
+
+class LocalDocument:
+    """A file on disk with the interface of a Streamlit upload (`name`, `size`, `getvalue()`).
+
+    `path` lets the app hash and extract the file in place instead of spooling a copy.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.name = self.path.name
+        self.size = self.path.stat().st_size
+
+    def getvalue(self):
+        return self.path.read_bytes()
+
+
+def load_manifest(path):
+    """Return the list of project entries in a YAML or JSON manifest, with defaults applied."""
+    path = Path(path)
+    text = path.read_text(encoding='utf-8')
+    if path.suffix.lower() in ('.yaml', '.yml'):
+        try:
+            import yaml  # optional
+        except ImportError:
+            raise SystemExit("Reading a YAML manifest requires PyYAML (pip install pyyaml); or use JSON.")
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+
+    if isinstance(data, list):
+        data = {'projects': data}
+    defaults = data.get('defaults') or {}
+    entries = []
+    for raw in data.get('projects') or []:
+        entry = {**PROJECT_INFO_DEFAULTS, **defaults, **raw}
+        entry['documents'] = resolve_documents(entry.get('documents') or [], path.parent)
+        entries.append(entry)
+    return entries
+
+
+def resolve_documents(patterns, base_dir):
+    paths = []
+    for pattern in patterns:
+        full = pattern if os.path.isabs(pattern) else str(base_dir / pattern)
+        # An unmatched pattern is kept as-is so validation reports it as missing
+        paths.extend(sorted(glob.glob(full)) or [full] if glob.has_magic(full) else [full])
+    return paths
+
+
+def validate_entry(entry, seen=None):
+    """Return a list of problems with a manifest entry (empty if it can run).
+
+    `seen` maps the output directory names of earlier entries to their names,
+    so an entry whose reports would overwrite another entry's is rejected.
+    """
+    problems = []
+    if not entry.get('name'):
+        problems.append("missing name")
+    elif seen is not None:
+        slug = _slug(entry['name'])
+        if slug in seen:
+            problems.append(f"name is not unique: reports would overwrite those of {seen[slug]!r}")
+        else:
+            seen[slug] = entry['name']
+    if entry.get('framework') not in app.FRAMEWORKS:
+        problems.append(f"framework must be one of {', '.join(app.FRAMEWORKS)}")
+    risk_areas = entry.get('risk_areas') or []
+    unknown = [area for area in risk_areas if area not in app.RISK_AREAS]
+    if not risk_areas or unknown:
+        problems.append(f"risk_areas must be a non-empty subset of {', '.join(app.RISK_AREAS)}")
+    if not entry.get('documents'):
+        problems.append("no documents")
+    for doc in entry.get('documents') or []:
+        if not os.path.isfile(doc):
+            problems.append(f"document not found: {doc}")
+    return problems
+
+
+def entry_key(entry):
+    """Content address of an entry: its settings and the bytes of every document.
+
+    A finished entry is skipped on the next run only while this key is unchanged.
+    """
+    digest = hashlib.sha256()
+    settings = {k: v for k, v in entry.items() if k != 'documents'}
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    for doc in entry['documents']:
+        digest.update(b"\0" + os.path.abspath(doc).encode('utf-8') + b"\0")
+        with open(doc, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ProgressLog:
+    """Append-only JSON-lines log of finished entries; the last record per key wins."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def completed(self):
+        """Map of entry key -> record for entries that finished and whose outputs still exist."""
+        done = {}
+        if not self.path.exists():
+            return done
+        with open(self.path, encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by an interrupted run
+                if record.get('status') == 'done' and all(os.path.exists(p) for p in record.get('outputs', [])):
+                    done[record['key']] = record
+                else:
+                    done.pop(record.get('key'), None)
+        return done
+
+    def append(self, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as fh:
+                fh.write(line)
+                fh.flush()
+                os.fsync(fh.fileno())
+
+
+def _slug(name):
+    return "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in name).strip("_") or "project"
+
+
+def run_entry(entry, output_dir, api_key, use_cache=True, force_messages=False, branding=None):
+    """Generate one assessment and write its reports; return (files written, prompt budget report, evidence stats)."""
+    project_info = {
+        'name': entry['name'],
+        'app_type': entry['app_type'],
+        'deployment': entry['deployment'],
+        'criticality': entry['criticality'],
+        'compliance': entry['compliance'] or ['None specified'],
+        'environment': entry['environment'],
+    }
+    uploads = [LocalDocument(path) for path in entry['documents']]
+    uploads, archive_reports = app.expand_uploaded_archives(uploads)
+    unreadable = [f"could not unpack {r['archive']}: {r['error']}" for r in archive_reports if r['error']]
+    if unreadable:
+        raise RuntimeError("; ".join(unreadable))
+    # Each entry is accounted as its own session against the memory ceilings
+    session_id = f"batch:{entry['name']}"
+    extracted = app.extract_uploaded_files(uploads, session_id=session_id)
+    documents = [(doc.name, text) for doc, (text, _) in zip(uploads, extracted)]
+    images, _ = app.prepare_uploaded_images(uploads, session_id=session_id)
+    prompt_documents = documents
+    if app.needs_summaries(documents, project_info, entry['framework'], entry['risk_areas']):
+        prompt_documents, _ = app.summarize_documents(
+            documents, project_info, entry['framework'], entry['risk_areas'], api_key,
+            use_cache=use_cache, force_messages=force_messages,
+        )
+    documents_content, budget_report = app.compact_documents(
+        prompt_documents, project_info, entry['framework'], entry['risk_areas']
+    )
+    report = app.generate_threat_assessment(
+        project_info, documents_content, entry['framework'], entry['risk_areas'], api_key,
+        use_cache=use_cache, force_messages=force_messages, raise_errors=True, images=images,
+    )
+    if not report:
+        raise RuntimeError("empty report")
+    try:
+        suggestions = app._suggest_references_from_text(report)
+        report = app._merge_references_section(report, suggestions)
+    except Exception:
+        # Non-fatal, as in the app
+        pass
+    report, evidence = app.verify_evidence(report, documents)
+
+    project_dir = Path(output_dir) / _slug(entry['name'])
+    project_dir.mkdir(parents=True, exist_ok=True)
+    md_path = project_dir / f"Threat_Assessment_{_slug(entry['name'])}_{datetime.now().strftime('%Y%m%d')}.md"
+    md_path.write_text(report, encoding='utf-8')
+    outputs = [str(md_path)]
+
+    filename, content, mime = app.create_pdf_download(report, entry['name'], branding=branding or {})
+    if mime == "application/pdf":
+        pdf_path = project_dir / filename
+        pdf_path.write_bytes(content)
+        outputs.append(str(pdf_path))
+    return outputs, budget_report, evidence
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run threat assessments for every project in a manifest.")
+    parser.add_argument("manifest", help="YAML or JSON manifest of projects")
+    parser.add_argument("--output-dir", default="reports", help="directory for reports and the progress log (default: reports)")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get('SECUREAI_BATCH_WORKERS', 4)),
+                        help="projects generated concurrently (default: 4 or SECUREAI_BATCH_WORKERS)")
+    parser.add_argument("--api-key", default=os.environ.get('SECUREAI_API_KEY', ""),
+                        help="API key (default: SECUREAI_API_KEY)")
+    parser.add_argument("--company-name", default="", help="company name shown in the PDF header")
+    parser.add_argument("--report-footer", default="", help="footer text for every PDF page")
+    parser.add_argument("--logo", help="PNG logo for the PDF header")
+    parser.add_argument("--no-cache", action="store_true", help="regenerate reports even if a cached response exists")
+    parser.add_argument("--force-messages-api", action="store_true", help="always use the Messages API")
+    parser.add_argument("--rerun", action="store_true", help="ignore the progress log and run every project")
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("an API key is required (--api-key or SECUREAI_API_KEY)")
+    entries = load_manifest(args.manifest)
+    seen = {}
+    invalid = [(entry.get('name') or f"entry {i + 1}", validate_entry(entry, seen)) for i, entry in enumerate(entries)]
+    invalid = [(name, problems) for name, problems in invalid if problems]
+    if invalid:
+        for name, problems in invalid:
+            print(f"✗ {name}: {'; '.join(problems)}", file=sys.stderr)
+        return 2
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    log = ProgressLog(output_dir / PROGRESS_LOG_NAME)
+    completed = {} if args.rerun else log.completed()
+    branding = {
+        'company_name': args.company_name,
+        'report_footer': args.report_footer,
+        'logo_image': Path(args.logo).read_bytes() if args.logo else None,
+    }
+
+    pending = []
+    for entry in entries:
+        key = entry_key(entry)
+        if key in completed:
+            print(f"↷ {entry['name']}: already done ({', '.join(completed[key]['outputs'])})")
+        else:
+            pending.append((key, entry))
+    if not pending:
+        print("All projects are up to date.")
+        return 0
+
+    failures = 0
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="batch-assessment") as pool:
+        futures = {}
+        for key, entry in pending:
+            future = pool.submit(
+                run_entry, entry, output_dir, args.api_key,
+                use_cache=not args.no_cache, force_messages=args.force_messages_api, branding=branding,
+            )
+            futures[future] = (key, entry, time.monotonic())
+        for done, future in enumerate(as_completed(futures), 1):
+            key, entry, submitted = futures[future]
+            record = {
+                'key': key,
+                'project': entry['name'],
+                'seconds': round(time.monotonic() - submitted, 1),
+                'finished_at': datetime.now().isoformat(timespec='seconds'),
+            }
+            try:
+                outputs, budget_report, evidence = future.result()
+            except Exception as e:
+                failures += 1
+                record.update(status='failed', error=str(e))
+                print(f"[{done}/{len(pending)}] ✗ {entry['name']}: {e}", file=sys.stderr)
+            else:
+                record.update(
+                    status='done', outputs=outputs, prompt_tokens=budget_report['prompt_tokens'],
+                    evidence_verified=evidence['verified'], evidence_fuzzy=evidence['fuzzy'],
+                    evidence_unsupported=evidence['unsupported'],
+                )
+                if budget_report['retrieval']:
+                    record.update(
+                        retrieval_recall=round(budget_report['retrieval']['recall'], 3),
+                        retrieval_saved_tokens=budget_report['retrieval']['saved_tokens'],
+                    )
+                print(f"[{done}/{len(pending)}] ✓ {entry['name']} in {record['seconds']}s → {', '.join(outputs)}")
+            log.append(record)
+
+    print(f"Finished {len(pending) - failures}/{len(pending)} projects in {time.monotonic() - started:.0f}s; "
+          f"progress log: {log.path}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
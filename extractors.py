@@ -0,0 +1,427 @@
+"""
+Document text extraction for uploaded files.
+
+Kept free of Streamlit imports so that worker processes of the extraction pool
+can import it cheaply. PDF and DOCX files are parsed in the pool, with large
+PDFs split into page ranges; each worker opens its file from a temporary copy
+and reads only the pages it was given. Extracted PDF text carries a "[Page N]"
+marker before every page so the model can cite page numbers.
+
+YAML and JSON files are reduced to a security-relevant outline by
+`structured.ingest_file`, also in the pool.
+
+Images (architecture diagrams, screenshots) are not turned into text: they
+are downscaled and re-encoded here, in the same pool, and sent to the model as
+image content blocks.
+"""
+
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import structured
+
+# Bump whenever extraction output changes, so cached extractions are recomputed
+EXTRACTOR_VERSION = 3
+
+# Pages per extraction task; a PDF with more pages is spread across workers
+PDF_PAGES_PER_TASK = int(os.environ.get('SECUREAI_PDF_PAGES_PER_TASK', 8))
+
+
+class ExtractionPool:
+    """Process pool for extraction tasks that is rebuilt after it breaks.
+
+    The worker processes start on the first `submit`. `restart` kills the
+    current workers, including one stuck on a task past its timeout, and the
+    next `submit` starts a fresh set. Workers are spawned rather than forked:
+    the server process runs many threads, and forking a multi-threaded
+    process can deadlock the child.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max(1, max_workers)
+        self.restarts = 0
+        self._executor = None
+        # Future -> executor it runs on, so a late caller cannot restart a newer executor
+        self._owners = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        for attempt in range(2):
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+                executor = self._executor
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                if attempt:
+                    raise
+                self._restart(executor)
+                continue
+            self._owners[future] = executor
+            return future
+
+    def restart(self, future):
+        """Kill the workers that ran `future` and start new ones on the next submit."""
+        self._restart(self._owners.get(future))
+
+    def _restart(self, executor):
+        with self._lock:
+            if executor is None or executor is not self._executor:
+                return  # Already restarted by another caller
+            self._executor = None
+            self.restarts += 1
+        # A stuck task never returns, so its worker is killed rather than waited for
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+def create_process_pool(max_workers):
+    """Return an `ExtractionPool` with up to `max_workers` worker processes."""
+    return ExtractionPool(max_workers)
+
+
+def _remaining(deadline):
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def _task_result(pool, future, fn, args, deadline):
+    """Result of one task: from its pool `future`, resubmitted once if the pool broke, else run here.
+
+    Raises TimeoutError once `deadline` passes; the pool is then restarted.
+    """
+    if future is None:
+        return fn(*args)
+    for attempt in range(2):
+        try:
+            return future.result(timeout=_remaining(deadline))
+        except FutureTimeoutError:
+            pool.restart(future)
+            raise TimeoutError("extraction timed out") from None
+        except (BrokenProcessPool, CancelledError):
+            # Cancelled: queued when another caller restarted the pool
+            pool.restart(future)
+            if attempt:
+                break
+            try:
+                future = pool.submit(fn, *args)
+            except Exception:
+                break
+    return fn(*args)
+
+
+def pdf_page_count(path):
+    from PyPDF2 import PdfReader
+
+    with open(path, 'rb') as fh:
+        reader = PdfReader(fh)
+        if reader.is_encrypted:
+            reader.decrypt("")
+        return len(reader.pages)
+
+
+def extract_pdf_pages(path, start, stop):
+    """Return [(page number, text)] for pages start..stop-1 (0-based) of the PDF at `path`.
+
+    The file is read through an open handle so only the requested pages are parsed.
+    """
+    from PyPDF2 import PdfReader
+
+    with open(path, 'rb') as fh:
+        reader = PdfReader(fh)
+        if reader.is_encrypted:
+            reader.decrypt("")
+        pages = []
+        for index in range(start, stop):
+            try:
+                text = reader.pages[index].extract_text() or ""
+            except Exception as e:
+                text = f"[Could not extract page text: {e}]"
+            pages.append((index + 1, "\n".join(line.rstrip() for line in text.splitlines()).strip()))
+        return pages
+
+
+def _docx_cell_text(cell):
+    return " ".join(cell.text.split()).replace("|", "/")
+
+
+def _docx_table_rows(table):
+    """Pipe rows for a table; horizontally merged cells (repeated by python-docx) appear once."""
+    rows = []
+    for row in table.rows:
+        cells = []
+        previous = None
+        for cell in row.cells:
+            if cell._tc is previous:
+                continue
+            previous = cell._tc
+            cells.append(_docx_cell_text(cell))
+        if any(cells):
+            rows.append("| " + " | ".join(cells) + " |")
+    return rows
+
+
+def extract_docx(path):
+    """Return (text, paragraph count, table count) for the DOCX file at `path`.
+
+    Body paragraphs and tables are read in document order. Headings become
+    markdown headings, list items become bullets, and tables become compact pipe
+    rows without a separator line.
+    """
+    from docx import Document
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+
+    document = Document(path)
+    lines = []
+    paragraphs = tables = 0
+    for element in document.element.body.iterchildren():
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'p':
+            paragraph = Paragraph(element, document)
+            text = " ".join(paragraph.text.split())
+            if not text:
+                continue
+            paragraphs += 1
+            style = (paragraph.style.name if paragraph.style is not None else "") or ""
+            if style == 'Title':
+                lines.append(f"# {text}")
+            elif style.startswith('Heading') and style[7:].strip().isdigit():
+                lines.append(f"{'#' * min(6, int(style[7:]))} {text}")
+            elif style.startswith('List'):
+                lines.append(f"- {text}")
+            else:
+                lines.append(text)
+        elif tag == 'tbl':
+            rows = _docx_table_rows(Table(element, document))
+            if rows:
+                tables += 1
+                lines.append("\n".join(rows))
+    return "\n\n".join(lines), paragraphs, tables
+
+
+def _format_pdf_pages(pages):
+    parts = []
+    for number, text in pages:
+        parts.append(f"[Page {number}]\n{text}" if text else f"[Page {number}]\n(no extractable text; scanned image?)")
+    return "\n\n".join(parts)
+
+
+def _extract_inline(name, path):
+    """Extraction for formats that are cheap enough to run in the calling thread."""
+    extension = Path(name).suffix.lower()
+    if extension in ['.txt', '.md']:
+        with open(path, encoding='utf-8') as fh:
+            return fh.read()
+    if extension in IMAGE_EXTENSIONS:
+        return f"[Image: {name} (attached to this request as an image)]"
+    return f"[{extension.upper()} Document: {name}]"
+
+
+def _info(name, started, finished=None, **fields):
+    info = {"name": name, "pages": None, "empty_pages": 0, "seconds": 0.0, "error": None}
+    info.update(fields)
+    info["seconds"] = round((finished or time.monotonic()) - started, 3)
+    return info
+
+
+def _plan_tasks(name, extension, path):
+    """Split one pooled document into (function, args) tasks plus fields for its info."""
+    if extension == '.pdf':
+        page_count = pdf_page_count(path)
+        ranges = range(0, page_count, PDF_PAGES_PER_TASK)
+        return [(extract_pdf_pages, (path, s, min(s + PDF_PAGES_PER_TASK, page_count))) for s in ranges], {"pages": page_count}
+    if extension in structured.STRUCTURED_EXTENSIONS:
+        return [(structured.ingest_file, (path, name))], {}
+    return [(extract_docx, (path,))], {}
+
+
+def _assemble(extension, results, fields):
+    if extension == '.pdf':
+        pages = [page for chunk in results for page in chunk]
+        return _format_pdf_pages(pages), dict(fields, empty_pages=sum(1 for _, text in pages if not text))
+    if extension in structured.STRUCTURED_EXTENSIONS:
+        text, outline_fields = results[0]
+        return text, dict(fields, **outline_fields)
+    text, paragraphs, tables = results[0]
+    return text, dict(fields, paragraphs=paragraphs, tables=tables)
+
+
+# Formats parsed in the process pool; anything else is cheap enough to decode inline
+POOLED_EXTENSIONS = ('.pdf', '.docx') + structured.STRUCTURED_EXTENSIONS
+# Formats sent to the model as image content blocks (see `prepare_image`)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Every format an upload may have; other files in an uploaded archive are skipped
+SUPPORTED_EXTENSIONS = ('.txt', '.md') + POOLED_EXTENSIONS + IMAGE_EXTENSIONS
+
+
+def extract_files(files, pool=None, timeout=None):
+    """Extract text from (file name, path) pairs; return [(text, info)] in the same order.
+
+    PDF, DOCX, YAML and JSON files are parsed in `pool`: each DOCX, YAML or
+    JSON file is one task and each PDF is cut into PDF_PAGES_PER_TASK-page
+    ranges. Workers read the files from `path`, so no file content is copied
+    between processes. All tasks of all files are submitted up front, so an
+    upload batch takes about as long as its largest file. Without a pool (or
+    if it breaks twice) the tasks run in this process. A file whose tasks take
+    longer than `timeout` seconds once this call starts waiting on it becomes
+    an extraction error, and the pool is restarted to stop them. `info` holds
+    the page count (PDF), paragraph and table counts (DOCX), the outline
+    summary and finding count (YAML/JSON), extraction time and any error;
+    failures produce an "[Error reading ...]" placeholder instead of raising.
+    """
+    results = [None] * len(files)
+    pooled = []
+    for index, (name, path) in enumerate(files):
+        started = time.monotonic()
+        extension = Path(name).suffix.lower()
+        try:
+            if extension not in POOLED_EXTENSIONS:
+                results[index] = (_extract_inline(name, path), _info(name, started))
+                continue
+            tasks, fields = _plan_tasks(name, extension, path)
+        except Exception as e:
+            results[index] = (f"[Error reading {name}: {str(e)}]", _info(name, started, error=str(e)))
+            continue
+        futures = None
+        # Completion time of each task, so a file's time excludes waiting on earlier files
+        finished = []
+        if pool is not None:
+            try:
+                futures = [pool.submit(fn, *args) for fn, args in tasks]
+            except Exception:
+                futures = None
+            for future in futures or []:
+                future.add_done_callback(lambda _, finished=finished: finished.append(time.monotonic()))
+        pooled.append((index, name, extension, started, tasks, futures, fields, finished))
+
+    for index, name, extension, started, tasks, futures, fields, finished in pooled:
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            task_results = [
+                _task_result(pool, futures[i] if futures else None, fn, args, deadline)
+                for i, (fn, args) in enumerate(tasks)
+            ]
+            text, fields = _assemble(extension, task_results, fields)
+        except TimeoutError:
+            error = f"extraction took longer than {timeout:.0f}s"
+            results[index] = (f"[Error reading {name}: {error}]", _info(name, started, error=error))
+            continue
+        except Exception as e:
+            results[index] = (f"[Error reading {name}: {str(e)}]", _info(name, started, error=str(e)))
+            continue
+        results[index] = (text, _info(name, started, finished=max(finished) if futures else None, **fields))
+    return results
+
+
+def extract_documents(documents, pool=None, timeout=None):
+    """`extract_files` for (file name, bytes) pairs, written to a temporary directory first."""
+    with tempfile.TemporaryDirectory(prefix="threat-modeling-extract-") as tmp_dir:
+        files = []
+        for index, (name, data) in enumerate(documents):
+            path = os.path.join(tmp_dir, f"{index}{Path(name).suffix.lower()}")
+            with open(path, 'wb') as fh:
+                fh.write(data)
+            files.append((name, path))
+        return extract_files(files, pool=pool, timeout=timeout)
+
+
+def _image_encoding():
+    """(Pillow format, media type) for re-encoded images: WebP where Pillow supports it, else JPEG."""
+    from PIL import features
+
+    return ("WEBP", "image/webp") if features.check("webp") else ("JPEG", "image/jpeg")
+
+
+def _source_size(source):
+    return len(source) if isinstance(source, bytes) else os.path.getsize(source)
+
+
+def prepare_image(source, max_edge, quality):
+    """Downscale and re-encode one image (bytes or a path); return (encoded bytes, media type, info).
+
+    The image is rotated per its EXIF orientation, scaled so its longest edge is
+    at most `max_edge` pixels and saved as lossy WebP (JPEG without WebP support)
+    at `quality`. Only pixels are written, so EXIF, GPS, ICC and text chunks
+    are dropped. Transparency is flattened onto white.
+    """
+    from PIL import Image, ImageOps
+
+    started = time.monotonic()
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as original:
+        original_format = original.format
+        image = ImageOps.exif_transpose(original)
+        original_size = image.size
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, "white")
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        pil_format, media_type = _image_encoding()
+        buffer = io.BytesIO()
+        if pil_format == "WEBP":
+            image.save(buffer, format=pil_format, quality=quality, method=4)
+        else:
+            image.save(buffer, format=pil_format, quality=quality, optimize=True)
+    encoded = buffer.getvalue()
+    info = {
+        "original_format": original_format,
+        "original_width": original_size[0],
+        "original_height": original_size[1],
+        "original_bytes": _source_size(source),
+        "format": pil_format,
+        "width": image.size[0],
+        "height": image.size[1],
+        "bytes": len(encoded),
+        "seconds": round(time.monotonic() - started, 3),
+    }
+    return encoded, media_type, info
+
+
+def prepare_images(images, max_edge, quality, pool=None, timeout=None):
+    """Run `prepare_image` for (name, bytes or path, max edge or None) triples; return results in order.
+
+    Each result is (encoded bytes, media type, info) or (None, None, info) with
+    the error in `info["error"]`. Images are processed concurrently in `pool`,
+    or in this process without one; as in `extract_files`, an image that takes
+    longer than `timeout` seconds becomes an error.
+    """
+    futures = None
+    if pool is not None:
+        try:
+            futures = [pool.submit(prepare_image, source, edge or max_edge, quality) for _, source, edge in images]
+        except Exception:
+            futures = None
+    results = []
+    for i, (name, source, edge) in enumerate(images):
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            encoded, media_type, info = _task_result(
+                pool, futures[i] if futures else None, prepare_image, (source, edge or max_edge, quality), deadline
+            )
+        except Exception as e:
+            error = f"processing took longer than {timeout:.0f}s" if isinstance(e, TimeoutError) else str(e)
+            results.append((None, None, {"name": name, "original_bytes": _source_size(source), "error": error}))
+            continue
+        results.append((encoded, media_type, dict(info, name=name, error=None)))
+    return results
@@ -0,0 +1,954 @@
+"""
+PDF rendering of threat assessment reports, and the process pool renders run in.
+
+A report is converted from markdown to HTML once (`convert_markdown`); the
+in-app preview and both PDF engines work from that one `ReportHtml`.
+
+Kept free of Streamlit imports, like `extractors`, so render workers can import
+it cheaply. WeasyPrint layout of a long report is CPU-heavy and can use a lot
+of memory, so the app renders in `RenderPool` workers: each worker's address
+space is capped, and a render that runs past its timeout is stopped by killing
+its worker. `render_pdf` then falls back to ReportLab.
+"""
+
+import base64
+import functools
+import io
+import multiprocessing
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+
+class RenderTimeout(RuntimeError):
+    """A render did not finish within its timeout; its worker was killed."""
+
+
+class RenderFailed(RuntimeError):
+    """A render raised an exception in its worker, or the worker died."""
+
+
+class RenderPoolUnavailable(RuntimeError):
+    """Worker processes cannot be started here."""
+
+
+class ReportHtml:
+    """A markdown report converted to HTML once, for the preview and every exporter.
+
+    `html` is the body and `toc` the table of contents (an HTML list of the
+    headings). If python-markdown is not installed, `html` is the escaped
+    markdown in a <pre> block, `toc` is empty and `error` says why. `soup()`
+    parses `html` into a BeautifulSoup tree on first use; the tree is not
+    pickled, so sending the report to a render worker only copies the HTML.
+    """
+
+    def __init__(self, html, toc="", error=None):
+        self.html = html
+        self.toc = toc
+        self.error = error
+        self._soup = None
+
+    def soup(self):
+        if self._soup is None:
+            from bs4 import BeautifulSoup
+
+            self._soup = BeautifulSoup(self.html, 'html.parser')
+        return self._soup
+
+    def __getstate__(self):
+        return dict(self.__dict__, _soup=None)
+
+    def __len__(self):
+        return len(self.html) + len(self.toc)
+
+
+def convert_markdown(markdown_text):
+    """Convert a markdown report to a ReportHtml with python-markdown (tables, fenced code, TOC)."""
+    try:
+        import markdown as _markdown  # optional
+    except ImportError as e:
+        escaped = (markdown_text or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        return ReportHtml(f"<pre>{escaped}</pre>", error=str(e))
+    md = _markdown.Markdown(extensions=["tables", "fenced_code", "toc"])
+    html = md.convert(markdown_text or "")
+    return ReportHtml(html, getattr(md, 'toc', ''))
+
+
+def clean_markdown_artifacts(html_text):
+    """Clean up common markdown artifacts from HTML output."""
+    # Remove literal \n sequences that appear as text
+    html_text = html_text.replace('\\n', ' ')
+    # Remove markdown link syntax that might not have been converted
+    html_text = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'<a href="\2">\1</a>', html_text)
+    # Clean up double spaces
+    html_text = re.sub(r'  +', ' ', html_text)
+    return html_text
+
+
+# Risk levels and priorities highlighted in exported reports: CSS class (WeasyPrint) and color (ReportLab)
+RISK_LEVELS = {
+    'CRITICAL': ('risk-critical', 'c53030'),
+    'HIGH': ('risk-high', 'd97706'),
+    'MEDIUM': ('risk-medium', 'd69e2e'),
+    'LOW': ('risk-low', '22543d'),
+    'P0': ('priority-critical', 'c53030'),
+    'P1': ('priority-high', 'd97706'),
+}
+# A tag (left as is, so attributes and URLs are never rewritten) or a level word in text
+_RISK_TERM = re.compile(r'<[^>]*>|\b(CRITICAL|Critical|HIGH|High|MEDIUM|Medium|LOW|Low|P0|P1)\b')
+# Replacement markup for each spelling of each level
+_RISK_SPANS = {
+    word: f'<span class="{css_class}">{word}</span>'
+    for level, (css_class, _) in RISK_LEVELS.items() for word in (level, level.capitalize())
+}
+_RISK_FONTS = {
+    word: f'<font color="#{color}"><b>{word}</b></font>'
+    for level, (_, color) in RISK_LEVELS.items() for word in (level, level.capitalize())
+}
+
+def annotate_risk_levels(html_text, markup):
+    """Wrap the risk level words in the text of `html_text` with `markup[word]`, in one pass.
+
+    Tags are matched by the same expression and copied unchanged, so only text
+    between tags is annotated.
+    """
+    def replace(match):
+        word = match.group(1)
+        return match.group(0) if word is None else markup[word]
+
+    return _RISK_TERM.sub(replace, html_text)
+
+
+def apply_risk_styling(html_text):
+    """Apply color styling (risk-* and priority-* classes) to risk level indicators in HTML."""
+    return annotate_risk_levels(html_text, _RISK_SPANS)
+
+
+# Static stylesheet of WeasyPrint reports. It is parsed once per process
+# (`_weasyprint_styles`); the footer text is added per render in the document.
+REPORT_STYLESHEET = """
+* { margin: 0; padding: 0; box-sizing: border-box; }
+
+/* Page setup */
+@page {
+    size: A4;
+    margin: 2cm 2cm 2.5cm 2cm;
+    @bottom-left {
+        font-size: 9pt;
+        color: #666;
+    }
+    @bottom-right {
+        content: "Page " counter(page) " of " counter(pages);
+        font-size: 9pt;
+        color: #666;
+    }
+}
+@page :first { margin-top: 2.5cm; }
+
+html {
+    width: 100%;
+}
+
+body {
+    width: 100%;
+    min-height: 100%;
+    font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', 'Roboto', 'Oxygen', 'Ubuntu', sans-serif;
+    font-size: 11pt;
+    line-height: 1.5;
+    color: #1a202c;
+    background: white;
+    padding: 0;
+    margin: 0;
+}
+
+/* Header section */
+.doc-header {
+    border-bottom: 3px solid #2d3748;
+    padding: 1.5rem 0;
+    margin-bottom: 2rem;
+    display: flex;
+    justify-content: space-between;
+    align-items: flex-start;
+}
+
+.logo-section { flex: 0 0 auto; }
+.logo-section img { max-width: 100px; height: auto; }
+
+.title-section {
+    flex: 1;
+    text-align: center;
+    padding: 0 2rem;
+}
+
+.title-section h1 {
+    font-size: 28pt;
+    color: #1a202c;
+    margin: 0 0 0.5rem 0;
+    font-weight: 700;
+}
+
+.title-section p {
+    font-size: 12pt;
+    color: #666;
+    margin: 0;
+}
+
+.date-section {
+    flex: 0 0 auto;
+    text-align: right;
+    font-size: 10pt;
+    color: #666;
+}
+
+/* Table of Contents */
+.toc-container {
+    background: #f7fafc;
+    border-left: 4px solid #2d3748;
+    padding: 1.5rem;
+    margin: 2rem 0;
+    page-break-inside: avoid;
+    border-radius: 4px;
+}
+
+.toc-container h2 {
+    font-size: 14pt;
+    margin: 0 0 1rem 0;
+    color: #1a202c;
+}
+
+.toc-container ul {
+    list-style: none;
+    padding: 0;
+    margin: 0;
+}
+
+.toc-container li {
+    margin: 0.4rem 0;
+    padding-left: 1.5rem;
+}
+
+.toc-container a {
+    color: #2c5282;
+    text-decoration: none;
+    font-size: 10pt;
+}
+
+/* Main content */
+main {
+    padding: 0;
+}
+
+/* Headings with page break control */
+h1 {
+    font-size: 22pt;
+    color: #1a202c;
+    margin: 3rem 0 1.5rem 0;
+    padding: 0.8rem 0 0.5rem 0;
+    border-bottom: 3px solid #2d3748;
+    page-break-before: always;
+    page-break-after: avoid;
+    font-weight: 700;
+    letter-spacing: 0.5px;
+}
+
+h1:first-of-type {
+    page-break-before: avoid;
+    margin-top: 0;
+}
+
+h2 {
+    font-size: 16pt;
+    color: #2d3748;
+    margin: 2.2rem 0 1rem 0;
+    padding-top: 0.8rem;
+    padding-bottom: 0.3rem;
+    border-bottom: 2px solid #cbd5e0;
+    page-break-after: avoid;
+    font-weight: 700;
+}
+
+h3 {
+    font-size: 13pt;
+    color: #2c5282;
+    margin: 1.5rem 0 0.8rem 0;
+    padding-top: 0.5rem;
+    page-break-after: avoid;
+    font-weight: 700;
+}
+
+h4 {
+    font-size: 11.5pt;
+    color: #4a5568;
+    margin: 1.2rem 0 0.6rem 0;
+    page-break-after: avoid;
+    font-weight: 600;
+}
+
+h5, h6 {
+    font-size: 10.5pt;
+    color: #4a5568;
+    margin: 1rem 0 0.5rem 0;
+    page-break-after: avoid;
+    font-weight: 600;
+}
+
+/* Paragraphs with proper spacing */
+p {
+    margin: 1rem 0;
+    text-align: justify;
+    line-height: 1.6;
+    orphans: 3;
+    widows: 3;
+}
+
+/* Lists with proper spacing */
+ul, ol {
+    margin: 1.2rem 0;
+    padding-left: 2.2rem;
+}
+
+li {
+    margin: 0.6rem 0;
+    padding-left: 0.4rem;
+    line-height: 1.5;
+}
+
+ul ul, ol ol, ul ol, ol ul {
+    margin: 0.6rem 0;
+    padding-left: 2rem;
+}
+
+/* Tables with professional styling */
+table {
+    width: 100%;
+    max-width: 100%;
+    border-collapse: collapse;
+    margin: 1.6rem 0;
+    page-break-inside: auto;
+    font-size: 8pt;
+    background: white;
+    table-layout: fixed;
+}
+
+table tr {
+    page-break-inside: avoid;
+    page-break-after: auto;
+}
+
+table, th, td {
+    border: 1px solid #cbd5e0;
+}
+
+th {
+    background: #2d3748;
+    color: white;
+    padding: 0.55rem 0.5rem;
+    text-align: left;
+    font-weight: 700;
+    font-size: 8pt;
+    word-wrap: break-word;
+    overflow-wrap: anywhere;
+    max-width: 110px;
+}
+
+td {
+    padding: 0.45rem 0.55rem;
+    vertical-align: top;
+    line-height: 1.35;
+    word-wrap: break-word;
+    overflow-wrap: anywhere;
+    max-width: 110px;
+}
+
+tbody tr:nth-child(odd) {
+    background: #f7fafc;
+}
+
+tbody tr:nth-child(even) {
+    background: white;
+}
+
+tbody tr:hover {
+    background: #edf2f7;
+}
+
+/* Risk level styling in tables */
+td:contains('CRITICAL'),
+td:contains('Critical') {
+    color: #c53030;
+    font-weight: 700;
+}
+
+td:contains('HIGH'),
+td:contains('High') {
+    color: #d97706;
+    font-weight: 700;
+}
+
+td:contains('MEDIUM'),
+td:contains('Medium') {
+    color: #d69e2e;
+    font-weight: 700;
+}
+
+td:contains('LOW'),
+td:contains('Low') {
+    color: #22543d;
+    font-weight: 600;
+}
+
+/* Code blocks with better styling */
+pre {
+    background: #1e293b;
+    color: #e2e8f0;
+    padding: 1.2rem;
+    border-radius: 5px;
+    margin: 1.5rem 0;
+    overflow-x: auto;
+    page-break-inside: avoid;
+    font-size: 8.5pt;
+    line-height: 1.5;
+    font-family: 'Courier New', 'Consolas', monospace;
+    white-space: pre-wrap;
+    word-wrap: break-word;
+    border-left: 4px solid #3b82f6;
+}
+
+pre code {
+    background: none;
+    color: #e2e8f0;
+    padding: 0;
+    border-radius: 0;
+    font-size: 8.5pt;
+    font-weight: 400;
+}
+
+code {
+    background: #f1f5f9;
+    color: #d97706;
+    padding: 2px 6px;
+    border-radius: 3px;
+    font-family: 'Courier New', 'Consolas', monospace;
+    font-size: 9pt;
+    font-weight: 500;
+}
+
+/* Risk levels and emphasis */
+strong, b {
+    font-weight: 700;
+    color: #1a202c;
+}
+
+em, i {
+    font-style: italic;
+    color: #4a5568;
+}
+
+/* Risk level styling with color-coding */
+.risk-critical {
+    color: #c53030;
+    font-weight: 700;
+    background: #fdf2f2;
+    padding: 2px 6px;
+    border-radius: 3px;
+}
+
+.risk-high {
+    color: #d97706;
+    font-weight: 700;
+    background: #fffbf0;
+    padding: 2px 6px;
+    border-radius: 3px;
+}
+
+.risk-medium {
+    color: #d69e2e;
+    font-weight: 700;
+    background: #fffaf0;
+    padding: 2px 6px;
+    border-radius: 3px;
+}
+
+.risk-low {
+    color: #22543d;
+    font-weight: 600;
+    background: #f0fdf4;
+    padding: 2px 6px;
+    border-radius: 3px;
+}
+
+/* Priority styling */
+.priority-critical {
+    color: #c53030;
+    font-weight: 700;
+    background: #fdf2f2;
+    padding: 2px 6px;
+    border-radius: 3px;
+}
+
+.priority-high {
+    color: #d97706;
+    font-weight: 700;
+    background: #fffbf0;
+    padding: 2px 6px;
+    border-radius: 3px;
+}
+
+/* Finding boxes */
+.finding-critical {
+    border-left: 5px solid #c53030;
+    background: #fdf2f2;
+    padding: 1rem;
+    margin: 1.5rem 0;
+    page-break-inside: avoid;
+    border-radius: 3px;
+}
+
+.finding-high {
+    border-left: 5px solid #d97706;
+    background: #fffbf0;
+    padding: 1rem;
+    margin: 1.5rem 0;
+    page-break-inside: avoid;
+    border-radius: 3px;
+}
+
+/* Important pointers */
+.important {
+    background: #fffaf0;
+    border-left: 4px solid #d69e2e;
+    padding: 0.8rem;
+    margin: 1rem 0;
+    page-break-inside: avoid;
+    font-size: 10pt;
+}
+
+/* Section dividers */
+hr {
+    border: none;
+    border-top: 2px solid #cbd5e0;
+    margin: 2.5rem 0;
+    page-break-after: avoid;
+}
+
+/* Blockquotes */
+blockquote {
+    border-left: 4px solid #cbd5e0;
+    padding-left: 1rem;
+    margin: 1.5rem 0;
+    padding: 0.8rem 1rem;
+    color: #4a5568;
+    background: #f7fafc;
+    page-break-inside: avoid;
+    font-style: italic;
+}
+
+/* Links */
+a {
+    color: #2c5282;
+    text-decoration: none;
+    page-break-inside: avoid;
+}
+
+a:hover {
+    text-decoration: underline;
+}
+
+/* Horizontal rule */
+hr {
+    border: none;
+    border-top: 1px solid #e2e8f0;
+    margin: 2rem 0;
+    page-break-after: avoid;
+}
+
+/* Page breaks */
+.page-break {
+    page-break-before: always;
+}
+
+/* Ensure proper spacing */
+main > *:first-child {
+    margin-top: 0;
+}
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def _weasyprint_styles():
+    """(CSS, FontConfiguration) for REPORT_STYLESHEET, built on the first WeasyPrint render in a process."""
+    from weasyprint import CSS  # optional
+    try:
+        from weasyprint.text.fonts import FontConfiguration  # WeasyPrint 53+
+    except ImportError:
+        from weasyprint.fonts import FontConfiguration
+
+    font_config = FontConfiguration()
+    return CSS(string=REPORT_STYLESHEET, font_config=font_config), font_config
+
+
+def _css_string(text):
+    """`text` escaped for use inside a double-quoted CSS string."""
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def render_weasyprint(report, branding):
+    """Render a ReportHtml to PDF bytes with WeasyPrint (styled, with a table of contents)."""
+    if report.error:
+        raise ImportError(report.error)
+    from weasyprint import HTML  # optional
+
+    # Build logo HTML if available
+    logo_html = ""
+    if branding.get('logo_image'):
+        try:
+            logo_b64 = base64.b64encode(branding['logo_image']).decode()
+            logo_html = f'<img src="data:image/png;base64,{logo_b64}" style="max-width: 120px; height: auto;">'
+        except Exception:
+            pass
+
+    html_body = clean_markdown_artifacts(report.html)
+    html_body = apply_risk_styling(html_body)  # Apply color styling to risk levels
+    toc_html = clean_markdown_artifacts(report.toc)
+
+    company_header = branding.get('company_name') or "Threat Assessment"
+    footer_text = branding.get('report_footer') or f"Generated {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+
+    full_html = f"""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="utf-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>{company_header} - Threat Assessment</title>
+        <style>
+            @page {{ @bottom-left {{ content: "{_css_string(footer_text)}"; }} }}
+        </style>
+    </head>
+    <body>
+    <div class="doc-header">
+        <div class="logo-section">{logo_html}</div>
+        <div class="title-section">
+            <h1>{company_header}</h1>
+            <p>Enterprise Threat Assessment Report</p>
+        </div>
+        <div class="date-section">
+            <p>Report Date</p>
+            <p>{datetime.now().strftime('%B %d, %Y')}</p>
+        </div>
+    </div>
+
+    <div class="toc-container">
+        <h2>Contents</h2>
+        {toc_html}
+    </div>
+
+    <main>{html_body}</main>
+    </body>
+    </html>
+    """
+
+    # Generate PDF with full content rendering (no truncation)
+    stylesheet, font_config = _weasyprint_styles()
+    pdf_bytes = HTML(string=full_html).write_pdf(
+        stylesheets=[stylesheet],
+        font_config=font_config,
+        presentational_hints=True,
+        optimize_size=('fonts',)  # Optimize fonts but keep full content
+    )
+    return pdf_bytes
+
+
+def render_reportlab(report, branding):
+    """Render a ReportHtml to PDF bytes with ReportLab (basic styling, no system libraries needed)."""
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import cm
+    from reportlab.lib import colors
+
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=A4,
+        leftMargin=2*cm,
+        rightMargin=2*cm,
+        topMargin=2*cm,
+        bottomMargin=2*cm,
+    )
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name='H1', fontSize=18, leading=22, spaceAfter=10, spaceBefore=10))
+    styles.add(ParagraphStyle(name='H2', fontSize=14, leading=18, spaceAfter=8, spaceBefore=8))
+    styles.add(ParagraphStyle(name='H3', fontSize=12, leading=16, spaceAfter=6, spaceBefore=6))
+    header_style = ParagraphStyle(
+        name='TableHeader',
+        parent=styles['BodyText'],
+        fontName='Helvetica-Bold',
+        textColor=colors.white,
+        fontSize=8,
+        leading=10
+    )
+    story = []
+
+    # Title
+    header_text = branding.get('company_name') or "Threat Assessment"
+    story.append(Paragraph(f"{header_text} - Threat Assessment", styles['Title']))
+    story.append(Spacer(1, 12))
+
+    soup = report.soup()
+
+    def colorize_text(text: str) -> str:
+        # Apply risk colors recognized by ReportLab (<font color="...">)
+        return annotate_risk_levels(text, _RISK_FONTS)
+
+    def add_table(table_tag):
+        rows = []
+        for tr in table_tag.find_all('tr'):
+            cells = []
+            for cell in tr.find_all(['th', 'td']):
+                cell_text = colorize_text(cell.get_text(" ", strip=True))
+                cell_style = header_style if cell.name == 'th' else styles['BodyText']
+                cells.append(Paragraph(cell_text or " ", cell_style))
+            rows.append(cells)
+        if not rows:
+            return
+        tbl = Table(rows, repeatRows=1)
+        style_cmds = [
+            ('GRID', (0,0), (-1,-1), 0.5, colors.HexColor('#cbd5e0')),
+            ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#2d3748')),
+            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0,0), (-1,-1), 8),
+            ('VALIGN', (0,0), (-1,-1), 'TOP'),
+        ]
+        # Zebra stripes for body
+        for i in range(1, len(rows)):
+            bg = colors.HexColor('#f7fafc') if i % 2 == 1 else colors.white
+            style_cmds.append(('BACKGROUND', (0,i), (-1,i), bg))
+        tbl.setStyle(TableStyle(style_cmds))
+        story.append(tbl)
+        story.append(Spacer(1, 10))
+
+    # Walk top-level elements and render
+    for el in soup.contents:
+        name = getattr(el, 'name', None)
+        if not name:
+            # Text node
+            txt = str(el).strip()
+            if txt:
+                story.append(Paragraph(colorize_text(txt), styles['BodyText']))
+                story.append(Spacer(1, 6))
+            continue
+
+        if name in ('h1', 'h2', 'h3'):
+            style = styles['H1'] if name == 'h1' else styles['H2'] if name == 'h2' else styles['H3']
+            story.append(Paragraph(colorize_text(el.get_text()), style))
+            story.append(Spacer(1, 6))
+        elif name == 'p':
+            story.append(Paragraph(colorize_text(el.decode_contents()), styles['BodyText']))
+            story.append(Spacer(1, 6))
+        elif name == 'table':
+            add_table(el)
+        else:
+            # Fallback for other tags
+            story.append(Paragraph(colorize_text(el.get_text()), styles['BodyText']))
+            story.append(Spacer(1, 6))
+
+    doc.build(story)
+    return buffer.getvalue()
+
+
+# WeasyPrint and ReportLab are not documented as thread-safe; renders outside the pool run one at a time
+_inline_render_lock = threading.Lock()
+
+
+def _render(renderer, report, branding, pool, timeout):
+    if pool is not None:
+        try:
+            return pool.run(renderer, (report, branding), timeout)
+        except RenderPoolUnavailable:
+            pass
+    with _inline_render_lock:
+        return renderer(report, branding)
+
+
+def render_pdf(report, branding, pool=None, timeout=None):
+    """Render a ReportHtml (see `convert_markdown`) to PDF bytes with WeasyPrint, or ReportLab as a fallback.
+
+    With a `pool`, each engine runs in a worker process for at most `timeout`
+    seconds; a WeasyPrint render that fails, times out or exhausts its worker's
+    memory is retried with ReportLab. Returns (PDF bytes, error). `error`
+    describes why WeasyPrint could not be used and is None for a WeasyPrint
+    render; the PDF bytes are None when neither engine succeeded.
+    """
+    try:
+        return _render(render_weasyprint, report, branding, pool, timeout), None
+    except Exception as e:
+        error = str(e)
+    try:
+        return _render(render_reportlab, report, branding, pool, timeout), error
+    except Exception:
+        return None, error
+
+
+def _limit_memory(max_bytes):
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows; renders there rely on the timeout alone
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        max_bytes = min(max_bytes, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, hard))
+
+
+def _worker_main(conn, max_bytes):
+    """Render worker loop: run each (function, args) received on `conn` and send back (ok, result or error)."""
+    if max_bytes:
+        _limit_memory(max_bytes)
+    while True:
+        try:
+            fn, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            result = (True, fn(*args))
+        except MemoryError:
+            result = (False, "MemoryError: the render exceeded the worker memory limit")
+        except Exception as e:
+            result = (False, f"{type(e).__name__}: {e}")
+        conn.send(result)
+
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(5)
+        self.conn.close()
+
+
+class RenderPool:
+    """Up to `workers` long-lived render processes, each running one render at a time.
+
+    Workers are spawned on first use (like the extraction pool, never forked)
+    and kept for later renders, so the PDF libraries are imported once per
+    worker. A worker whose render times out or that dies is killed and
+    replaced on the next render. Callers beyond `workers` wait in a queue;
+    `stats()` reports its depth and the durations of recent renders.
+    """
+
+    def __init__(self, workers, memory_bytes=None, history=200):
+        self.workers = max(1, workers)
+        self.memory_bytes = memory_bytes
+        self._context = multiprocessing.get_context("spawn")
+        self._cond = threading.Condition()
+        self._idle = []
+        self._live = 0
+        self._queued = 0
+        self._busy = 0
+        self._renders = deque(maxlen=history)
+
+    def _acquire(self):
+        with self._cond:
+            self._queued += 1
+            try:
+                while not self._idle and self._live >= self.workers:
+                    self._cond.wait()
+            finally:
+                self._queued -= 1
+            self._busy += 1
+            if self._idle:
+                return self._idle.pop()
+            self._live += 1
+        try:
+            parent, child = self._context.Pipe()
+            process = self._context.Process(
+                target=_worker_main, args=(child, self.memory_bytes), name="pdf-render", daemon=True
+            )
+            process.start()
+            child.close()
+            return _Worker(process, parent)
+        except Exception as e:
+            self._release(None)
+            raise RenderPoolUnavailable(str(e)) from e
+
+    def _release(self, worker):
+        with self._cond:
+            self._busy -= 1
+            if worker is not None:
+                self._idle.append(worker)
+            else:
+                self._live -= 1
+            self._cond.notify()
+
+    def run(self, fn, args, timeout=None):
+        """Run `fn(*args)` in a worker and return its result.
+
+        `fn` must be picklable (a module-level function). Raises RenderTimeout
+        after `timeout` seconds, and RenderFailed if `fn` raises or the worker
+        dies.
+        """
+        worker = self._acquire()
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            try:
+                worker.conn.send((fn, args))
+                if not worker.conn.poll(timeout):
+                    outcome = "timeout"
+                    raise RenderTimeout(f"{fn.__name__} did not finish within {timeout:g} s")
+                ok, value = worker.conn.recv()
+            except (EOFError, OSError) as e:
+                outcome = "crashed"
+                worker.process.join(5)
+                raise RenderFailed(f"{fn.__name__} worker exited (exit code {worker.process.exitcode})") from e
+            if not ok:
+                raise RenderFailed(value)
+            outcome = "ok"
+            return value
+        finally:
+            if outcome in ("timeout", "crashed"):
+                worker.kill()
+                worker = None
+            with self._cond:
+                self._renders.append({
+                    "renderer": fn.__name__,
+                    "seconds": round(time.monotonic() - started, 3),
+                    "outcome": outcome,
+                })
+            self._release(worker)
+
+    def close(self):
+        """Stop the idle workers; busy ones are stopped when their render finishes."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._live -= len(idle)
+        for worker in idle:
+            worker.kill()
+
+    def stats(self):
+        with self._cond:
+            renders = list(self._renders)
+            queued, busy, live = self._queued, self._busy, self._live
+        durations = sorted(r["seconds"] for r in renders if r["outcome"] == "ok")
+        outcomes = [r["outcome"] for r in renders]
+
+        def percentile(q):
+            return durations[min(len(durations) - 1, int(q * len(durations)))] if durations else 0.0
+
+        return {
+            "workers": live,
+            "busy": busy,
+            "queued": queued,
+            "renders": len(renders),
+            "timeouts": outcomes.count("timeout"),
+            "failures": outcomes.count("error") + outcomes.count("crashed"),
+            "p50_seconds": percentile(0.5),
+            "p95_seconds": percentile(0.95),
+        }
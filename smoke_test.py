@@ -78,7 +78,11 @@ class FakeMessages:
         if not messages or not isinstance(messages, list):
             raise AssertionError("Messages API called without messages list")
         content = messages[0].get('content', '') if isinstance(messages[0], dict) else ''
-        if 'You are an expert' not in content:
+        # The role and static instructions are sent as a (cacheable) system prompt
+        system = kwargs.get('system') or ''
+        if isinstance(system, list):
+            system = ''.join(block.get('text', '') for block in system if isinstance(block, dict))
+        if 'You are an expert' not in system + content or 'SmokeTest' not in content:
             raise AssertionError("Messages content missing expected payload")
         return FakeCompletion(
             "TABLE OF CONTENTS\n- [EXECUTIVE SUMMARY](#executive-summary)\n- [THREAT MODELING ANALYSIS](#threat-modeling-analysis)\n- [REFERENCES](#references)\n\n## EXECUTIVE SUMMARY\nOverall Risk Rating: LOW\nTop 5 Findings:\n- Test finding 1\n- Test finding 2\n\n## THREAT MODELING ANALYSIS\n...\n\n## REFERENCES\n- [NIST SP 800-53] https://csrc.nist.gov/"
@@ -0,0 +1,588 @@
+"""
+Structured ingestion of YAML and JSON uploads (OpenAPI specs, Kubernetes
+manifests, IaC outputs such as Terraform plans or CloudFormation templates).
+
+Instead of the raw file, the model receives a compact outline: the servers,
+auth schemes, endpoints and schemas of an API spec, the workloads, services
+and ingresses of manifests, and security-relevant values found anywhere in the
+file (secret-like keys with their values redacted, ports, public CIDRs, risky
+flags, wildcard permissions). Schemas referenced through `$ref` are listed
+once with a reference count, repeated subtrees point to their first
+occurrence, and long arrays of similar items are shown as a sample. Outline
+lines carry JSON Pointers ("#/paths/~1users/get") the model can cite.
+
+Like `extractors`, kept free of Streamlit imports for the extraction pool.
+"""
+
+import json
+import re
+from pathlib import Path
+
+STRUCTURED_EXTENSIONS = ('.yaml', '.yml', '.json')
+
+# Keys whose values are credentials; their values are never sent
+SECRET_KEY = re.compile(
+    r'passw(or)?d|passphrase|secret|token|api[_-]?key|private[_-]?key|credential|access[_-]?key|'
+    r'connection[_-]?string|^auth$',
+    re.IGNORECASE,
+)
+# ...except keys that only name or locate a secret (secretName, tokenUrl, password_file)
+SECRET_REFERENCE_KEY = re.compile(r'(name|ref|arn|id|path|file|url|uri|endpoint)s?$', re.IGNORECASE)
+# Schema properties worth pointing out in an API spec
+SENSITIVE_FIELD = re.compile(
+    SECRET_KEY.pattern + r'|ssn|social|email|phone|birth|dob|card|iban|account[_-]?number|address|salary',
+    re.IGNORECASE,
+)
+PORT_KEY = re.compile(r'^(port|ports|containerPort|hostPort|nodePort|targetPort|from_port|to_port|FromPort|ToPort)$')
+PERMISSION_KEY = re.compile(r'^(verbs|resources|apiGroups|actions?|Action|Resource|resources?)$')
+# Flag values that widen the attack surface, by key
+RISKY_FLAGS = {
+    'privileged': True,
+    'allowPrivilegeEscalation': True,
+    'hostNetwork': True,
+    'hostPID': True,
+    'hostIPC': True,
+    'runAsNonRoot': False,
+    'readOnlyRootFilesystem': False,
+    'automountServiceAccountToken': True,
+    'publicly_accessible': True,
+    'PubliclyAccessible': True,
+    'encrypted': False,
+    'storage_encrypted': False,
+    'StorageEncrypted': False,
+    'skip_tls_verify': True,
+    'insecureSkipTLSVerify': True,
+}
+PUBLIC_CIDRS = ('0.0.0.0/0', '::/0')
+HTTP_METHODS = ('get', 'put', 'post', 'delete', 'patch', 'options', 'head', 'trace')
+
+# Arrays longer than this whose items look alike are shown as one sample
+ARRAY_SAMPLE_THRESHOLD = 5
+# Subtrees with at least this many scalar leaves are collapsed when repeated
+REPEAT_MIN_LEAVES = 4
+# Limits for the outline sections
+MAX_FINDINGS_PER_KIND = 40
+MAX_STRUCTURE_LINES = 300
+MAX_STRUCTURE_DEPTH = 8
+MAX_SCALAR_CHARS = 80
+# YAML aliases are loaded as shared objects, which the outline walks once per
+# reference; a few nested aliases ("billion laughs") expand exponentially. The
+# parsed documents may hold at most this many values, or one per byte of the
+# file if more, counting every alias expansion, and nest this deep.
+EXPANDED_VALUES_GRACE = 100000
+MAX_NESTING = 200
+
+
+class DocumentTooLarge(ValueError):
+    """Parsed documents expand to too many values, or nest too deep, to be outlined."""
+
+
+def pointer(parts):
+    """RFC 6901 JSON Pointer (URI fragment form) for a path of keys and indexes."""
+    return "#" + "".join("/" + str(part).replace("~", "~0").replace("/", "~1") for part in parts)
+
+
+def load_documents(data, extension):
+    """Parse JSON, or every document of a (multi-document) YAML stream; return a list of documents."""
+    text = data.decode('utf-8-sig')
+    if extension == '.json':
+        return [json.loads(text)]
+    import yaml  # optional
+
+    return [document for document in yaml.safe_load_all(text) if document is not None]
+
+
+def check_expansion(documents, data_bytes):
+    """Raise DocumentTooLarge if `documents` expand beyond the limits for a file of `data_bytes`.
+
+    Stops counting at the limit, so a self-referencing alias is rejected too.
+    """
+    limit = max(EXPANDED_VALUES_GRACE, data_bytes)
+    stack = [(document, 1) for document in documents]
+    values = 0
+    while stack:
+        node, depth = stack.pop()
+        values += 1
+        if values > limit:
+            raise DocumentTooLarge(f"more than {limit} values once YAML aliases are expanded")
+        if depth > MAX_NESTING:
+            raise DocumentTooLarge(f"nested more than {MAX_NESTING} levels deep")
+        if isinstance(node, dict):
+            stack.extend((value, depth + 1) for value in node.values())
+        elif isinstance(node, list):
+            stack.extend((value, depth + 1) for value in node)
+
+
+def _dict(value):
+    return value if isinstance(value, dict) else {}
+
+
+def _list(value):
+    return value if isinstance(value, list) else []
+
+
+def _walk(node, path=()):
+    yield path, node
+    if isinstance(node, dict):
+        for key, value in node.items():
+            yield from _walk(value, path + (key,))
+    elif isinstance(node, list):
+        for index, value in enumerate(node):
+            yield from _walk(value, path + (index,))
+
+
+def _scalar(value, limit=MAX_SCALAR_CHARS):
+    text = json.dumps(value, default=str) if not isinstance(value, str) else value
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _redacted(value):
+    return f"<redacted, {len(str(value))} chars>"
+
+
+def _is_secret(key, value):
+    """Whether `value` under `key` looks like a credential (booleans, URLs and references do not)."""
+    return (
+        isinstance(key, str) and bool(SECRET_KEY.search(key)) and not SECRET_REFERENCE_KEY.search(key)
+        and isinstance(value, str) and bool(value.strip())
+        and not value.startswith(('$', '{{', 'arn:', 'ref:')) and not re.match(r'^[a-z]+://', value)
+    )
+
+
+# "key: value", "key=value" or '"key": value' on one line of raw YAML/JSON
+_ASSIGNMENT = re.compile(
+    r'''(?P<key>"[^"\n]*"|'[^'\n]*'|[A-Za-z0-9_.\-]+)(?P<sep>[ \t]*[:=][ \t]*)'''
+    r'''(?P<value>"(?:[^"\\\n]|\\.)*"|'[^'\n]*'|[^\s"'][^\n]*)'''
+)
+# YAML block scalar indicator ("password: |"); the indented lines below it are the value
+_BLOCK_SCALAR = re.compile(r'^[|>][+-]?[0-9]?$')
+
+
+def redact_secrets(text):
+    """Mask the values of secret-like keys (see `_is_secret`) in raw YAML or JSON text.
+
+    Used for files that cannot be parsed, so their text can still be sent.
+    Works line by line: an unquoted value runs to the end of its line (less a
+    trailing comment), which may mask more than the value but never less.
+    """
+    lines = text.split('\n')
+    block_indent = None
+
+    def mask(match):
+        nonlocal block_indent
+        key, value = match.group('key').strip('"\''), match.group('value')
+        if value[:1] in ('"', "'"):
+            value = value[1:-1]
+        else:
+            value = re.split(r'\s+#', value, 1)[0].rstrip()
+        if _BLOCK_SCALAR.match(value) and SECRET_KEY.search(key) and not SECRET_REFERENCE_KEY.search(key):
+            block_indent = indent
+            return match.group(0)
+        if not _is_secret(key, value):
+            return match.group(0)
+        return f"{match.group('key')}{match.group('sep')}{_redacted(value)}"
+
+    for i, line in enumerate(lines):
+        indent = len(line) - len(line.lstrip())
+        if block_indent is not None:
+            if not line.strip():
+                continue
+            if indent > block_indent:
+                lines[i] = line[:indent] + _redacted(line.strip())
+                continue
+            block_indent = None
+        lines[i] = _ASSIGNMENT.sub(mask, line)
+    return '\n'.join(lines)
+
+
+def _findings(document, base=()):
+    """Map of kind -> ["pointer: description"] for security-relevant values anywhere in `document`."""
+    found = {"Secret-like values (redacted)": [], "Ports": [], "Public exposure": [],
+             "Risky settings": [], "Wildcard permissions": [], "Endpoints and URLs": []}
+
+    def add(kind, path, text):
+        found[kind].append(f"{pointer(base + path)}: {text}")
+
+    for path, node in _walk(document):
+        key = path[-1] if path else None
+        if isinstance(node, dict):
+            # Kubernetes env entries and similar {name: DB_PASSWORD, value: ...} pairs
+            name = node.get('name')
+            if isinstance(name, str) and _is_secret(name, node.get('value')):
+                add("Secret-like values (redacted)", path, f"{name} = {_redacted(node['value'])}")
+            continue
+        if isinstance(node, list):
+            if isinstance(key, str) and PERMISSION_KEY.match(key) and '*' in node:
+                add("Wildcard permissions", path, f"{key}: [{', '.join(map(str, node[:6]))}]")
+            continue
+        if not isinstance(key, str):
+            if isinstance(node, str) and node in PUBLIC_CIDRS:
+                add("Public exposure", path, f"{node} (open to the internet)")
+            continue
+        if _is_secret(key, node):
+            add("Secret-like values (redacted)", path, f"{key} = {_redacted(node)}")
+        elif PORT_KEY.match(key) and node not in (None, ""):
+            add("Ports", path, f"{key} {node}")
+        elif key in RISKY_FLAGS and node is RISKY_FLAGS[key]:
+            add("Risky settings", path, f"{key}: {str(node).lower()}")
+        elif key in ('runAsUser', 'run_as_user') and node == 0:
+            add("Risky settings", path, f"{key}: 0 (root)")
+        elif isinstance(node, str) and node in PUBLIC_CIDRS:
+            add("Public exposure", path, f"{key}: {node} (open to the internet)")
+        elif PERMISSION_KEY.match(key) and node == '*':
+            add("Wildcard permissions", path, f"{key}: *")
+        elif isinstance(node, str) and re.match(r'^(https?|wss?|grpc)://', node):
+            plaintext = " (plaintext)" if node.startswith(('http://', 'ws://')) else ""
+            add("Endpoints and URLs", path, f"{key}: {_scalar(node)}{plaintext}")
+    return found
+
+
+def _format_findings(found):
+    lines = []
+    for kind, items in found.items():
+        if not items:
+            continue
+        lines.append(f"#### {kind}")
+        lines.extend(f"- {item}" for item in items[:MAX_FINDINGS_PER_KIND])
+        if len(items) > MAX_FINDINGS_PER_KIND:
+            lines.append(f"- … {len(items) - MAX_FINDINGS_PER_KIND} more")
+        lines.append("")
+    return lines
+
+
+def _ref_name(ref):
+    return ref.rsplit('/', 1)[-1]
+
+
+def _schema_label(schema):
+    """Short description of a schema: the referenced name, or the shape of an inline schema."""
+    if not isinstance(schema, dict):
+        return "?"
+    if '$ref' in schema:
+        return _ref_name(str(schema['$ref']))
+    if schema.get('type') == 'array':
+        return f"array of {_schema_label(schema.get('items'))}"
+    for combinator in ('allOf', 'oneOf', 'anyOf'):
+        if combinator in schema:
+            return f" {combinator} ".join(_schema_label(s) for s in _list(schema[combinator]))
+    if 'properties' in schema:
+        names = list(map(str, _dict(schema['properties'])))
+        return f"object {{{', '.join(names[:8])}{', …' if len(names) > 8 else ''}}}"
+    return str(schema.get('type') or "object")
+
+
+def _security_label(requirements):
+    if requirements is None:
+        return "not specified"
+    if requirements == [] or requirements == [{}]:
+        return "NONE (public)"
+    if not isinstance(requirements, list):
+        return _scalar(requirements)
+    alternatives = []
+    for requirement in requirements:
+        alternatives.append(" + ".join(
+            f"{name}[{', '.join(map(str, _list(scopes)))}]" if scopes else str(name)
+            for name, scopes in _dict(requirement).items()
+        ) or "optional")
+    return " | ".join(alternatives)
+
+
+def _openapi_outline(spec):
+    """Outline lines and summary fields for an OpenAPI 3 / Swagger 2 document."""
+    version = spec.get('openapi') or spec.get('swagger')
+    info = _dict(spec.get('info'))
+    lines = [f"#### API: {info.get('title', 'untitled')} {info.get('version', '')} (OpenAPI {version})".rstrip()]
+
+    servers = [server.get('url') for server in _list(spec.get('servers')) if isinstance(server, dict)]
+    if spec.get('host'):
+        servers += [f"{scheme}://{spec['host']}{spec.get('basePath', '')}" for scheme in _list(spec.get('schemes')) or ['https']]
+    for url in servers:
+        lines.append(f"- Server: {url}{' (plaintext)' if str(url).startswith('http://') else ''}")
+    lines.append("")
+
+    components = _dict(spec.get('components'))
+    schemes = _dict(components.get('securitySchemes')) or _dict(spec.get('securityDefinitions'))
+    schemes_path = ('components', 'securitySchemes') if _dict(components.get('securitySchemes')) else ('securityDefinitions',)
+    lines.append("#### Auth schemes")
+    for name, scheme in schemes.items():
+        scheme = scheme if isinstance(scheme, dict) else {}
+        details = [str(scheme.get('type', '?'))]
+        if scheme.get('scheme'):
+            details.append(f"{scheme['scheme']}" + (f" ({scheme['bearerFormat']})" if scheme.get('bearerFormat') else ""))
+        if scheme.get('in'):
+            details.append(f"in {scheme['in']} '{scheme.get('name', '')}'")
+        flows = _dict(scheme.get('flows')) or ({str(scheme['flow']): scheme} if scheme.get('flow') else {})
+        for flow_name, flow in flows.items():
+            scopes = list(map(str, _dict(_dict(flow).get('scopes'))))
+            details.append(f"{flow_name} flow, scopes: {', '.join(scopes) or 'none'}")
+        if scheme.get('openIdConnectUrl'):
+            details.append(str(scheme['openIdConnectUrl']))
+        lines.append(f"- {name}: {'; '.join(details)} ({pointer(schemes_path + (name,))})")
+    if not schemes:
+        lines.append("- none declared")
+    global_security = spec.get('security')
+    lines.append(f"- Default requirement: {_security_label(global_security)}")
+    lines.append("")
+
+    lines.append("#### Endpoints")
+    references = {}
+    endpoints = unauthenticated = 0
+    for path_name, item in _dict(spec.get('paths')).items():
+        if not isinstance(item, dict):
+            continue
+        shared_parameters = _list(item.get('parameters'))
+        for method in HTTP_METHODS:
+            operation = item.get(method)
+            if not isinstance(operation, dict):
+                continue
+            endpoints += 1
+            security = operation.get('security', global_security)
+            if not security or security == [{}]:
+                unauthenticated += 1
+            parts = [f"{method.upper()} {path_name}", f"auth: {_security_label(security)}"]
+            parameters = []
+            for parameter in shared_parameters + _list(operation.get('parameters')):
+                if not isinstance(parameter, dict):
+                    continue
+                if '$ref' in parameter:
+                    parameters.append(_ref_name(str(parameter['$ref'])))
+                elif parameter.get('in') == 'body':
+                    parts.append(f"body: {_schema_label(parameter.get('schema'))}")
+                else:
+                    parameters.append(f"{parameter.get('name')} ({parameter.get('in')})")
+            if parameters:
+                parts.append(f"params: {', '.join(parameters)}")
+            content = _dict(_dict(operation.get('requestBody')).get('content'))
+            for media_type, body in content.items():
+                parts.append(f"body: {_schema_label(_dict(body).get('schema'))} ({media_type})")
+                break
+            if isinstance(operation.get('responses'), (dict, list)):
+                parts.append(f"responses: {', '.join(map(str, operation['responses']))}")
+            if operation.get('deprecated'):
+                parts.append("deprecated")
+            lines.append(f"- {' · '.join(parts)} ({pointer(('paths', path_name, method))})")
+        for _, node in _walk(item):
+            if isinstance(node, dict) and isinstance(node.get('$ref'), str):
+                references[node['$ref']] = references.get(node['$ref'], 0) + 1
+    lines.append("")
+
+    schemas = _dict(components.get('schemas')) or _dict(spec.get('definitions'))
+    schemas_path = ('components', 'schemas') if _dict(components.get('schemas')) else ('definitions',)
+    if schemas:
+        # Each schema is described once, however many operations reference it
+        lines.append("#### Schemas")
+        for name, schema in schemas.items():
+            properties = list(map(str, _dict(_dict(schema).get('properties'))))
+            uses = sum(count for ref, count in references.items() if _ref_name(ref) == name)
+            sensitive = [p for p in properties if SENSITIVE_FIELD.search(p)]
+            parts = [f"{name}: {_schema_label(schema)}"]
+            if uses:
+                parts.append(f"referenced {uses}×")
+            if sensitive:
+                parts.append(f"sensitive fields: {', '.join(sensitive)}")
+            lines.append(f"- {' · '.join(parts)} ({pointer(schemas_path + (name,))})")
+        lines.append("")
+    summary = f"OpenAPI · {endpoints} endpoints ({unauthenticated} without auth) · {len(schemes)} auth schemes"
+    return lines, summary
+
+
+def _pod_spec(obj):
+    """Pod spec of a Pod, of a workload's pod template or of a CronJob's job template."""
+    spec = _dict(obj.get('spec'))
+    if obj.get('kind') == 'Pod':
+        return spec
+    if 'jobTemplate' in spec:
+        spec = _dict(_dict(spec['jobTemplate']).get('spec'))
+    return _dict(_dict(spec.get('template')).get('spec'))
+
+
+def _kubernetes_outline(objects):
+    """Outline lines for Kubernetes objects given as (pointer path, object)."""
+    lines = ["#### Kubernetes objects"]
+    for path, obj in objects:
+        metadata = _dict(obj.get('metadata'))
+        name = metadata.get('name', '?')
+        if metadata.get('namespace'):
+            name = f"{metadata['namespace']}/{name}"
+        spec = _dict(obj.get('spec'))
+        parts = [f"{obj.get('kind')} {name}"]
+        pod = _pod_spec(obj)
+        for container in _list(pod.get('initContainers')) + _list(pod.get('containers')):
+            if not isinstance(container, dict):
+                continue
+            ports = [str(p.get('containerPort')) for p in _list(container.get('ports')) if isinstance(p, dict)]
+            parts.append(f"container {container.get('name')}: {container.get('image')}"
+                         + (f" ports {', '.join(ports)}" if ports else ""))
+        if pod.get('serviceAccountName'):
+            parts.append(f"service account {pod['serviceAccountName']}")
+        if obj.get('kind') == 'Service':
+            ports = [f"{p.get('port')}→{p.get('targetPort', p.get('port'))}" for p in _list(spec.get('ports'))
+                     if isinstance(p, dict)]
+            parts.append(f"type {spec.get('type', 'ClusterIP')} ports {', '.join(ports)}")
+        if obj.get('kind') == 'Ingress':
+            hosts = [str(rule.get('host', '*')) for rule in _list(spec.get('rules')) if isinstance(rule, dict)]
+            parts.append(f"hosts {', '.join(hosts)}; TLS {'yes' if spec.get('tls') else 'NO'}")
+        if obj.get('kind') == 'Secret':
+            keys = list(_dict(obj.get('data'))) + list(_dict(obj.get('stringData')))
+            parts.append(f"keys {', '.join(map(str, keys))}")
+        lines.append(f"- {' · '.join(parts)} ({pointer(path)})")
+    lines.append("")
+    return lines, f"Kubernetes · {len(objects)} objects"
+
+
+def _leaves(node):
+    if isinstance(node, dict):
+        return sum(_leaves(v) for v in node.values())
+    if isinstance(node, list):
+        return sum(_leaves(v) for v in node)
+    return 1
+
+
+def _shape(node):
+    if isinstance(node, dict):
+        return ('dict', tuple(sorted(map(str, node))))
+    if isinstance(node, list):
+        return ('list',)
+    return ('scalar', type(node).__name__)
+
+
+class _Structure:
+    """Compact indented rendering of a document with repeated subtrees and similar items collapsed."""
+
+    def __init__(self):
+        self.lines = []
+        self.seen = {}
+        self.collapsed = 0
+        self.omitted = 0
+
+    def emit(self, depth, text):
+        if len(self.lines) < MAX_STRUCTURE_LINES:
+            self.lines.append("  " * depth + text)
+        else:
+            self.omitted += 1
+
+    def render(self, node, path, depth=0, label=None):
+        prefix = f"{label}: " if label is not None else "- "
+        if not isinstance(node, (dict, list)):
+            key = path[-1] if path else ""
+            self.emit(depth, prefix + (_redacted(node) if _is_secret(key, node) else _scalar(node)))
+            return
+        if not node:
+            self.emit(depth, prefix + ("{}" if isinstance(node, dict) else "[]"))
+            return
+        if _leaves(node) >= REPEAT_MIN_LEAVES:
+            try:
+                fingerprint = json.dumps(node, sort_keys=True, default=str)
+            except TypeError:
+                # Keys of mixed types (YAML allows 200 and "default" side by side) cannot be sorted
+                fingerprint = json.dumps(node, default=str)
+            if fingerprint in self.seen:
+                self.collapsed += 1
+                self.emit(depth, prefix + f"(same as {self.seen[fingerprint]})")
+                return
+            self.seen[fingerprint] = pointer(path)
+        if depth >= MAX_STRUCTURE_DEPTH:
+            self.emit(depth, prefix + ("{…}" if isinstance(node, dict) else f"[… {len(node)} items]"))
+            return
+        if isinstance(node, list) and all(not isinstance(v, (dict, list)) for v in node) and len(node) <= 12:
+            self.emit(depth, prefix + "[" + ", ".join(_scalar(v, 40) for v in node) + "]")
+            return
+        child_depth = depth + 1
+        if label is None and not path:
+            # The document root needs no line of its own
+            child_depth = depth
+        else:
+            self.emit(depth, prefix.rstrip() if label is not None else "-")
+        if isinstance(node, dict):
+            for key, value in node.items():
+                self.render(value, path + (key,), child_depth, label=key)
+            return
+        if len(node) > ARRAY_SAMPLE_THRESHOLD and len({_shape(v) for v in node}) == 1:
+            self.collapsed += 1
+            self.render(node[0], path + (0,), child_depth)
+            self.emit(child_depth, f"… {len(node) - 1} more items shaped like {pointer(path + (0,))}")
+            return
+        for index, value in enumerate(node):
+            self.render(value, path + (index,), child_depth)
+
+
+def _kubernetes_objects(documents, multi):
+    objects = []
+    for index, document in enumerate(documents):
+        base = (index,) if multi else ()
+        if not isinstance(document, dict):
+            continue
+        kind = document.get('kind')
+        if kind == 'List' or (isinstance(kind, str) and kind.endswith('List') and 'items' in document):
+            objects.extend((base + ('items', i), item) for i, item in enumerate(_list(document.get('items')))
+                           if isinstance(item, dict) and 'kind' in item)
+        elif 'apiVersion' in document and 'kind' in document:
+            objects.append((base, document))
+    return objects
+
+
+def outline(documents, name):
+    """Return (outline text, fields) for parsed documents of the file `name`."""
+    multi = len(documents) > 1
+    lines = []
+    found = {}
+    collapsed = 0
+    summaries = []
+
+    specs = [(i, d) for i, d in enumerate(documents) if isinstance(d, dict) and (d.get('openapi') or d.get('swagger'))]
+    for _, spec in specs:
+        spec_lines, summary = _openapi_outline(spec)
+        lines.extend(spec_lines)
+        summaries.append(summary)
+    objects = _kubernetes_objects(documents, multi)
+    if objects:
+        object_lines, summary = _kubernetes_outline(objects)
+        lines.extend(object_lines)
+        summaries.append(summary)
+
+    for index, document in enumerate(documents):
+        for kind, items in _findings(document, (index,) if multi else ()).items():
+            found.setdefault(kind, []).extend(items)
+    lines.extend(_format_findings(found))
+
+    if not specs and not objects:
+        # No known format: a compact rendering of the structure itself
+        structure = _Structure()
+        for index, document in enumerate(documents):
+            structure.render(document, (index,) if multi else (), label=f"document {index}" if multi else None)
+        if structure.omitted:
+            structure.lines.append(f"… {structure.omitted} more lines omitted")
+        lines.append("#### Structure")
+        lines.extend(structure.lines)
+        collapsed = structure.collapsed
+        summaries.append(f"{Path(name).suffix.upper()[1:]} · {len(documents)} document(s)")
+
+    findings = sum(len(items) for items in found.values())
+    header = (f"[Structured outline of {name}: {'; '.join(summaries)} · {findings} security-relevant values. "
+              "Pointers such as #/paths/~1users/get are JSON Pointers into the original file"
+              + ("; their first segment is the document index in the YAML stream" if multi else "")
+              + "; secret values are redacted.]")
+    fields = {"outline": "; ".join(summaries), "findings": findings, "collapsed": collapsed}
+    return header + "\n\n" + "\n".join(lines).strip(), fields
+
+
+def ingest_file(path, name):
+    """Return (text, fields) for the YAML or JSON file at `path`, uploaded as `name`.
+
+    Files that cannot be parsed or outlined (see `check_expansion`) are passed
+    through as raw text with a note and secret values masked (`redact_secrets`),
+    so their content still reaches the model; `fields["parse_error"]` says why.
+    """
+    extension = Path(name).suffix.lower()
+    data = Path(path).read_bytes()
+    try:
+        documents = load_documents(data, extension)
+        check_expansion(documents, len(data))
+        return outline(documents, name)
+    except Exception as e:
+        # Unparsable, an alias bomb, or a shape the outline does not expect
+        raw = redact_secrets(data.decode('utf-8', errors='replace'))
+        return f"[Could not parse as {extension.upper()[1:]} ({e}); raw content follows]\n{raw}", {
+            "outline": "unparsed", "findings": 0, "collapsed": 0, "parse_error": str(e),
+        }
@@ -0,0 +1,85 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import archives
+import extractors
+
+LIMITS = dict(extensions=extractors.SUPPORTED_EXTENSIONS, max_files=100, max_bytes=50 * 1024 * 1024, max_ratio=100)
+
+
+def _zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+
+def test_zip_members_filtered_deduplicated_and_streamed_to_disk(tmp_path):
+    source = _zip([
+        ("docs/design.md", b"# Design\nAgents call the payments API."),
+        ("docs/copy/design-old.md", b"# Design\nAgents call the payments API."),
+        ("docs/api.yaml", b"openapi: 3.0.0\n"),
+        ("docs/logo.svg", b"<svg/>"),
+        ("docs/nested.zip", b"PK"),
+        ("__MACOSX/docs/._design.md", b"\0\0"),
+        ("docs/.env", b"SECRET=1"),
+    ])
+    seen = []
+
+    members, report = archives.expand_archive(
+        source, "docs.zip", str(tmp_path), progress=lambda count, name: seen.append(count), **LIMITS
+    )
+
+    assert [m.name for m in members] == ["docs.zip/docs/design.md", "docs.zip/docs/api.yaml"]
+    assert members[0].getvalue() == b"# Design\nAgents call the payments API."
+    assert members[0].size == len(members[0].getvalue()) and len(members[0].digest) == 64
+    statuses = {entry['name'].split('/', 1)[1]: (entry['status'], entry['detail']) for entry in report['entries']}
+    assert statuses["docs/copy/design-old.md"] == ("duplicate", "same content as docs.zip/docs/design.md")
+    assert statuses["docs/logo.svg"] == ("skipped", "unsupported type .svg")
+    assert statuses["docs/nested.zip"][0] == "skipped"
+    assert statuses["__MACOSX/docs/._design.md"] == ("skipped", "hidden file")
+    assert statuses["docs/.env"] == ("skipped", "hidden file")
+    assert report['files'] == 2 and seen == list(range(1, 8))
+    # Only the unpacked, distinct members are left on disk
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_zip_bombs_and_oversized_archives_rejected_while_unpacking(tmp_path):
+    bomb = _zip([("readme.md", b"short"), ("notes.txt", b"\0" * (20 * 1024 * 1024))])
+    with pytest.raises(archives.ArchiveLimitExceeded, match="zip bomb"):
+        archives.expand_archive(bomb, "bomb.zip", str(tmp_path), **LIMITS)
+
+    many = _zip([(f"{i}.md", f"file {i}".encode()) for i in range(101)])
+    with pytest.raises(archives.ArchiveLimitExceeded, match="more than 100 files"):
+        archives.expand_archive(many, "many.zip", str(tmp_path), **LIMITS)
+
+    large = _zip([(f"{i}.md", os.urandom(1024 * 1024)) for i in range(4)])
+    with pytest.raises(archives.ArchiveLimitExceeded, match="more than 3 MB"):
+        archives.expand_archive(large, "large.zip", str(tmp_path), **dict(LIMITS, max_bytes=3 * 1024 * 1024))
+
+
+def test_tarball_read_as_a_stream(tmp_path):
+    path = tmp_path / "docs.tar.gz"
+    with tarfile.open(path, 'w:gz') as archive:
+        for name, data in [("repo/README.md", b"Uses OAuth."), ("repo/deploy.json", b"{}"), ("repo/main.go", b"package main")]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    out = tmp_path / "out"
+    out.mkdir()
+
+    members, report = archives.expand_archive(str(path), "docs.tar.gz", str(out), **LIMITS)
+
+    assert [(m.name, m.getvalue()) for m in members] == [
+        ("docs.tar.gz/repo/README.md", b"Uses OAuth."), ("docs.tar.gz/repo/deploy.json", b"{}"),
+    ]
+    assert [entry['status'] for entry in report['entries']] == ["extracted", "extracted", "skipped"]
+
+    with pytest.raises(tarfile.TarError):
+        archives.expand_archive(io.BytesIO(b"not an archive"), "notes.gz", str(out), **LIMITS)
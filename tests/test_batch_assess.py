@@ -0,0 +1,126 @@
+import sys
+import types
+
+# Provide minimal stubs for streamlit and anthropic so importing app works in test env
+fake_st = types.SimpleNamespace()
+fake_st.set_page_config = lambda *a, **k: None
+fake_st.markdown = lambda *a, **k: None
+fake_st.file_uploader = lambda *a, **k: None
+fake_st.text_input = lambda *a, **k: None
+fake_st.success = lambda *a, **k: None
+fake_st.warning = lambda *a, **k: None
+fake_st.info = lambda *a, **k: None
+fake_st.error = lambda *a, **k: None
+fake_st.empty = lambda *a, **k: types.SimpleNamespace(text=lambda *a, **k: None)
+fake_st.progress = lambda *a, **k: types.SimpleNamespace(progress=lambda *a, **k: None)
+fake_st.columns = lambda n: [types.SimpleNamespace(__enter__=lambda *a, **k: None, __exit__=lambda *a, **k: None) for _ in range(n)]
+
+class _DummySessionState:
+    def __init__(self):
+        self._d = {}
+    def __contains__(self, key):
+        return key in self._d
+    def __getattr__(self, name):
+        return self._d.get(name, None)
+    def __setattr__(self, name, value):
+        if name == '_d':
+            super().__setattr__(name, value)
+        else:
+            self._d[name] = value
+
+fake_st.session_state = _DummySessionState()
+
+sys.modules['streamlit'] = fake_st
+
+# Minimal anthropic stub
+fake_anthropic = types.SimpleNamespace()
+class _AnthropicStub:
+    def __init__(self, *a, **k):
+        pass
+fake_anthropic.Anthropic = _AnthropicStub
+sys.modules['anthropic'] = fake_anthropic
+
+import json
+
+import pytest
+
+import app
+import batch_assess
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, '_response_cache', app.DiskLRUCache(tmp_path / "responses.sqlite3", 1024 * 1024, 3600))
+    monkeypatch.setattr(app, '_api_capabilities', app.ApiCapabilityCache(tmp_path / "api_capabilities.json"))
+    monkeypatch.setattr(app, '_extraction_cache', app.TieredCache(app.MemoryLRUCache(1024 * 1024)))
+    monkeypatch.setattr(app, '_request_scheduler', app.RequestScheduler(requests_per_minute=0, tokens_per_minute=0))
+
+
+class RecordingMessages:
+    def __init__(self):
+        self.projects = []
+
+    def create(self, **kwargs):
+        content = kwargs['messages'][0]['content']
+        name = content.split("- Project Name: ", 1)[1].split("\n", 1)[0]
+        self.projects.append(name)
+        return types.SimpleNamespace(content=[types.SimpleNamespace(type="text", text=f"# EXECUTIVE SUMMARY\n{name}\n")])
+
+
+def _write_manifest(tmp_path, projects):
+    docs = tmp_path / "docs"
+    docs.mkdir(exist_ok=True)
+    (docs / "portal.md").write_text("All agents run with admin access.")
+    (docs / "billing.txt").write_text("Card numbers are stored in the billing database.")
+    manifest = tmp_path / "portfolio.json"
+    manifest.write_text(json.dumps({
+        "defaults": {"framework": "STRIDE", "risk_areas": ["Agentic AI Risk"]},
+        "projects": projects,
+    }))
+    return manifest
+
+
+def test_batch_run_writes_reports_and_resumes(monkeypatch, tmp_path):
+    messages = RecordingMessages()
+    monkeypatch.setattr(app, 'get_anthropic_client', lambda api_key: types.SimpleNamespace(
+        beta=types.SimpleNamespace(messages=messages)))
+    manifest = _write_manifest(tmp_path, [
+        {"name": "Customer Portal", "documents": ["docs/*.md"]},
+        {"name": "Billing", "documents": ["docs/billing.txt"], "compliance": ["PCI-DSS"]},
+    ])
+    out = tmp_path / "reports"
+    args = [str(manifest), "--output-dir", str(out), "--workers", "2", "--api-key", "fake", "--no-cache"]
+
+    assert batch_assess.main(args) == 0
+    assert sorted(messages.projects) == ["Billing", "Customer Portal"]
+    records = [json.loads(line) for line in (out / "progress.jsonl").read_text().splitlines()]
+    assert {r["status"] for r in records} == {"done"}
+    reports = sorted(out.glob("*/*.md"))
+    assert [p.parent.name for p in reports] == ["Billing", "Customer_Portal"]
+    assert "Customer Portal" in reports[1].read_text()
+
+    # A second run skips finished projects; changing a document reruns only its project
+    assert batch_assess.main(args) == 0
+    assert len(messages.projects) == 2
+    (tmp_path / "docs" / "billing.txt").write_text("Card numbers are now tokenized.")
+    assert batch_assess.main(args) == 0
+    assert sorted(messages.projects) == ["Billing", "Billing", "Customer Portal"]
+
+
+def test_invalid_manifest_entries_are_reported_before_running(tmp_path, capsys):
+    manifest = _write_manifest(tmp_path, [
+        {"name": "Typo", "documents": ["docs/missing*.md"], "framework": "STRIDEX"},
+    ])
+    assert batch_assess.main([str(manifest), "--output-dir", str(tmp_path / "out"), "--api-key", "fake"]) == 2
+    err = capsys.readouterr().err
+    assert "framework must be one of" in err and "document not found" in err
+
+
+def test_duplicate_project_names_are_rejected(tmp_path, capsys):
+    manifest = _write_manifest(tmp_path, [
+        {"name": "Customer Portal", "documents": ["docs/portal.md"]},
+        {"name": "Customer_Portal", "documents": ["docs/billing.txt"]},
+    ])
+    assert batch_assess.main([str(manifest), "--output-dir", str(tmp_path / "out"), "--api-key", "fake"]) == 2
+    err = capsys.readouterr().err
+    assert "Customer_Portal: name is not unique" in err and "Customer Portal:" not in err
@@ -0,0 +1,135 @@
+import io
+
+import pytest
+
+import extractors
+
+PyPDF2 = pytest.importorskip("PyPDF2")
+canvas = pytest.importorskip("reportlab.pdfgen.canvas")
+
+
+def _make_pdf(pages):
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer)
+    for number in range(1, pages + 1):
+        if number != 3:  # page 3 is left blank, like a scanned diagram
+            pdf.drawString(72, 720, f"Design page {number}: agents call the payments API")
+        pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = extractors.create_process_pool(2)
+    yield pool
+    pool.shutdown()
+
+
+@pytest.mark.parametrize("use_pool", [False, True])
+def test_pdf_pages_extracted_in_order_with_page_markers(monkeypatch, pool, use_pool):
+    monkeypatch.setattr(extractors, 'PDF_PAGES_PER_TASK', 4)
+    documents = [
+        ("architecture.pdf", _make_pdf(11)),
+        ("notes.md", b"# Notes\nTokens never expire."),
+        ("broken.pdf", b"%PDF-1.4 not really a pdf"),
+    ]
+
+    (pdf_text, pdf_info), (md_text, md_info), (broken_text, broken_info) = extractors.extract_documents(
+        documents, pool=pool if use_pool else None
+    )
+
+    assert pdf_info["pages"] == 11 and pdf_info["empty_pages"] == 1 and pdf_info["error"] is None
+    markers = [line for line in pdf_text.splitlines() if line.startswith("[Page ")]
+    assert markers == [f"[Page {n}]" for n in range(1, 12)]
+    assert "[Page 10]\nDesign page 10: agents call the payments API" in pdf_text
+    assert "[Page 3]\n(no extractable text" in pdf_text
+
+    assert md_text == "# Notes\nTokens never expire." and md_info["pages"] is None
+    assert broken_text.startswith("[Error reading broken.pdf") and broken_info["error"]
+
+
+def test_docx_paragraphs_headings_and_tables_in_document_order(pool):
+    docx = pytest.importorskip("docx")
+    document = docx.Document()
+    document.add_heading("Payments Service", level=1)
+    document.add_paragraph("Agents call the payments API with a shared token.")
+    table = document.add_table(rows=3, cols=3)
+    for r, row in enumerate([("Component", "Data", "Exposure"), ("Gateway", "PAN", "Internet"), ("", "", "")]):
+        for c, value in enumerate(row):
+            table.cell(r, c).text = value
+    merged = table.cell(1, 1).merge(table.cell(1, 2))
+    merged.text = "PAN | CVV"
+    document.add_paragraph("Tokens never expire.", style="List Bullet")
+    buffer = io.BytesIO()
+    document.save(buffer)
+
+    [(text, info)] = extractors.extract_documents([("design.docx", buffer.getvalue())], pool=pool)
+
+    assert text.split("\n\n") == [
+        "# Payments Service",
+        "Agents call the payments API with a shared token.",
+        "| Component | Data | Exposure |\n| Gateway | PAN / CVV |",
+        "- Tokens never expire.",
+    ]
+    assert info["paragraphs"] == 3 and info["tables"] == 1 and info["error"] is None
+
+
+def test_images_downscaled_reencoded_and_stripped(pool):
+    Image = pytest.importorskip("PIL.Image")
+    photo = Image.effect_noise((3000, 2000), 60).convert("RGB")
+    exif = Image.Exif()
+    exif[0x010F] = "Example Camera"  # Make
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=95, exif=exif)
+    diagram = io.BytesIO()
+    Image.new("RGBA", (400, 300), (0, 0, 255, 128)).save(diagram, format="PNG")
+
+    [(encoded, media_type, info), (small, _, small_info), (broken, _, broken_info)] = extractors.prepare_images(
+        [("photo.jpg", buffer.getvalue(), None), ("flow.png", diagram.getvalue(), None), ("bad.png", b"nope", None)],
+        max_edge=1568, quality=80, pool=pool,
+    )
+
+    assert (info["original_width"], info["original_height"]) == (3000, 2000)
+    assert (info["width"], info["height"]) == (1568, 1045)
+    assert info["bytes"] < info["original_bytes"] and info["error"] is None
+    with Image.open(io.BytesIO(encoded)) as result:
+        assert result.format == info["format"] and media_type == f"image/{info['format'].lower()}"
+        assert not result.getexif() and result.mode == "RGB"
+    # Small images keep their size; transparency is flattened
+    assert (small_info["width"], small_info["height"]) == (400, 300)
+    with Image.open(io.BytesIO(small)) as result:
+        assert result.mode == "RGB"
+    assert broken is None and broken_info["error"]
+
+
+def test_stuck_extraction_times_out_and_pool_is_rebuilt(monkeypatch):
+    import os
+    import time
+
+    real_plan = extractors._plan_tasks
+
+    def plan(name, extension, path):
+        if name == "stuck.docx":
+            return [(time.sleep, (60,))], {}
+        return real_plan(name, extension, path)
+
+    monkeypatch.setattr(extractors, '_plan_tasks', plan)
+    pool = extractors.create_process_pool(1)
+    try:
+        started = time.monotonic()
+        (stuck, stuck_info), (config, config_info) = extractors.extract_documents(
+            [("stuck.docx", b"x"), ("config.json", b'{"port": 8080}')], pool=pool, timeout=2,
+        )
+        assert time.monotonic() - started < 30
+        assert stuck.startswith("[Error reading stuck.docx") and "longer than 2s" in stuck_info["error"]
+        # The file queued behind the stuck one ran on the restarted pool
+        assert config_info["error"] is None and "8080" in config and pool.restarts == 1
+
+        # Workers that die break the pool; the next extraction rebuilds it
+        for process in list(pool._executor._processes.values()):
+            os.kill(process.pid, 9)
+        [(config, config_info)] = extractors.extract_documents([("config.json", b'{"port": 9090}')], pool=pool)
+        assert config_info["error"] is None and "9090" in config and pool.restarts == 2
+    finally:
+        pool.shutdown()
@@ -0,0 +1,1013 @@
+import gc
+import sys
+import types
+
+# Provide minimal stubs for streamlit and anthropic so importing app works in test env
+fake_st = types.SimpleNamespace()
+fake_st.set_page_config = lambda *a, **k: None
+fake_st.markdown = lambda *a, **k: None
+fake_st.file_uploader = lambda *a, **k: None
+fake_st.text_input = lambda *a, **k: None
+fake_st.success = lambda *a, **k: None
+fake_st.warning = lambda *a, **k: None
+fake_st.info = lambda *a, **k: None
+fake_st.error = lambda *a, **k: None
+fake_st.empty = lambda *a, **k: types.SimpleNamespace(text=lambda *a, **k: None)
+fake_st.progress = lambda *a, **k: types.SimpleNamespace(progress=lambda *a, **k: None)
+fake_st.columns = lambda n: [types.SimpleNamespace(__enter__=lambda *a, **k: None, __exit__=lambda *a, **k: None) for _ in range(n)]
+
+class _DummySessionState:
+    def __init__(self):
+        self._d = {}
+    def __contains__(self, key):
+        return key in self._d
+    def __getattr__(self, name):
+        return self._d.get(name, None)
+    def __setattr__(self, name, value):
+        if name == '_d':
+            super().__setattr__(name, value)
+        else:
+            self._d[name] = value
+
+fake_st.session_state = _DummySessionState()
+
+sys.modules['streamlit'] = fake_st
+
+# Minimal anthropic stub
+fake_anthropic = types.SimpleNamespace()
+class _AnthropicStub:
+    def __init__(self, *a, **k):
+        pass
+fake_anthropic.Anthropic = _AnthropicStub
+sys.modules['anthropic'] = fake_anthropic
+
+import io
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def isolated_client_registry(monkeypatch):
+    registry = app.ClientRegistry()
+    monkeypatch.setattr(app, '_client_registry', registry)
+    return registry
+
+
+@pytest.fixture(autouse=True)
+def isolated_response_cache(monkeypatch, tmp_path):
+    cache = app.DiskLRUCache(tmp_path / "responses.sqlite3", max_bytes=1024 * 1024, max_age_seconds=3600)
+    monkeypatch.setattr(app, '_response_cache', cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def isolated_extraction_cache(monkeypatch, tmp_path):
+    cache = app.TieredCache(
+        app.MemoryLRUCache(1024 * 1024),
+        app.DiskLRUCache(tmp_path / "extractions.sqlite3", max_bytes=1024 * 1024, max_age_seconds=3600),
+    )
+    monkeypatch.setattr(app, '_extraction_cache', cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def isolated_api_capabilities(monkeypatch, tmp_path):
+    capabilities = app.ApiCapabilityCache(tmp_path / "api_capabilities.json")
+    monkeypatch.setattr(app, '_api_capabilities', capabilities)
+    return capabilities
+
+
+@pytest.fixture(autouse=True)
+def isolated_request_scheduler(monkeypatch):
+    sleeps = []
+    scheduler = app.RequestScheduler(
+        max_retries=3, requests_per_minute=0, tokens_per_minute=0,
+        breaker=app.CircuitBreaker(failure_threshold=2, reset_seconds=60), sleep=sleeps.append,
+    )
+    scheduler.sleeps = sleeps
+    monkeypatch.setattr(app, '_request_scheduler', scheduler)
+    return scheduler
+
+
+REPORT_BLOCKS = [
+    "# EXECUTIVE SUMMARY\n\n**Overall Risk Rating:** HIGH\n",
+    "\n## REFERENCES\n- [NIST SP 800-53] https://csrc.nist.gov/\n",
+]
+
+PROJECT_INFO = {
+    'name': 'StreamTest',
+    'app_type': 'Web Application',
+    'deployment': 'Cloud (AWS)',
+    'criticality': 'High',
+    'compliance': ['GDPR'],
+    'environment': 'Production',
+}
+
+
+class FakeMessage:
+    def __init__(self, blocks, usage=None):
+        self.content = [types.SimpleNamespace(type="text", text=b) for b in blocks]
+        self.usage = types.SimpleNamespace(**(usage or {}))
+
+
+class FakeStream:
+    def __init__(self, blocks):
+        self._blocks = blocks
+        # Split every block into small deltas the way the streaming API does
+        self.text_stream = iter([b[i:i + 7] for b in blocks for i in range(0, len(b), 7)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def get_final_message(self):
+        return FakeMessage(self._blocks)
+
+
+class FakeMessages:
+    def __init__(self):
+        self.calls = []
+
+    def create(self, **kwargs):
+        self.calls.append(("create", kwargs))
+        return FakeMessage(REPORT_BLOCKS)
+
+    def stream(self, **kwargs):
+        self.calls.append(("stream", kwargs))
+        return FakeStream(REPORT_BLOCKS)
+
+
+class FakeAnthropic:
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        self.beta = types.SimpleNamespace(messages=FakeMessages())
+        FakeAnthropic.instances.append(self)
+
+
+def _generate(monkeypatch, **kwargs):
+    monkeypatch.setattr(app.anthropic, 'Anthropic', FakeAnthropic, raising=False)
+    return app.generate_threat_assessment(
+        PROJECT_INFO,
+        "### design.md\nAll agents run with admin access.",
+        'STRIDE',
+        ['Agentic AI Risk'],
+        api_key='fake',
+        **kwargs
+    )
+
+
+def test_streaming_matches_blocking_output(monkeypatch):
+    blocking = _generate(monkeypatch, use_cache=False)
+    assert FakeAnthropic.instances[-1].beta.messages.calls[-1][0] == "create"
+
+    deltas = []
+    streamed = _generate(monkeypatch, stream_callback=deltas.append, use_cache=False)
+    assert FakeAnthropic.instances[-1].beta.messages.calls[-1][0] == "stream"
+
+    assert streamed == blocking
+    assert "".join(deltas) == blocking
+    assert len(deltas) > 2
+
+
+def test_response_cache_serves_identical_inputs(monkeypatch, isolated_response_cache):
+    cache = isolated_response_cache
+    first = _generate(monkeypatch)
+    api_calls = FakeAnthropic.instances[-1].beta.messages.calls
+    second = _generate(monkeypatch)
+
+    assert second == first
+    # The second run is answered from the cache without calling the API
+    assert len(api_calls) == 1
+    assert cache.stats()["hits"] == 1
+
+    # Bypassing the cache regenerates the report
+    _generate(monkeypatch, use_cache=False)
+    assert len(api_calls) == 2
+
+
+def test_static_instructions_sent_as_cacheable_system_prefix(monkeypatch):
+    class CachingMessages(FakeMessages):
+        def create(self, **kwargs):
+            self.calls.append(("create", kwargs))
+            # The provider reports the prefix as written on the first call and read afterwards
+            cached = len(self.calls) > 1
+            return FakeMessage(REPORT_BLOCKS, usage={
+                "input_tokens": 900,
+                "output_tokens": 400,
+                "cache_creation_input_tokens": 0 if cached else 6000,
+                "cache_read_input_tokens": 6000 if cached else 0,
+            })
+
+    messages = CachingMessages()
+    monkeypatch.setattr(app, 'get_anthropic_client', lambda api_key: types.SimpleNamespace(
+        beta=types.SimpleNamespace(messages=messages)))
+
+    usage = {}
+    _generate(monkeypatch, use_cache=False, usage=usage)
+    other_project = dict(PROJECT_INFO, name='OtherProject', compliance=['HIPAA'])
+    app.generate_threat_assessment(
+        other_project, "### api.md\nTokens never expire.", 'PASTA', ['Model Risk'],
+        api_key='fake', use_cache=False, usage=usage,
+    )
+
+    (_, first), (_, second) = messages.calls
+    assert first['system'] == second['system']
+    assert first['system'][0]['cache_control'] == {"type": "ephemeral"}
+    # Project-specific inputs stay out of the shared prefix
+    system_text = first['system'][0]['text']
+    assert 'StreamTest' not in system_text and 'STRIDE' not in system_text
+    assert 'OtherProject' in second['messages'][0]['content']
+    # The role is stated once, in the cached prefix
+    assert 'You are an expert' in system_text and 'You are an expert' not in first['messages'][0]['content']
+    assert usage == {
+        "input_tokens": 1800,
+        "output_tokens": 800,
+        "cache_creation_input_tokens": 6000,
+        "cache_read_input_tokens": 6000,
+    }
+
+
+def test_api_surface_is_remembered_per_model(monkeypatch, isolated_api_capabilities):
+    class LegacyCompletions:
+        def __init__(self):
+            self.calls = []
+
+        def create(self, **kwargs):
+            self.calls.append(kwargs['model'])
+            if kwargs['model'] == 'messages-only-model':
+                raise RuntimeError("This model is not supported on this API. Please use the Messages API.")
+            return types.SimpleNamespace(completion="legacy report")
+
+    client = types.SimpleNamespace(completions=LegacyCompletions(), beta=types.SimpleNamespace(messages=FakeMessages()))
+
+    for _ in range(2):
+        assert app._request_assessment(client, "prompt", 'messages-only-model', force_messages=False) == "".join(REPORT_BLOCKS)
+        assert app._request_assessment(client, "prompt", 'completions-model', force_messages=False) == "legacy report"
+
+    # Only the first call to the messages-only model paid for the failed completions round-trip
+    assert client.completions.calls == ['messages-only-model', 'completions-model', 'completions-model']
+    assert len(client.beta.messages.calls) == 2
+
+    # The map survives a restart
+    reloaded = app.ApiCapabilityCache(isolated_api_capabilities.path)
+    assert reloaded.snapshot() == {'completions-model': 'completions', 'messages-only-model': 'messages'}
+
+    # Another gateway learns its own surfaces, and concurrent writers merge instead of overwriting
+    monkeypatch.setattr(app, 'API_BASE_URL', 'https://gateway.example')
+    assert reloaded.get('completions-model') is None
+    reloaded.record('completions-model', 'messages')
+    isolated_api_capabilities.record('other-model', 'messages')
+    assert list(isolated_api_capabilities.path.parent.glob('*.tmp')) == []
+    final = app.ApiCapabilityCache(isolated_api_capabilities.path)
+    assert final.snapshot() == {'completions-model': 'messages', 'other-model': 'messages'}
+    monkeypatch.setattr(app, 'API_BASE_URL', None)
+    assert final.get('completions-model') == 'completions'
+
+
+class FakeStatusError(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(f"Error code: {status}")
+        self.status_code = status
+        self.response = types.SimpleNamespace(status_code=status, headers=headers or {})
+
+
+def test_scheduler_retries_overload_and_honors_retry_after(monkeypatch, isolated_request_scheduler):
+    class FlakyMessages(FakeMessages):
+        def create(self, **kwargs):
+            self.calls.append(("create", kwargs))
+            if len(self.calls) == 1:
+                raise FakeStatusError(429, {"retry-after": "7"})
+            if len(self.calls) == 2:
+                raise FakeStatusError(529)
+            return FakeMessage(REPORT_BLOCKS)
+
+    messages = FlakyMessages()
+    monkeypatch.setattr(app, 'get_anthropic_client', lambda api_key: types.SimpleNamespace(
+        beta=types.SimpleNamespace(messages=messages)))
+
+    assert _generate(monkeypatch, use_cache=False) == "".join(REPORT_BLOCKS)
+    scheduler = isolated_request_scheduler
+    assert len(messages.calls) == 3
+    # retry-after is honored; the overload retry uses jittered backoff within the base delay
+    assert scheduler.sleeps[0] == 7
+    assert 0 <= scheduler.sleeps[1] <= scheduler.backoff_base * 2
+    assert [a["outcome"] for a in scheduler.attempts] == ["retry", "retry", "ok"]
+    assert [a["status"] for a in scheduler.attempts] == [429, 529, None]
+
+    # Client errors are not retried
+    with pytest.raises(FakeStatusError):
+        scheduler.call(lambda: (_ for _ in ()).throw(FakeStatusError(400)))
+    assert scheduler.stats()["retries"] == 2
+
+
+def test_scheduler_does_not_repeat_streamed_text(isolated_request_scheduler):
+    deltas = []
+
+    def send():
+        deltas.append("partial ")
+        raise FakeStatusError(529)
+
+    with pytest.raises(FakeStatusError):
+        isolated_request_scheduler.call(send, can_retry=lambda: not deltas)
+    assert deltas == ["partial "]
+
+
+def test_circuit_breaker_fails_fast_after_repeated_overload(isolated_request_scheduler):
+    calls = []
+
+    def send():
+        calls.append(1)
+        raise FakeStatusError(503)
+
+    for _ in range(2):
+        with pytest.raises(FakeStatusError):
+            isolated_request_scheduler.call(send)
+    assert len(calls) == 2 * 4  # first attempt plus three retries per call
+
+    with pytest.raises(app.CircuitOpenError):
+        isolated_request_scheduler.call(send)
+    assert len(calls) == 8
+    assert isolated_request_scheduler.stats()["circuit"] == "open"
+
+
+def test_circuit_breaker_lets_one_trial_call_through():
+    now = [0.0]
+    breaker = app.CircuitBreaker(failure_threshold=1, reset_seconds=30, clock=lambda: now[0])
+    breaker.record_failure()
+    now[0] = 31.0
+
+    trial = breaker.before_call()
+    assert trial is not None
+    with pytest.raises(app.CircuitOpenError, match="trial request"):
+        breaker.before_call()
+    # A failed trial re-opens the breaker; once the trial succeeds, everyone gets through
+    breaker.record_failure()
+    with pytest.raises(app.CircuitOpenError):
+        breaker.before_call()
+    now[0] = 62.0
+    trial = breaker.before_call()
+    breaker.end_trial(object())  # another caller's cleanup leaves the trial in place
+    with pytest.raises(app.CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.before_call() is None and breaker.before_call() is None
+
+
+def test_token_bucket_spaces_requests_to_quota():
+    now = [0.0]
+    bucket = app.TokenBucket(per_minute=60, clock=lambda: now[0])
+    assert bucket.reserve(60) == 0
+    # The bucket is empty: the next request waits one second, the one after it two
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    assert bucket.reserve(1) == pytest.approx(2.0)
+    now[0] = 30.0
+    assert bucket.reserve(10) == 0
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = app.DiskLRUCache(tmp_path / "lru.sqlite3", max_bytes=25, max_age_seconds=0)
+    cache.put("a", b"x" * 10)
+    cache.put("b", b"y" * 10)
+    assert cache.get("a") == b"x" * 10  # "a" is now the most recently used entry
+    cache.put("c", b"z" * 10)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_client_registry_reuses_clients_per_api_key(monkeypatch, isolated_client_registry):
+    monkeypatch.setattr(app.anthropic, 'Anthropic', FakeAnthropic, raising=False)
+
+    first = app.get_anthropic_client('key-a')
+    assert app.get_anthropic_client('key-a') is first
+    assert app.get_anthropic_client('key-b') is not first
+
+    stats = isolated_client_registry.stats()
+    assert stats["clients_created"] == 2
+    assert stats["client_reuses"] == 1
+
+
+def test_client_registry_closes_evicted_pool_once_unused(monkeypatch):
+    closed = []
+
+    class Pool:
+        def __init__(self, name):
+            self.name = name
+
+        def close(self):
+            closed.append(self.name)
+
+    class Client:
+        pass
+
+    registry = app.ClientRegistry(max_clients=1)
+    monkeypatch.setattr(registry, '_build_client', lambda api_key: (Client(), Pool(api_key)))
+    in_use = registry.get('key-a')
+    registry.get('key-b')  # evicts key-a while a job still holds its client
+    gc.collect()
+    assert closed == []
+
+    del in_use
+    gc.collect()
+    assert closed == ['key-a']
+    assert registry.stats()["clients"] == 1
+
+
+class SectionMessages:
+    """Answers each part request with a small section and a fixed delay."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def create(self, **kwargs):
+        import re
+        import time
+
+        content = kwargs['messages'][0]['content']
+        part = int(re.search(r'produces part (\d+) of', content).group(1))
+        time.sleep(self.delay)
+        bodies = {
+            1: "Preamble to drop\n# EXECUTIVE SUMMARY\nTop finding F001 is CRITICAL.\n",
+            2: "# THREAT MODELING ANALYSIS - STRIDE\n| T001 | spoofing |\n| T001 | tampering |\n",
+            3: "# COMPREHENSIVE RISK MATRIX\n| F001 | admin agents |\n\n## REFERENCES\n- [OWASP Top 10] https://owasp.org/\n",
+            4: "# PRIORITIZED RECOMMENDATIONS\n| R001 | restrict agents, fixes F001 and F009 |\n",
+            5: "# APPENDICES\nA-C\n\n## REFERENCES\n- [NIST SP 800-53] https://csrc.nist.gov/\n",
+        }
+        return FakeMessage([bodies[part]])
+
+
+def test_section_wise_generation_runs_parts_concurrently(monkeypatch):
+    import time
+
+    class SectionAnthropic:
+        def __init__(self, *args, **kwargs):
+            self.beta = types.SimpleNamespace(messages=SectionMessages(delay=0.2))
+
+    monkeypatch.setattr(app.anthropic, 'Anthropic', SectionAnthropic, raising=False)
+    progress = []
+    stats = {}
+    started = time.monotonic()
+    report = app.generate_threat_assessment_by_section(
+        PROJECT_INFO, "### design.md\nAll agents run with admin access.", 'STRIDE', ['Agentic AI Risk'],
+        api_key='fake', progress_callback=lambda done, total, title: progress.append(done), use_cache=False, stats=stats,
+    )
+    elapsed = time.monotonic() - started
+
+    # Five 0.2s parts in well under the 1s a sequential run would take
+    assert elapsed < 0.8
+    assert progress == [1, 2, 3, 4, 5]
+    assert report.startswith("# EXECUTIVE SUMMARY")
+    assert report.index("# THREAT MODELING") < report.index("# COMPREHENSIVE RISK MATRIX") < report.index("# APPENDICES")
+    # References from every part end up in one section at the end
+    assert report.count("REFERENCES") == 1
+    assert "https://owasp.org/" in report and "https://csrc.nist.gov/" in report
+    # The restarted T001 definition is renumbered; F009 is referenced but never defined
+    assert stats["renumbered_ids"] == [("T001", "T002")]
+    assert stats["dangling_ids"] == ["F009"] and stats["ambiguous_ids"] == []
+
+
+def test_section_failure_cancels_remaining_parts(monkeypatch):
+    import re
+    import threading
+    import time
+
+    release = threading.Event()
+    started = []
+
+    class FailingMessages:
+        def create(self, **kwargs):
+            part = int(re.search(r'produces part (\d+) of', kwargs['messages'][0]['content']).group(1))
+            started.append(part)
+            if part == 1:
+                raise ValueError("bad request")
+            release.wait(10)
+            return FakeMessage(["# PART\n"])
+
+    monkeypatch.setattr(app, 'SECTION_WORKERS', 2)
+    monkeypatch.setattr(app, 'get_anthropic_client', lambda api_key: types.SimpleNamespace(
+        beta=types.SimpleNamespace(messages=FailingMessages())))
+    began = time.monotonic()
+    try:
+        with pytest.raises(RuntimeError, match="bad request"):
+            app.generate_threat_assessment_by_section(
+                PROJECT_INFO, "### design.md\nAll agents run with admin access.", 'STRIDE', ['Agentic AI Risk'],
+                api_key='fake', use_cache=False, force_messages=True, raise_errors=True,
+            )
+        # The error surfaces while the other part still runs, and queued parts never start
+        assert time.monotonic() - began < 5
+    finally:
+        release.set()
+    time.sleep(0.1)
+    # The worker freed by the failure may start one more part before the rest are cancelled
+    assert len(started) <= 3 < len(app.SECTION_GROUPS)
+
+
+def test_references_follow_renumbered_definitions():
+    threats = app.SECTION_GROUPS.index(next(g for g in app.SECTION_GROUPS if "threat_modeling" in g[1]))
+    parts = [""] * len(app.SECTION_GROUPS)
+    parts[threats] = (
+        "### Agents\n| T001 | admin agents |\n| T002 | prompt injection, see T001 |\n\n"
+        "### Models\n| T001 | model theft |\nT001 also enables T002.\n"
+    )
+    parts[-1] = "Mitigates T001."
+    reconciled, summary = app._reconcile_identifiers(parts)
+
+    assert summary["renumbered_ids"] == [("T001", "T003")]
+    assert "| T002 | prompt injection, see T001 |" in reconciled[threats]
+    assert "| T003 | model theft |\nT003 also enables T002." in reconciled[threats]
+    # Another section's reference to the repeated ID cannot be resolved
+    assert summary["ambiguous_ids"] == ["T001"] and reconciled[-1] == "Mitigates T001."
+
+
+def test_documents_compacted_to_prompt_budget():
+    security = "\n\n".join(
+        f"Section {i}: the API gateway validates the OAuth token and the admin role before agents access the database."
+        for i in range(200)
+    )
+    disclaimer = "This document is confidential and intended solely for the use of the addressee named above."
+    marketing = "\n\n".join(f"Page {i}\n\nOur quarterly picnic was a great success and everyone enjoyed it.\n\n{disclaimer}" for i in range(200))
+    documents = [("design.md", security + "\n\n" + disclaimer), ("newsletter.txt", marketing)]
+
+    small = [("notes.md", "All agents run with admin access.")]
+    content, report = app.compact_documents(small, PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'])
+    assert content == app.assemble_documents(small)
+    assert report["strategies"] == [] and report["fits"]
+
+    budget = app.estimate_tokens(app.build_assessment_prompt(PROJECT_INFO, "", 'STRIDE', ['Agentic AI Risk'])) + 3000
+    content, report = app.compact_documents(
+        documents, PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'], budget_tokens=budget, top_k=0
+    )
+
+    assert report["fits"] and report["prompt_tokens"] <= budget < report["original_prompt_tokens"]
+    assert len(report["strategies"]) == 3
+    # Page markers are stripped and the repeated disclaimer is removed from the second document
+    assert "Page 12" not in content
+    assert "200 repeated paragraphs removed" in report["strategies"]
+    assert content.count(disclaimer) <= 1
+    design, newsletter = report["documents"]
+    assert design["relevance"] > newsletter["relevance"]
+    assert design["tokens"] > newsletter["tokens"]
+    assert design["truncated"] and "paragraphs omitted to fit the prompt budget" in content
+
+
+def test_prompt_budget_memoized_across_reruns(monkeypatch):
+    calls = []
+    compact = app.compact_documents
+
+    def counting_compact(*args, **kwargs):
+        calls.append(args[3])
+        return compact(*args, **kwargs)
+
+    monkeypatch.setattr(app, 'compact_documents', counting_compact)
+    documents = [("notes.md", "All agents run with admin access.")]
+
+    first = app.prompt_budget(documents, PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'])
+    again = app.prompt_budget(list(documents), dict(PROJECT_INFO), 'STRIDE', ['Agentic AI Risk'])
+    assert again is first and len(calls) == 1
+    assert first[0] == app.assemble_documents(documents) and first[2] is False
+
+    app.prompt_budget(documents, PROJECT_INFO, 'STRIDE', ['Agentic AI Risk', 'Data Security Risk'])
+    app.prompt_budget([("notes.md", "All agents run as root.")], PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'])
+    assert len(calls) == 3
+
+
+class _Upload:
+    def __init__(self, name, data):
+        self.name = name
+        self._data = data
+
+    def getvalue(self):
+        return self._data
+
+
+def test_extractions_cached_by_content_hash(monkeypatch, isolated_extraction_cache):
+    calls = []
+    real_extract = app.extractors.extract_files
+
+    def counting_extract(files, pool=None, timeout=None):
+        calls.append([name for name, _ in files])
+        return real_extract(files, pool=None)
+
+    monkeypatch.setattr(app.extractors, 'extract_files', counting_extract)
+    upload = _Upload("design.md", b"# Design\n\nThe API gateway validates tokens.")
+
+    [(text, info)] = app.extract_uploaded_files([upload])
+    assert info['cached'] is False and calls == [["design.md"]]
+
+    # Renamed copies of the same bytes are served from memory and keep their own name
+    [(again, again_info)] = app.extract_uploaded_files([_Upload("copy.md", upload.getvalue())])
+    assert again == text and again_info['cached'] is True and again_info['name'] == "copy.md"
+    assert len(calls) == 1
+
+    # A new process starts with an empty memory tier but finds the disk entry
+    isolated_extraction_cache.memory = app.MemoryLRUCache(1024 * 1024)
+    app.extract_uploaded_files([upload])
+    assert len(calls) == 1
+    stats = isolated_extraction_cache.stats()
+    assert stats['memory_hits'] == 0 and stats['disk_hits'] == 1
+
+    # Changed bytes, and duplicates within one batch, are extracted once
+    edited = _Upload("design.md", b"# Design\n\nThe API gateway validates and logs tokens.")
+    results = app.extract_uploaded_files([edited, _Upload("dup.md", edited.getvalue())])
+    assert calls[-1] == ["design.md"]
+    assert [info['name'] for _, info in results] == ["design.md", "dup.md"]
+    assert "logs tokens" in results[1][0]
+
+
+class _BufferedUpload(io.BytesIO):
+    """Like Streamlit's UploadedFile: a BytesIO with a name, size and file id."""
+
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+        self.file_id = f"{name}-{len(data)}"
+
+
+def test_uploads_spooled_within_session_memory_budget(monkeypatch):
+    accountant = app.MemoryAccountant(session_limit=1000, server_limit=1500)
+    monkeypatch.setattr(app, '_memory_accountant', accountant)
+    spooled = []
+    real_extract = app.extractors.extract_files
+
+    def spying_extract(files, pool=None, timeout=None):
+        spooled.extend(path for _, path in files)
+        assert all(os.path.getsize(path) for path in spooled)
+        return real_extract(files, pool=None)
+
+    monkeypatch.setattr(app.extractors, 'extract_files', spying_extract)
+    upload = _BufferedUpload("design.md", b"# Design\n\n" + b"Tokens are validated. " * 10)
+
+    [(text, info)] = app.extract_uploaded_files([upload], session_id="s1")
+
+    assert text.startswith("# Design") and info['error'] is None
+    # The spool is removed and the upload buffer is released (still usable, not copied)
+    assert spooled and not os.path.exists(spooled[0])
+    upload.write(b"!")
+    assert accountant.stats("s1")["session_bytes"] == 0
+
+    accountant.set_resident("s1", 900)
+    with pytest.raises(app.MemoryBudgetExceeded, match="limit"):
+        app.extract_uploaded_files([_BufferedUpload("big.md", b"x" * 200)], session_id="s1")
+    accountant.set_resident("s2", 1400)
+    with pytest.raises(app.MemoryBudgetExceeded, match="busy"):
+        app.extract_uploaded_files([_BufferedUpload("other.md", b"y" * 50)], session_id="s3")
+    stats = accountant.stats("s1")
+    assert stats == {"session_bytes": 900, "server_bytes": 2300, "sessions": 2, "rejected": 2}
+
+
+def test_archive_uploads_unpacked_once_and_deduplicated(monkeypatch):
+    import zipfile
+
+    monkeypatch.setattr(app, '_archive_store', app.ArchiveStore(max_entries=1))
+    calls = []
+    real_expand = app.archives.expand_archive
+
+    def counting_expand(*args, **kwargs):
+        calls.append(args[1])
+        return real_expand(*args, **kwargs)
+
+    monkeypatch.setattr(app.archives, 'expand_archive', counting_expand)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr("docs/design.md", "# Design\nAgents call the payments API.")
+        archive.writestr("docs/notes.txt", "Already uploaded separately.")
+        archive.writestr("docs/build.sh", "make")
+    uploads = [_BufferedUpload("notes.txt", b"Already uploaded separately."), _BufferedUpload("docs.zip", buffer.getvalue())]
+    progress = []
+
+    files, [report] = app.expand_uploaded_archives(uploads, progress=lambda *args: progress.append(args))
+
+    assert [f.name for f in files] == ["notes.txt", "docs.zip/docs/design.md"]
+    assert progress[-1] == ("docs.zip", 3, "docs.zip/docs/build.sh")
+    assert report['files'] == 1 and report['error'] is None
+    assert {e['name']: e['status'] for e in report['entries']} == {
+        "docs.zip/docs/design.md": "extracted", "docs.zip/docs/notes.txt": "duplicate", "docs.zip/docs/build.sh": "skipped",
+    }
+    [_, (text, info)] = app.extract_uploaded_files(files, session_id="archive")
+    assert text.startswith("# Design") and info['error'] is None
+
+    # Reruns reuse the unpacked archive; a broken archive is reported instead of raising
+    files_again, _ = app.expand_uploaded_archives(uploads)
+    assert [f.path for f in files_again[1:]] == [f.path for f in files[1:]] and calls == ["docs.zip"]
+    _, [broken] = app.expand_uploaded_archives([_BufferedUpload("broken.zip", b"PK not really")])
+    assert broken['error'] and broken['files'] == 0
+    # Unpacking another archive evicts the first one; its files go once no session or job holds its members
+    other = io.BytesIO()
+    with zipfile.ZipFile(other, 'w') as archive:
+        archive.writestr("readme.md", "Other project.")
+    app.expand_uploaded_archives([_BufferedUpload("other.zip", other.getvalue())])
+    path = files[1].path
+    assert files[1].getvalue().startswith(b"# Design")
+    del files, files_again
+    gc.collect()
+    assert not os.path.exists(path)
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = app.MemoryLRUCache(max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+    cache.put("c", b"1234")
+    assert cache.get("b") is None and cache.get("a") and cache.get("c")
+    assert cache.stats()['bytes'] == 8
+
+
+def test_evidence_retrieval_keeps_relevant_chunks():
+    filler = "\n\n".join(
+        f"The cafeteria menu for week {i} features soup, salad and a seasonal dessert." for i in range(600)
+    )
+    design = (
+        "# Overview\n\n" + filler + "\n\n"
+        "# Agent Controls\n\nUser prompts are screened for prompt injection and jailbreaking attempts "
+        "before the autonomous agent may take actions.\n\n"
+        "# Identity\n\nOAuth tokens prevent spoofing identity of service callers."
+    )
+    scan = "[Page 1]\nCover page\n\n[Page 2]\nAgents escalate privilege only with human oversight and approval."
+    documents = [("design.md", design), ("review.pdf", scan)]
+
+    content, report = app.compact_documents(documents, PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'], top_k=2)
+
+    retrieval = report["retrieval"]
+    assert retrieval["chunks"] > 10 and retrieval["selected_chunks"] <= 4
+    overhead = report["overhead_tokens"]
+    assert report["prompt_tokens"] - overhead < (report["original_prompt_tokens"] - overhead) // 10
+    assert retrieval["saved_tokens"] == report["original_prompt_tokens"] - report["prompt_tokens"]
+    assert "[Excerpt: Agent Controls]" in content and "prompt injection" in content
+    assert "[Excerpt: Identity]" in content
+    assert "[Excerpt: Page 2]" in content and "Cover page" not in content
+    assert "cafeteria" not in content
+    assert retrieval["groups"]["Agentic AI Risk"]["matched_queries"] >= 3
+    assert 0 < retrieval["recall"] <= 1
+
+    # Small uploads are sent whole
+    _, report = app.compact_documents([("notes.md", scan)], PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'], top_k=2)
+    assert report["retrieval"] is None
+
+
+def test_oversized_documents_summarized_hierarchically_and_cached(monkeypatch):
+    class SummarizingMessages(FakeMessages):
+        def create(self, **kwargs):
+            self.calls.append(("create", kwargs))
+            if kwargs['system'][0]['text'] != app.SUMMARY_SYSTEM_PROMPT:
+                return FakeMessage(REPORT_BLOCKS)
+            part = kwargs['messages'][0]['content'].split("\n\n", 1)[1]
+            return FakeMessage([f"- [Page 1] \"{part[:90]}\""])
+
+    messages = SummarizingMessages()
+    monkeypatch.setattr(app, 'get_anthropic_client', lambda api_key: types.SimpleNamespace(
+        beta=types.SimpleNamespace(messages=messages)))
+    overhead = app.estimate_tokens(app.build_assessment_prompt(PROJECT_INFO, "", 'STRIDE', ['Agentic AI Risk']))
+    monkeypatch.setattr(app, 'MODEL_CONTEXT_TOKENS', overhead + 1000)
+    monkeypatch.setattr(app, 'PROMPT_TOKEN_BUDGET', overhead + 200)
+    monkeypatch.setattr(app, 'SUMMARY_CHUNK_TOKENS', 100)
+    design = "\n\n".join(
+        f"[Page {i}]\nService {i} keeps its tokens in the shared vault and calls the payments API over TLS."
+        for i in range(60)
+    )
+    documents = [("design.pdf", design), ("notes.md", "Agents run as admin.")]
+    assert app.needs_summaries(documents, PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'])
+    progress = []
+
+    digests, report = app.summarize_documents(
+        documents, PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'], 'fake',
+        progress_callback=lambda done, total: progress.append((done, total)),
+    )
+
+    assert digests[1] == documents[1]
+    name, digest = digests[0]
+    assert name == "design.pdf" and digest.startswith("(Digest of a 1,")
+    assert "Service 0 keeps its tokens" in digest
+    [entry] = report["documents"]
+    assert entry["chunks"] > 10 and entry["levels"] == 2 and not entry["cached"]
+    assert entry["tokens"] < entry["original_tokens"] // 3
+    assert report["requests"] == len(messages.calls) == progress[-1][0]
+
+    # Re-assessing the same uploads skips the map phase
+    again, report = app.summarize_documents(documents, PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'], 'fake')
+    assert again == digests and report["documents"][0]["cached"] and report["requests"] == 0
+
+    # So does another framework, risk selection or extra upload, which only changes the share
+    other, report = app.summarize_documents(
+        documents + [("extra.md", "Logs are kept for a year.")], PROJECT_INFO, 'PASTA', ['Model Risk'], 'fake')
+    assert other[0] == digests[0] and report["requests"] == 0
+    assert report["documents"][0]["cached_chunks"] > report["documents"][0]["chunks"]
+
+    # The background job assesses the digests instead of the prepared prompt
+    monkeypatch.setattr(app, '_job_manager', app.AssessmentJobManager(max_workers=1))
+    job_id = app._job_manager.submit(
+        app.run_assessment_job, project_info=PROJECT_INFO, documents_content="### design.pdf\nfull text",
+        framework='STRIDE', risk_areas=['Agentic AI Risk'], api_key='fake', stream=False,
+        documents=documents, summarize=True,
+    )
+    snapshot = _wait_for_job(job_id)
+    assert snapshot["status"] == "done" and snapshot["details"]["summaries"]["documents"][0]["cached"]
+    prompt = messages.calls[-1][1]['messages'][0]['content']
+    assert "(Digest of a 1," in prompt and "full text" not in prompt
+
+
+def test_failed_summary_chunk_cancels_the_rest(monkeypatch):
+    import threading
+    import time
+
+    release = threading.Event()
+    calls = []
+
+    class FailingSummaries(FakeMessages):
+        def create(self, **kwargs):
+            calls.append(1)
+            if "Part 1 of" in kwargs['messages'][0]['content']:
+                raise ValueError("bad request")
+            release.wait(10)
+            return FakeMessage(["- [Page 1] digest"])
+
+    monkeypatch.setattr(app, 'get_anthropic_client', lambda api_key: types.SimpleNamespace(
+        beta=types.SimpleNamespace(messages=FailingSummaries())))
+    monkeypatch.setattr(app, 'SUMMARY_CHUNK_TOKENS', 100)
+    monkeypatch.setattr(app, 'SUMMARY_WORKERS', 2)
+    design = "\n\n".join(f"[Page {i}]\nService {i} calls the payments API over TLS with a shared token." for i in range(60))
+
+    began = time.monotonic()
+    try:
+        with pytest.raises(ValueError, match="bad request"):
+            app.summarize_documents([("design.pdf", design)], PROJECT_INFO, 'STRIDE', ['Agentic AI Risk'], 'fake',
+                                    use_cache=False, force_messages=True)
+        assert time.monotonic() - began < 5
+    finally:
+        release.set()
+    time.sleep(0.1)
+    # The worker freed by the failure may start one more chunk before the rest are cancelled
+    assert len(calls) <= 3 < len(app._pack_paragraphs(design, 100))
+
+
+def test_evidence_quotes_verified_against_uploads():
+    documents = [
+        ("Architecture_Design_v2.pdf", "[Page 1]\nIntroduction.\n\n[Page 3]\nAgent Permissions: All agents are "
+                                       "deployed with admin-level access to financial systems."),
+        ("config.md", "Agents can access database admin credentials, API keys, payment processing tokens and "
+                      "customer data repositories."),
+    ]
+    report = (
+        "# FINDINGS\n\n"
+        "| F001 | Over-privileged agents | [Document: Architecture_Design_v2.pdf] | "
+        "\"all agents are deployed with ADMIN-LEVEL access to financial systems\" | CRITICAL |\n"
+        "| F002 | Static secrets | [Document: Vault_Runbook.pdf] | 'API keys are rotated every ninety days' | HIGH |\n\n"
+        "**EXAMPLE from config.md:** The document states 'Agents can access database admin credentials, API keys, "
+        "payment tokens and customer data repositories' (F003).\n\n"
+        "## Recommendations\n\nLabels like \"Agent Permissions\" are too short to check.\n"
+    )
+
+    verified, stats = app.verify_evidence(report, documents)
+
+    assert verified.startswith(report.rstrip("\n"))
+    assert "## EVIDENCE VERIFICATION" in verified
+    assert "| F001 | Verified | \"all agents are deployed with ADMIN-LEVEL access to financial systems\" verified " \
+           "— Architecture_Design_v2.pdf p. 3 |" in verified
+    assert "| F002 | Unsupported |" in verified and "Vault_Runbook.pdf was not uploaded" in verified
+    assert "| F003 | Fuzzy |" in verified and "— config.md |" in verified
+    assert (stats["findings"], stats["quotes"]) == (3, 3)
+    assert (stats["verified"], stats["fuzzy"], stats["unsupported"]) == (1, 1, 1)
+
+    # Nothing to check: the report is returned unchanged
+    unchanged, stats = app.verify_evidence(REPORT_BLOCKS[0], documents)
+    assert unchanged == REPORT_BLOCKS[0] and stats["findings"] == 0
+
+
+def test_evidence_verification_scales_to_large_uploads():
+    import random
+    import time
+
+    rng = random.Random(7)
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9))) for _ in range(5000)]
+    text = " ".join(rng.choice(vocabulary) for _ in range(500_000))
+    quotes = []
+    for i in range(300):
+        start = text.index(" ", rng.randrange(len(text) - 200)) + 1
+        words = text[start:start + 250].split()[:20]
+        if i % 3 == 1:
+            words[10] = "rewritten"
+        elif i % 3 == 2:
+            words = ["invented", "evidence", str(i)] + vocabulary[i:i + 9]
+        quotes.append(" ".join(words))
+    report = "\n".join(f"| F{i:03d} | finding | \"{quote}\" |" for i, quote in enumerate(quotes))
+    index = app.EvidenceIndex([("large.md", text)])
+
+    started = time.monotonic()
+    _, stats = app.verify_evidence(report, [("large.md", text)], index=index)
+
+    assert time.monotonic() - started < 1.0
+    assert stats["findings"] == 300
+    assert stats["verified"] == 100 and stats["fuzzy"] == 100 and stats["unsupported"] == 100
+
+
+def test_images_sent_as_content_blocks_on_messages_api(monkeypatch, isolated_response_cache):
+    messages = FakeMessages()
+    monkeypatch.setattr(app, 'get_anthropic_client', lambda api_key: types.SimpleNamespace(
+        beta=types.SimpleNamespace(messages=messages)))
+    images = [{"name": "flow.png", "media_type": "image/webp", "data": b"RIFF1234", "width": 1500, "height": 750}]
+
+    report = app.generate_threat_assessment(
+        PROJECT_INFO, "docs", 'STRIDE', ['Agentic AI Risk'], "key", use_cache=True,
+        force_messages=False, raise_errors=True, images=images,
+    )
+
+    # Images need the Messages API even when it is not forced
+    assert report and len(messages.calls) == 1
+    label, image, prompt = messages.calls[0][1]["messages"][0]["content"]
+    assert label == {"type": "text", "text": "Image: flow.png"}
+    assert image["source"] == {"type": "base64", "media_type": "image/webp", "data": "UklGRjEyMzQ="}
+    assert prompt["type"] == "text" and "docs" in prompt["text"]
+    # The same prompt with different image bytes is a different cache entry
+    app.generate_threat_assessment(
+        PROJECT_INFO, "docs", 'STRIDE', ['Agentic AI Risk'], "key", use_cache=True,
+        force_messages=False, raise_errors=True, images=[dict(images[0], data=b"RIFF5678")],
+    )
+    assert len(messages.calls) == 2
+
+
+def test_image_uploads_shrunk_to_byte_budget(monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+
+    monkeypatch.setattr(app, '_shared_extraction_pool', lambda: None)
+    monkeypatch.setattr(app, 'IMAGE_MAX_EDGE', 400)
+    monkeypatch.setattr(app, 'IMAGE_MIN_EDGE', 100)
+    uploads = []
+    for i in range(3):
+        buffer = io.BytesIO()
+        Image.effect_noise((800, 600), 40 + i).convert("RGB").save(buffer, format="PNG")
+        uploads.append(_Upload(f"screen{i}.png", buffer.getvalue()))
+    uploads.append(_Upload("notes.md", b"# Notes"))
+
+    images, infos = app.prepare_uploaded_images(uploads)
+    unlimited = sum(len(image['data']) for image in images)
+    assert len(images) == 3 and infos[3] is None
+    assert all(info['width'] == 400 and info['tokens'] == app.image_tokens(400, 300) for info in infos[:3])
+
+    monkeypatch.setattr(app, 'IMAGE_BUDGET_BYTES', unlimited // 2)
+    images, infos = app.prepare_uploaded_images(uploads)
+    assert len(images) == 3 and sum(len(image['data']) for image in images) <= unlimited // 2
+    assert all(info['budget_scaled'] and info['width'] < 400 for info in infos[:3])
+
+
+def _wait_for_job(job_id, timeout=5):
+    import time
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        snapshot = app._job_manager.get(job_id).snapshot()
+        if snapshot["status"] in ("done", "failed"):
+            return snapshot
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_background_job_streams_and_stores_result(monkeypatch):
+    messages = FakeMessages()
+    monkeypatch.setattr(app, 'get_anthropic_client', lambda api_key: types.SimpleNamespace(
+        beta=types.SimpleNamespace(messages=messages)))
+    monkeypatch.setattr(app, '_job_manager', app.AssessmentJobManager(max_workers=2))
+
+    job_id = app._job_manager.submit(
+        app.run_assessment_job, description='StreamTest', project_info=PROJECT_INFO,
+        documents_content="### design.md\nAll agents run with admin access.", framework='STRIDE',
+        risk_areas=['Agentic AI Risk'], api_key='fake', use_cache=False, force_messages=False,
+        documents=[("design.md", "All agents run with admin access.")],
+    )
+    snapshot = _wait_for_job(job_id)
+
+    assert snapshot["status"] == "done"
+    assert snapshot["result"].startswith("".join(REPORT_BLOCKS).rstrip("\n"))
+    assert snapshot["streamed"] == "".join(REPORT_BLOCKS)
+    assert messages.calls[0][0] == "stream"
+    assert "usage" in snapshot["details"]
+    assert snapshot["details"]["evidence"]["findings"] == 0
+
+
+def test_background_job_failure_is_reported(monkeypatch):
+    class BrokenMessages(FakeMessages):
+        def stream(self, **kwargs):
+            raise RuntimeError("invalid x-api-key")
+
+    monkeypatch.setattr(app, 'get_anthropic_client', lambda api_key: types.SimpleNamespace(
+        beta=types.SimpleNamespace(messages=BrokenMessages())))
+    monkeypatch.setattr(app, '_job_manager', app.AssessmentJobManager(max_workers=1, result_ttl=0))
+
+    job_id = app._job_manager.submit(
+        app.run_assessment_job, project_info=PROJECT_INFO, documents_content="", framework='STRIDE',
+        risk_areas=['Agentic AI Risk'], api_key='fake', use_cache=False, force_messages=False,
+    )
+    snapshot = _wait_for_job(job_id)
+    assert snapshot["status"] == "failed"
+    assert "invalid x-api-key" in snapshot["error"]
+
+    # Finished jobs expire after the result TTL
+    app._job_manager.submit(lambda job: None)
+    assert app._job_manager.get(job_id) is None
@@ -40,6 +40,8 @@ class _AnthropicStub:
 fake_anthropic.Anthropic = _AnthropicStub
 sys.modules['anthropic'] = fake_anthropic
 
+import app
+import render_worker
 from app import create_pdf_download
 
 
@@ -54,17 +56,29 @@ def test_create_pdf_with_weasyprint(monkeypatch):
 
     monkeypatch.setitem(sys.modules, 'markdown', types.SimpleNamespace(Markdown=DummyMd))
 
-    # Provide a fake weasyprint.HTML that returns PDF bytes
+    # Provide a fake weasyprint (HTML, CSS, FontConfiguration) that returns PDF bytes
     class FakeHTML:
         def __init__(self, string=None):
             self.string = string
 
-        def write_pdf(self):
+        def write_pdf(self, **kwargs):
             return b"%PDF-FAKE-BYTES"
 
-    monkeypatch.setitem(sys.modules, 'weasyprint', types.SimpleNamespace(HTML=FakeHTML))
-
-    filename, content, mime = create_pdf_download('# EXECUTIVE SUMMARY\nTest', 'TestProject')
+    fonts = types.SimpleNamespace(FontConfiguration=lambda: object())
+    monkeypatch.setitem(sys.modules, 'weasyprint', types.SimpleNamespace(
+        HTML=FakeHTML, CSS=lambda string=None, font_config=None: string))
+    monkeypatch.setitem(sys.modules, 'weasyprint.text', types.SimpleNamespace(fonts=fonts))
+    monkeypatch.setitem(sys.modules, 'weasyprint.text.fonts', fonts)
+    render_worker._weasyprint_styles.cache_clear()
+    # The fake module only exists in this process, so render here rather than in the worker pool
+    monkeypatch.setattr(app, 'get_render_pool', lambda: None)
+    monkeypatch.setattr(app, '_report_html_cache', app.MemoryLRUCache(1024 * 1024))
+    monkeypatch.setattr(app, '_pdf_cache', app.MemoryLRUCache(1024 * 1024, sizeof=lambda entry: len(entry[0])))
+
+    try:
+        filename, content, mime = create_pdf_download('# EXECUTIVE SUMMARY\nTest', 'TestProject', branding={})
+    finally:
+        render_worker._weasyprint_styles.cache_clear()
 
     assert mime == 'application/pdf'
     assert filename.endswith('.pdf')
@@ -92,3 +106,59 @@ def test_create_pdf_fallback_when_weasyprint_missing(monkeypatch):
     assert mime == 'text/markdown'
     assert filename.endswith('.md')
     assert isinstance(content, str)
+
+
+def test_rendered_pdf_cached_by_report_and_branding(monkeypatch):
+    renders = []
+
+    def fake_render(report, branding, pool=None, timeout=None):
+        renders.append(branding.get('company_name'))
+        return b"%PDF-" + report.html[:3].encode(), None
+
+    monkeypatch.setattr(render_worker, 'render_pdf', fake_render)
+    monkeypatch.setattr(app, '_pdf_cache', app.MemoryLRUCache(12, sizeof=lambda entry: len(entry[0])))
+    branding = {'logo_image': b"png", 'company_name': "Acme", 'report_footer': ""}
+
+    first = create_pdf_download('# A', 'TestProject', branding=branding)
+    again = create_pdf_download('# A', 'TestProject', branding=dict(branding))
+    assert first == again and first[2] == 'application/pdf'
+    assert renders == ["Acme"]
+
+    # A new logo, company name or report is a new PDF
+    create_pdf_download('# A', 'TestProject', branding=dict(branding, logo_image=b"other"))
+    create_pdf_download('# A', 'TestProject', branding=dict(branding, company_name="Initech"))
+    assert renders == ["Acme", "Acme", "Initech"]
+
+    # Bounded by bytes: each PDF is 8 bytes, so only the latest one is kept
+    create_pdf_download('# A', 'TestProject', branding=branding)
+    assert renders == ["Acme", "Acme", "Initech", "Acme"]
+    assert app._pdf_cache.stats()['entries'] == 1
+
+
+def test_report_converted_once_for_preview_and_exports(monkeypatch):
+    conversions = []
+    rendered = []
+
+    def fake_convert(markdown_text):
+        conversions.append(markdown_text)
+        return render_worker.ReportHtml(f"<p>{markdown_text}</p>", toc="<ul></ul>")
+
+    def fake_render(report, branding, pool=None, timeout=None):
+        rendered.append(report)
+        return b"%PDF-" + report.html.encode(), None
+
+    monkeypatch.setattr(render_worker, 'convert_markdown', fake_convert)
+    monkeypatch.setattr(render_worker, 'render_pdf', fake_render)
+    monkeypatch.setattr(app, '_report_html_cache', app.MemoryLRUCache(1024 * 1024))
+    monkeypatch.setattr(app, '_pdf_cache', app.MemoryLRUCache(1024 * 1024, sizeof=lambda entry: len(entry[0])))
+
+    assert app.render_markdown_as_html('# Shared') == "<p># Shared</p>"
+    assert "<p># Shared</p>" in app.markdown_to_html('# Shared')
+    create_pdf_download('# Shared', 'TestProject', branding={})
+    create_pdf_download('# Shared', 'TestProject', branding={'company_name': "Acme"})
+
+    assert conversions == ['# Shared']
+    assert len(rendered) == 2 and rendered[0] is rendered[1]
+
+    app.render_markdown_as_html('# Edited')
+    assert conversions == ['# Shared', '# Edited']
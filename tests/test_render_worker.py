@@ -0,0 +1,186 @@
+import os
+import sys
+import time
+import types
+
+import pytest
+
+import render_worker
+
+
+@pytest.fixture
+def pool():
+    pool = render_worker.RenderPool(1, memory_bytes=512 * 1024 * 1024)
+    yield pool
+    pool.close()
+
+
+def test_render_pool_reuses_workers_and_recovers_from_timeouts_and_crashes(pool):
+    assert pool.run(len, ("abc",), timeout=30) == 3
+    first = pool._idle[0].process.pid
+
+    with pytest.raises(render_worker.RenderTimeout, match="sleep did not finish within 0.5 s"):
+        pool.run(time.sleep, (30,), timeout=0.5)
+    with pytest.raises(render_worker.RenderFailed, match="exit code 3"):
+        pool.run(os._exit, (3,), timeout=30)
+    with pytest.raises(render_worker.RenderFailed, match="ValueError"):
+        pool.run(int, ("not a number",), timeout=30)
+
+    # Killed workers are replaced; a worker whose task raised is kept
+    assert pool.run(len, ("abcd",), timeout=30) == 4
+    assert pool._idle[0].process.pid != first
+    stats = pool.stats()
+    assert (stats['workers'], stats['busy'], stats['queued']) == (1, 0, 0)
+    assert (stats['renders'], stats['timeouts'], stats['failures']) == (5, 1, 2)
+    assert stats['p95_seconds'] < 30
+
+
+@pytest.mark.skipif(os.name != 'posix', reason="address space limits need the resource module")
+def test_render_worker_memory_is_capped(pool):
+    with pytest.raises(render_worker.RenderFailed, match="MemoryError"):
+        pool.run(bytearray, (2 * 1024 * 1024 * 1024,), timeout=30)
+
+
+def test_render_pdf_falls_back_to_reportlab_when_weasyprint_times_out(monkeypatch):
+    class SlowWeasyPrintPool:
+        def run(self, fn, args, timeout=None):
+            if fn is render_worker.render_weasyprint:
+                raise render_worker.RenderTimeout(f"render_weasyprint did not finish within {timeout:g} s")
+            return b"%PDF-basic"
+
+    report = render_worker.ReportHtml("<h1>Report</h1>")
+    pdf_bytes, error = render_worker.render_pdf(report, {}, pool=SlowWeasyPrintPool(), timeout=5)
+
+    assert pdf_bytes == b"%PDF-basic"
+    assert error == "render_weasyprint did not finish within 5 s"
+
+
+def test_converted_report_pickles_without_its_parse_tree():
+    pickle = pytest.importorskip("pickle")
+    pytest.importorskip("bs4")
+    report = render_worker.ReportHtml("<h1>Report</h1><p>High risk</p>", toc="<ul></ul>")
+    assert [el.name for el in report.soup().contents] == ["h1", "p"]
+
+    copy = pickle.loads(pickle.dumps(report))
+
+    assert (copy.html, copy.toc, copy.error, copy._soup) == (report.html, report.toc, None, None)
+
+
+def test_risk_levels_styled_in_text_only_in_one_pass():
+    html = (
+        '<p>High risk; <a href="https://example.com/High" title="LOW">see Critical</a> '
+        'Highlight P0 P10 medium Medium</p>'
+    )
+
+    assert render_worker.apply_risk_styling(html) == (
+        '<p><span class="risk-high">High</span> risk; <a href="https://example.com/High" title="LOW">see '
+        '<span class="risk-critical">Critical</span></a> Highlight <span class="priority-critical">P0</span> '
+        'P10 medium <span class="risk-medium">Medium</span></p>'
+    )
+    assert render_worker.annotate_risk_levels("LOW impact", render_worker._RISK_FONTS) == (
+        '<font color="#22543d"><b>LOW</b></font> impact'
+    )
+
+
+def test_risk_styling_is_linear_on_large_reports():
+    row = (
+        '<tr><td><a href="https://example.com/findings/High-risk">F{0}</a></td><td>Critical</td><td>P1</td>'
+        '<td>Secrets are stored in plain text; impact is High and likelihood Medium.</td></tr>\n'
+    )
+
+    def report(kilobytes):
+        return "".join(row.format(i) for i in range(kilobytes * 1024 // len(row)))
+
+    def best_time(html):
+        # Best of three, so one slow run on a shared machine does not skew the ratio
+        timings = []
+        for _ in range(3):
+            started = time.perf_counter()
+            styled = render_worker.apply_risk_styling(html)
+            timings.append(time.perf_counter() - started)
+        return min(timings), styled
+
+    small, _ = best_time(report(512))
+    html = report(2048)
+    large, styled = best_time(html)
+    rows = html.count("<tr>")
+
+    assert styled.count('<span class="risk-critical">Critical</span>') == rows
+    assert styled.count('<span class="risk-high">High</span>') == rows
+    assert styled.count('<span class="risk-medium">Medium</span>') == rows
+    assert styled.count('<span class="priority-high">P1</span>') == rows
+    assert styled.count('href="https://example.com/findings/High-risk"') == rows
+    # Four times the input takes about four times as long; quadratic work would take sixteen
+    assert large < small * 8
+
+
+def _weasyprint():
+    try:
+        import weasyprint
+    except (ImportError, OSError) as e:
+        # OSError: the Python package is installed but Pango/Cairo are not
+        pytest.skip(f"WeasyPrint unavailable: {e}")
+    return weasyprint
+
+
+def test_weasyprint_stylesheet_and_fonts_built_once_per_process(monkeypatch):
+    built = []
+    documents = []
+
+    class FontConfiguration:
+        def __init__(self):
+            built.append("fonts")
+
+    class CSS:
+        def __init__(self, string=None, font_config=None):
+            built.append("css")
+            self.font_config = font_config
+
+    class HTML:
+        def __init__(self, string=None):
+            self.string = string
+
+        def write_pdf(self, stylesheets=None, font_config=None, **options):
+            documents.append((self.string, stylesheets, font_config))
+            return b"%PDF-fake"
+
+    fonts_module = types.SimpleNamespace(FontConfiguration=FontConfiguration)
+    monkeypatch.setitem(sys.modules, 'weasyprint', types.SimpleNamespace(HTML=HTML, CSS=CSS))
+    monkeypatch.setitem(sys.modules, 'weasyprint.text', types.SimpleNamespace(fonts=fonts_module))
+    monkeypatch.setitem(sys.modules, 'weasyprint.text.fonts', fonts_module)
+    render_worker._weasyprint_styles.cache_clear()
+    try:
+        report = render_worker.ReportHtml("<h1>Report</h1>", toc="<ul></ul>")
+        render_worker.render_weasyprint(report, {'company_name': "Acme", 'report_footer': 'Ask "security"'})
+        render_worker.render_weasyprint(report, {'company_name': "Initech"})
+    finally:
+        render_worker._weasyprint_styles.cache_clear()
+
+    assert built == ["fonts", "css"]
+    (first, stylesheets, font_config), (second, stylesheets_again, _) = documents
+    assert stylesheets == stylesheets_again and stylesheets[0].font_config is font_config
+    # Only the footer and header are in the document; the static rules come from the shared stylesheet
+    assert 'content: "Ask \\"security\\"";' in first and "<h1>Acme</h1>" in first
+    assert "<h1>Initech</h1>" in second and "Generated " in second
+    assert ".toc-container" not in first and ".toc-container" in render_worker.REPORT_STYLESHEET
+
+
+def test_weasyprint_render_timings_with_precompiled_stylesheet(record_property):
+    _weasyprint()
+    rows = "".join(f"| T{i} | High | Tokens are logged in plain text. |\n" for i in range(400))
+    report = render_worker.convert_markdown(f"# Findings\n\n| ID | Risk | Finding |\n|---|---|---|\n{rows}")
+
+    # Before: the stylesheet is parsed and the fonts configured for every render
+    render_worker._weasyprint_styles.cache_clear()
+    started = time.perf_counter()
+    render_worker.render_weasyprint(report, {})
+    before = time.perf_counter() - started
+    # After: later renders in the process reuse both
+    started = time.perf_counter()
+    pdf_bytes = render_worker.render_weasyprint(report, {})
+    after = time.perf_counter() - started
+
+    record_property("render_seconds_building_stylesheet", round(before, 3))
+    record_property("render_seconds_precompiled_stylesheet", round(after, 3))
+    assert pdf_bytes.startswith(b"%PDF")
+    assert render_worker._weasyprint_styles.cache_info().hits >= 1
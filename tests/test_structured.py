@@ -0,0 +1,171 @@
+import json
+
+import pytest
+
+import extractors
+import structured
+
+USER = {"type": "object", "properties": {"id": {"type": "string"}, "password": {"type": "string"}}}
+OPENAPI = {
+    "openapi": "3.0.1",
+    "info": {"title": "Payments API", "version": "2"},
+    "servers": [{"url": "http://legacy.example.com"}],
+    "security": [{"bearerAuth": []}],
+    "components": {
+        "securitySchemes": {
+            "bearerAuth": {"type": "http", "scheme": "bearer"},
+            "oauth": {"type": "oauth2", "flows": {"clientCredentials": {
+                "tokenUrl": "https://auth.example.com/token", "scopes": {"write": "write"}}}},
+        },
+        "schemas": {"User": USER},
+    },
+    "paths": {
+        "/health": {"get": {"security": [], "responses": {"200": {}}}},
+        **{
+            f"/users/{i}/{{id}}": {
+                "parameters": [{"name": "id", "in": "path"}],
+                "put": {
+                    "security": [{"oauth": ["write"]}],
+                    "requestBody": {"content": {"application/json": {"schema": {"$ref": "#/components/schemas/User"}}}},
+                    "responses": {"204": {}},
+                },
+            }
+            for i in range(30)
+        },
+    },
+}
+
+
+def test_openapi_outline_lists_endpoints_auth_and_schemas_once():
+    text, fields = structured.outline([OPENAPI], "api.json")
+
+    assert fields["outline"] == "OpenAPI · 31 endpoints (1 without auth) · 2 auth schemes"
+    assert "- GET /health · auth: NONE (public) · responses: 200 (#/paths/~1health/get)" in text
+    assert "PUT /users/7/{id} · auth: oauth[write] · params: id (path) · body: User (application/json)" in text
+    assert "(#/paths/~1users~17~1{id}/put)" in text
+    assert "- User: object {id, password} · referenced 30× · sensitive fields: password" in text
+    assert "Server: http://legacy.example.com (plaintext)" in text
+    # The token URL is not mistaken for a secret
+    assert "<redacted" not in text
+    assert len(text) < len(json.dumps(OPENAPI, indent=2)) / 2
+
+
+def test_manifests_outlined_with_pointers_and_redacted_secrets(tmp_path):
+    pytest.importorskip("yaml")
+    path = tmp_path / "0.yaml"
+    path.write_text(
+        "apiVersion: apps/v1\n"
+        "kind: Deployment\n"
+        "metadata: {name: api, namespace: prod}\n"
+        "spec:\n"
+        "  template:\n"
+        "    spec:\n"
+        "      containers:\n"
+        "      - name: api\n"
+        "        image: registry/api:1.2\n"
+        "        ports: [{containerPort: 8080}]\n"
+        "        securityContext: {privileged: true}\n"
+        "        env: [{name: DB_PASSWORD, value: hunter2hunter2}]\n"
+        "---\n"
+        "apiVersion: v1\n"
+        "kind: Service\n"
+        "metadata: {name: api}\n"
+        "spec: {type: LoadBalancer, ports: [{port: 443, targetPort: 8080}]}\n"
+    )
+
+    text, fields = structured.ingest_file(path, "deploy.yaml")
+
+    assert fields["outline"] == "Kubernetes · 2 objects"
+    assert "Structured outline of deploy.yaml" in text
+    assert "- Deployment prod/api · container api: registry/api:1.2 ports 8080 (#/0)" in text
+    assert "- Service api · type LoadBalancer ports 443→8080 (#/1)" in text
+    assert "#/0/spec/template/spec/containers/0/securityContext/privileged: privileged: true" in text
+    assert "DB_PASSWORD = <redacted, 14 chars>" in text and "hunter2" not in text
+
+
+def test_generic_json_collapses_repeats_and_unparsable_files_pass_through():
+    plan = {
+        "resource_changes": [{"address": f"aws_instance.web[{i}]", "change": {"actions": ["create"]}} for i in range(50)],
+        "db": {"password": "supersecret", "publicly_accessible": True, "ingress": ["0.0.0.0/0"]},
+        "copy": {"resource": {"a": 1, "b": 2, "c": 3, "d": 4}},
+        "again": {"resource": {"a": 1, "b": 2, "c": 3, "d": 4}},
+    }
+    documents = [("plan.json", json.dumps(plan).encode()), ("broken.json", b"{not json")]
+
+    [(text, info), (raw, raw_info)] = extractors.extract_documents(documents)
+
+    assert "… 49 more items shaped like #/resource_changes/0" in text and "web[7]" not in text
+    assert "\nagain: (same as #/copy)" in text
+    assert "#/db/password: password = <redacted, 11 chars>" in text and "supersecret" not in text
+    assert "#/db/publicly_accessible: publicly_accessible: true" in text
+    assert "#/db/ingress/0: 0.0.0.0/0 (open to the internet)" in text
+    assert info["collapsed"] == 2 and info["findings"] == 3 and info["error"] is None
+    assert raw_info["parse_error"] and raw.endswith("{not json")
+
+
+def test_alias_bombs_and_self_references_pass_through_as_raw_text(tmp_path):
+    pytest.importorskip("yaml")
+    import time
+
+    levels = ["a: &a [x, x, x, x, x, x, x, x, x]"] + [
+        f"{name}: &{name} [{', '.join(['*' + prev] * 9)}]" for prev, name in zip("abcdefg", "bcdefgh")
+    ]
+    bomb = tmp_path / "bomb.yaml"
+    bomb.write_text("\n".join(levels) + "\n")
+    cycle = tmp_path / "cycle.yaml"
+    cycle.write_text("a: &a [*a]\n")
+
+    started = time.monotonic()
+    text, fields = structured.ingest_file(str(bomb), "bomb.yaml")
+    assert time.monotonic() - started < 5
+    assert "once YAML aliases are expanded" in fields['parse_error'] and text.endswith("\n".join(levels) + "\n")
+
+    text, fields = structured.ingest_file(str(cycle), "cycle.yaml")
+    assert fields['outline'] == "unparsed" and "a: &a [*a]" in text
+
+    # Shared anchors within the limits are still outlined
+    shared = tmp_path / "shared.yaml"
+    shared.write_text("defaults: &defaults {privileged: true}\nweb: *defaults\nworker: *defaults\n")
+    text, fields = structured.ingest_file(str(shared), "shared.yaml")
+    assert 'parse_error' not in fields and fields['findings'] == 3
+
+
+def test_unexpected_value_types_are_outlined_not_dropped(tmp_path):
+    documents = [
+        {"openapi": "3.0.0", "info": "Payments", "servers": "https://api.example.com",
+         "components": {"securitySchemes": ["bearer"], "schemas": {"User": {"properties": ["id"]}}},
+         "security": "bearer",
+         "paths": {"/users": {"parameters": {"name": "id"}, "get": {"requestBody": "json", "responses": 200}}}},
+        {"apiVersion": "v1", "kind": None, "metadata": "web", "spec": {"containers": "nginx", "ports": [80]}},
+        {"apiVersion": "v1", "kind": "ServiceList", "items": {"web": {}}},
+        {"apiVersion": "v1", "kind": "Service", "metadata": {"name": "web"}, "spec": {"ports": ["80"], "rules": 3}},
+        {200: "ok", "default": {"a": 1, "b": 2, "c": 3, "d": 4}},
+    ]
+
+    text, fields = structured.outline(documents, "mixed.yaml")
+
+    assert "- GET /users · auth: bearer" in text
+    assert "- Service web · type ClusterIP ports " in text
+    assert fields['outline'] == "OpenAPI · 1 endpoints (0 without auth) · 0 auth schemes; Kubernetes · 2 objects"
+
+    path = tmp_path / "odd.json"
+    path.write_text(json.dumps({"kind": None, "info": "text", "n": [1, 2]}))
+    text, fields = extractors.extract_files([("odd.json", str(path))])[0]
+    assert fields['error'] is None and 'parse_error' not in fields
+
+
+def test_unparsable_files_pass_through_with_secrets_masked(tmp_path):
+    broken = tmp_path / "values.yaml"
+    broken.write_text(
+        "db:\n  password: hunter2\n  secretName: db-creds\n  tls_private_key: |\n    -----BEGIN KEY-----\n"
+        "  host: db\n  [unclosed\n"
+    )
+    text, fields = structured.ingest_file(str(broken), "values.yaml")
+    assert fields["outline"] == "unparsed"
+    assert "hunter2" not in text and "BEGIN KEY" not in text
+    assert "password: <redacted, 7 chars>" in text and "secretName: db-creds" in text and "host: db" in text
+
+    broken = tmp_path / "config.json"
+    broken.write_text('{"user": "svc", "api_key": "sk-live-123", ')
+    text, _ = structured.ingest_file(str(broken), "config.json")
+    assert "sk-live-123" not in text and '"user": "svc"' in text